@@ -1,9 +1,26 @@
+"""
+Filter the transforms in /tf and /tf_static of bag files by frame_id
+
+Only the tf topics are deserialized, all other topics are copied as raw serialized
+bytes (with their connection headers), so filtering runs at disk speed.
+
+Example to use:
+
+python filter_tf.py in.bag -o out.bag
+python filter_tf.py in.bag out.bag  # old form, out.bag must not exist yet
+python filter_tf.py a.bag b.bag c.bag -d filtered_folder -j 4
+
+"""
 import os
 import sys
+import argparse
 import rosbag
 import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+TF_TOPICS = ('/tf', '/tf_static')
 
-frame_to_keep = [
+frame_to_keep = {
     't265_odom_frame',
     't265_pose_frame',
     't265_link',
@@ -13,43 +30,84 @@ frame_to_keep = [
     'd435i_depth_optical_frame',
     'd435i_aligned_depth_to_color_frame',
     'd435i_color_optical_frame',
-]
+}
 
 def filter_tf(in_bag, out_bag, frame_to_keep):
+    """Write the filtered bag to <out_bag>.tmp and rename it on success, so a failed run leaves no partial bag"""
     print("Reading from " + in_bag)
-    bag = rosbag.Bag(in_bag, 'r')
-    with rosbag.Bag(out_bag, 'w') as outbag:
-        print("Writing to " + out_bag)
-        for topic, msg, t in bag.read_messages():
-            if topic == '/tf' and msg.transforms:
-                transforms_to_keep = []
-                for i in range(len(msg.transforms)):
-                    if msg.transforms[i].header.frame_id in frame_to_keep:
-                        transforms_to_keep.append(msg.transforms[i])
-                    
-                msg.transforms = transforms_to_keep
-                outbag.write('/tf', msg, t)
-
-            elif topic == '/tf_static' and msg.transforms:
-                transforms_to_keep = []
-                for i in range(len(msg.transforms)):
-                    if msg.transforms[i].header.frame_id in frame_to_keep:
-                        transforms_to_keep.append(msg.transforms[i])
-                    
-                msg.transforms = transforms_to_keep
-                outbag.write('/tf_static', msg, t)
-
-            else:
-                outbag.write(topic, msg, t)
+    frame_to_keep = set(frame_to_keep)
+    tmp_bag = out_bag + '.tmp'
+    try:
+        with rosbag.Bag(in_bag, 'r') as bag, rosbag.Bag(tmp_bag, 'w') as outbag:
+            print("Writing to " + out_bag)
+            for topic, raw_msg, t, connection_header in bag.read_messages(raw=True, return_connection_header=True):
+                if topic in TF_TOPICS:
+                    msg_type = raw_msg[4]
+                    msg = msg_type()
+                    msg.deserialize(raw_msg[1])
+                    if msg.transforms:
+                        msg.transforms = [transform for transform in msg.transforms
+                                          if transform.header.frame_id in frame_to_keep]
+                        outbag.write(topic, msg, t, connection_header=connection_header)
+                        continue
+
+                outbag.write(topic, raw_msg, t, raw=True, connection_header=connection_header)
+    except BaseException:
+        if os.path.exists(tmp_bag):
+            os.remove(tmp_bag)
+        raise
+    os.replace(tmp_bag, out_bag)
+
+def get_output_path(in_bag, output_folder=None):
+    """<in_bag>_filtered.bag, in output_folder if given"""
+    name = os.path.splitext(os.path.basename(in_bag))[0] + '_filtered.bag'
+    return os.path.join(output_folder or os.path.dirname(in_bag), name)
+
+def filter_tf_bags(bag_pairs, frame_to_keep, num_workers=4):
+    """Filter (in_bag, out_bag) pairs in a process pool, return the failed pairs"""
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(filter_tf, in_bag, out_bag, frame_to_keep): (in_bag, out_bag)
+                   for in_bag, out_bag in bag_pairs}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to filter %s: %s" % (futures[future][0], e))
+                failed.append(futures[future])
+    return failed
 
 
 if __name__ == "__main__":
-    in_bag = sys.argv[1]
-    out_bag = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Filter the tf frames of ROS bags.")
+    parser.add_argument("bags", nargs='+', help="Input bags.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output bag, for a single input bag.")
+    parser.add_argument("-d", "--output-folder", default=None,
+                        help="Output folder of the <bag>_filtered.bag files, default to the folder of each input bag.")
+    parser.add_argument("-j", "--workers", type=int, default=4, help="Number of worker processes.")
+    args = parser.parse_args()
 
-    try:
-        filter_tf(in_bag, out_bag, frame_to_keep)
-        print('Successful!')
-    except Exception as e:
-        print(e)
+    # old form "filter_tf.py in.bag out.bag": the second bag is the output if it does not exist yet
+    if (len(args.bags) == 2 and args.output is None and args.output_folder is None and
+            os.path.isfile(args.bags[0]) and not os.path.exists(args.bags[1])):
+        args.output = args.bags.pop()
+
+    missing = [in_bag for in_bag in args.bags if not os.path.isfile(in_bag)]
+    if len(missing) > 0:
+        parser.error("input bags not found: %s (use -o/--output for the output bag)" % ', '.join(missing))
+
+    if args.output is not None:
+        if len(args.bags) != 1 or args.output_folder is not None:
+            parser.error("-o/--output takes a single input bag, use -d/--output-folder for several bags")
+        bag_pairs = [(args.bags[0], args.output)]
+    else:
+        if args.output_folder is not None:
+            os.makedirs(args.output_folder, exist_ok=True)
+        bag_pairs = [(in_bag, get_output_path(in_bag, args.output_folder)) for in_bag in args.bags]
 
+    failed = filter_tf_bags(bag_pairs, frame_to_keep, min(args.workers, len(bag_pairs)))
+    if len(failed) > 0:
+        print("Failed to filter %d of %d bags." % (len(failed), len(bag_pairs)))
+        sys.exit(1)
+    print('Successful!')
@@ -33,6 +33,7 @@ from pytorch_grad_cam.utils.model_targets import (
     ClassifierOutputTarget, 
     RawScoresOutputTarget,
 )
+from utils.train_utils import get_color_file_list
 
 methods = {
     "gradcam": GradCAM,
@@ -111,8 +112,7 @@ if __name__ == '__main__':
     folder_path = "/media/lab/NEPTUNE2/field_datasets/row_18/2022-11-15-11-26-08"
 
     # image files
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     # Start the loop
     out = cv2.VideoWriter('/home/lab/affordance_distance_abla.avi', cv2.VideoWriter_fourcc(*'MJPG'), 6, (256, 256))     
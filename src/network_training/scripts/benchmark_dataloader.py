@@ -0,0 +1,175 @@
+'''
+Benchmark the DataLoader of a model over num_workers, batch_size, prefetch_factor
+and pin_memory, and write the fastest settings into its YAML configuration
+
+Each batch is moved to the device and a forward/backward pass of the model (with
+random weights) is run, so the idle fraction is the share of the step time spent
+waiting for data. The on-device batch augmentation is not included.
+
+Example:
+
+python benchmark_dataloader.py affordance --workers 0 2 4 8 --write
+python benchmark_dataloader.py vanilla_vae --batch-sizes 32 64 128 --write --tune-batch-size
+
+'''
+import os
+import argparse
+import torch
+
+from utils.train_utils import read_yaml
+from utils.augment_utils import ToUInt8Tensor, BatchAugment
+from utils.loader_benchmark import autotune_loader, write_dataloader_params
+from models import AffordanceNet_Resnet18, VanillaVAE, VAEGAN, LatentCtrl, EndToEnd
+
+# Path settings
+curr_dir    = os.path.dirname(os.path.abspath(__file__))
+train_config_dir  = os.path.join(curr_dir, 'configs')
+human_dataset_dir = '/media/lab/NEPTUNE2/field_datasets/human_data' # as in train_endToend.py
+
+MODEL_TYPES = ['affordance', 'vanilla_vae', 'vae_gan', 'latent_ctrl', 'end_to_end']
+
+
+def get_dataset(model_type, model_config, train_config, dataset_dir=None):
+    '''
+    Dataset of a model built as in its training script
+    '''
+    model_params = model_config['model_params']
+    if model_type == 'affordance':
+        from train_affordance_field_multi_img import AffordanceDataset
+        image_resize = train_config['affordance_params']['image_resize']
+        return AffordanceDataset(dataset_dir or train_config['path_params']['dataset_dir'],
+                    resize=[image_resize[0], image_resize[1]],
+                    affordance_dim=model_params['output_dim'],
+                    transform=ToUInt8Tensor(),
+                    random_flip=False)
+
+    if model_type in ['vanilla_vae', 'vae_gan']:
+        if model_type == 'vanilla_vae':
+            from train_vae_field import VAEDataset, transform_composed
+        else:
+            from train_vaegan_field import VAEDataset, transform_composed
+        if dataset_dir is None:
+            dataset_dir = [train_config['path_params']['dataset_dir']]
+            if train_config['path_params']['extra_dataset_dir'] != 'None':
+                dataset_dir.append(train_config['path_params']['extra_dataset_dir'])
+        else:
+            dataset_dir = [dataset_dir]
+        return VAEDataset(dataset_dir,
+                    resize=[model_params['input_dim'], model_params['input_dim']],
+                    transform=transform_composed)
+
+    if model_type == 'latent_ctrl':
+        from train_latentCtrl_dagger import LatentCtrlDataset as ControlDataset
+        input_dim = read_yaml(os.path.join(train_config_dir, 'vanilla_vae.yaml'))['model_params']['input_dim']
+    else:
+        from train_endToend import EndToEndDataset as ControlDataset
+        input_dim = model_params['input_dim']
+    return ControlDataset(dataset_dir or human_dataset_dir,
+                iteration=train_config['dataset_params']['iteration'],
+                resize=[input_dim, input_dim],
+                transform=ToUInt8Tensor(return_flip=True),
+                enable_extra=model_params['enable_extra'])
+
+def get_train_step(model_type, model_config, device):
+    '''
+    step_fn(batch_data) moving the batch to the device and running a forward/backward pass
+    '''
+    model_params = model_config['model_params']
+    vae_model = None
+    if model_type == 'affordance':
+        model = AffordanceNet_Resnet18(**model_params)
+    elif model_type == 'vanilla_vae':
+        model = VanillaVAE(**model_params)
+    elif model_type == 'vae_gan':
+        model = VAEGAN(**model_params)
+    elif model_type == 'end_to_end':
+        model = EndToEnd(**model_params)
+    else:
+        vae_model = VanillaVAE(**read_yaml(os.path.join(train_config_dir, 'vanilla_vae.yaml'))['model_params'])
+        vae_model.to(device).eval()
+        model_params = dict(model_params, z_dim=vae_model.get_latent_dim())
+        model = LatentCtrl(**model_params)
+    model.to(device).train()
+    prepare_batch = BatchAugment()
+
+    def forward(batch_data):
+        x_extra = batch_data.get('state_extra') if model_params.get('enable_extra') else None
+        if model_type == 'latent_ctrl':
+            with torch.no_grad(): # frozen VAE
+                z = vae_model.get_latent(batch_data['image'], with_logvar=True)
+            return model(z, x_extra)
+        if model_type == 'end_to_end':
+            return model(batch_data['image'], x_extra)
+        return model(batch_data['image'])
+
+    def step_fn(batch_data):
+        batch_data = prepare_batch(batch_data, device, augment=False)
+        output = forward(batch_data)
+        outputs = output if isinstance(output, (list, tuple)) else [output]
+        loss = sum(y.float().mean() for y in outputs if torch.is_tensor(y) and y.requires_grad)
+        model.zero_grad(set_to_none=True)
+        loss.backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    return step_fn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark and tune the DataLoader settings of a model')
+    parser.add_argument('model_type', choices=MODEL_TYPES, help='model YAML configuration in configs/')
+    parser.add_argument('--dataset-dir', default=None, help='dataset folder, as in the training script if not set')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=None, help='batch sizes, the configured one if not set')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8], help='num_workers to try')
+    parser.add_argument('--prefetch', type=int, nargs='+', default=[2, 4], help='prefetch_factor to try')
+    parser.add_argument('--pin', type=int, nargs='+', default=[0, 1], help='pin_memory to try (0/1)')
+    parser.add_argument('--num-batches', type=int, default=50, help='measured batches per setting')
+    parser.add_argument('--warmup', type=int, default=5, help='batches before measuring')
+    parser.add_argument('--no-model', action='store_true', help='only move the batches to the device')
+    parser.add_argument('--write', action='store_true', help='write the best settings into the YAML configuration')
+    parser.add_argument('--tune-batch-size', action='store_true', help='also write the batch size with the highest samples/s')
+    args = parser.parse_args()
+
+    train_config = read_yaml(os.path.join(train_config_dir, 'train_config_field.yaml'))
+    model_config_path = os.path.join(train_config_dir, args.model_type + '.yaml')
+    model_config = read_yaml(model_config_path)
+    device = torch.device(train_config['train_params']['device'])
+    batch_sizes = args.batch_sizes or [model_config['train_params']['batch_size']]
+
+    dataset = get_dataset(args.model_type, model_config, train_config, args.dataset_dir)
+    print('Total length of data: ', str(len(dataset)))
+
+    if args.no_model:
+        prepare_batch = BatchAugment()
+        def step_fn(batch_data):
+            prepare_batch(batch_data, device, augment=False)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+    else:
+        step_fn = get_train_step(args.model_type, model_config, device)
+
+    best, results = autotune_loader(dataset,
+                                    batch_sizes,
+                                    num_workers=args.workers,
+                                    prefetch_factors=args.prefetch,
+                                    pin_memory=[bool(pin) for pin in args.pin],
+                                    num_batches=args.num_batches,
+                                    warmup=args.warmup,
+                                    step_fn=step_fn)
+
+    # batch size with the highest samples/s of its best settings
+    speed = {(size, str(params)): result['samples_per_sec'] for size, params, result in results}
+    best_batch_size = max(batch_sizes, key=lambda size: speed[(size, str(best[size]))])
+    for batch_size in batch_sizes:
+        print('Best settings for batch_size {:d}: {}'.format(batch_size, best[batch_size]))
+
+    if args.write:
+        if args.tune_batch_size:
+            batch_size = best_batch_size
+            write_dataloader_params(model_config_path, best[batch_size], batch_size=batch_size)
+        else:
+            batch_size = model_config['train_params']['batch_size']
+            if batch_size not in best:
+                raise ValueError("batch_size {:d} of {:s} was not benchmarked, use --tune-batch-size".format(batch_size, model_config_path))
+            write_dataloader_params(model_config_path, best[batch_size])
+        print('Saved the settings of batch_size {:d} to {:s}'.format(batch_size, model_config_path))
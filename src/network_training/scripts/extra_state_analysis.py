@@ -9,11 +9,11 @@ import pandas
 import matplotlib.pyplot as plt
 
 from controller.vae_latent_control import VAELatentController_Full, VAELatentController, VAELatentController_TRT
+from utils.train_utils import get_color_file_list
 
 def read_data(folder_path, image_only=False):
     # image file
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     results = {'color_file_list': color_file_list}
 
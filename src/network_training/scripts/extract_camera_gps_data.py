@@ -7,15 +7,19 @@ import shutil
 import numpy as np
 import pandas
 import pickle
-import cv2
-from cv_bridge import CvBridge
 
-from tqdm import tqdm
-
-import rosbag
 from utils import rosbag_utils
+from utils.batch_utils import batch_extract, list_bag_files
+from utils.bag_catalog import BagCatalog
+from utils.image_utils import extract_images
+from utils.shard_utils import write_shard, write_shard_manifest
 from utils.navigation_utils import *
 
+# the color images are read without their payload (loaded for the synced rows only),
+# which needs the pure-Python BagReader, so it is used even if rosbag is installed
+LAZY_TOPICS = ["/d435i/color/image_raw/compressed"]
+BAG_READER = 'python'
+
 
 class ExtractData():
     def __init__(self, 
@@ -23,36 +27,52 @@ class ExtractData():
         output_folder,
         bag_folder_name,
         field_data,
+        image_format='png',
+        num_read_workers=1,
+        shard_resize=None,
+        max_skew=None,
     ):
         # output config
+        self.bag_path = bag_path
         self.output_folder = output_folder
         self.bag_folder_name = bag_folder_name
+        self.image_format = image_format # 'jpg' writes the original JPEG bytes
+        self.num_read_workers = num_read_workers # >1 decodes the chunks of the bag in parallel
+        self.shard_resize = shard_resize # [width, height] writes a packed training shard instead
+        self.max_skew = max_skew # drop samples without a match within max_skew seconds in all topics
 
         # field data
         self.field_data = field_data
         self.utm_T_local = field_data['utm_T_local']
+        self.row_index = RowIndex(field_data['row_data'])
+        self.row_index_actual = RowIndex(field_data['row_data'], 'vertice_actual')
 
-        if not os.path.isdir(output_folder):
-            os.makedirs(output_folder)
+        os.makedirs(output_folder, exist_ok=True) # may run in parallel
 
         print(bag_path)
-        bag = rosbag.Bag(bag_path, "r")
-        self.extract_data_from_bag(bag)
+        with rosbag_utils.open_bag(bag_path, BAG_READER) as bag:
+            self.extract_data_from_bag(bag)
 
     def extract_data_from_bag(self, bag):
         ## read topics
-        color_image = rosbag_utils.get_topic_from_bag(bag, "/d435i/color/image_raw/compressed", False)
-        # depth_image = rosbag_utils.get_topic_from_bag(bag, "/d435i/aligned_depth_to_color/image_raw/compressed", False)
-        compass_hdg = rosbag_utils.get_topic_from_bag(bag, "/mavros/global_position/compass_hdg", False)
-        px4_global_position = rosbag_utils.get_topic_from_bag(bag, "/mavros/global_position/global", False)
-        piksi_global_position = rosbag_utils.get_topic_from_bag(bag, "/piksi/navsatfix_best_fix", False)
+        topic_msgs = rosbag_utils.read_topics(bag, [
+            "/d435i/color/image_raw/compressed",
+            # "/d435i/aligned_depth_to_color/image_raw/compressed",
+            "/mavros/global_position/compass_hdg",
+            "/mavros/global_position/global",
+            "/piksi/navsatfix_best_fix",
+        ], False, num_workers=self.num_read_workers, lazy_topics=LAZY_TOPICS)
+        color_image = topic_msgs["/d435i/color/image_raw/compressed"]
+        compass_hdg = topic_msgs["/mavros/global_position/compass_hdg"]
+        px4_global_position = topic_msgs["/mavros/global_position/global"]
+        piksi_global_position = topic_msgs["/piksi/navsatfix_best_fix"]
 
         ros_time, sync_topics = rosbag_utils.timesync_topics([
             color_image,
             piksi_global_position,
             compass_hdg,
             px4_global_position
-        ], printout=False)
+        ], printout=False, max_skew=self.max_skew)
     
         color_image_sync = sync_topics[0]
         piksi_global_position_sync = sync_topics[1]
@@ -60,128 +80,59 @@ class ExtractData():
         px4_global_position_sync = sync_topics[3]
 
         # heading
-        compass_heading = np.radians(compass_hdg_sync['data'])
+        compass_heading = np.radians(compass_hdg_sync['data'].to_numpy())
 
         # local position
-        local_pos_x = []
-        local_pos_y = []
-        for i in range(len(piksi_global_position_sync)):
-            pos_xy = get_local_xy_from_latlon(
-                piksi_global_position_sync['latitude'].iloc[i],
-                piksi_global_position_sync['longitude'].iloc[i],
-                # px4_global_position_sync['latitude'].iloc[i],
-                # px4_global_position_sync['longitude'].iloc[i],
-                self.utm_T_local,
-            )
-            local_pos_x.append(pos_xy[0])
-            local_pos_y.append(pos_xy[1])
-
-        local_pos_x = np.array(local_pos_x)
-        local_pos_y = np.array(local_pos_y)
-
-        results = {
-            'time': piksi_global_position_sync['ros_time'],
-            # 'time': px4_global_position_sync['ros_time'],
-            'compass_heading': compass_heading,
-            'local_pos_x': local_pos_x,
-            'local_pos_y': local_pos_y,
-        }
-        results = pandas.DataFrame(results)
+        local_pos = get_local_xy_from_latlon_batch(
+            piksi_global_position_sync['latitude'].to_numpy(),
+            piksi_global_position_sync['longitude'].to_numpy(),
+            # px4_global_position_sync['latitude'].to_numpy(),
+            # px4_global_position_sync['longitude'].to_numpy(),
+            self.utm_T_local,
+        )
+        local_pos_x = local_pos[:,0]
+        local_pos_y = local_pos[:,1]
 
         ## bitmask1: check in polygon
-        all_index = []
-        for x, y in zip(local_pos_x, local_pos_y):
-            current_pose = [x, y]
-
-            index = find_area_index(current_pose, self.field_data['row_data'])
-            if index is not None:
-                all_index.append(index)
-
-            if len(all_index) > 10:
-                break
+        all_index = self.row_index.find_batch(local_pos_x, local_pos_y)
+        all_index = all_index[all_index >= 0][:11]
+        if len(all_index) == 0:
+            raise ValueError("No data inside the field rows")
 
-        row_index = int(np.array(all_index).mean())
+        row_index = int(all_index.mean())
         print("Flying in row %d" % row_index)
+        current_row_data = self.field_data['row_data'][row_index]
 
-        current_polygon = Polygon([vertex for vertex in self.field_data['row_data'][row_index]['vertice_actual']])
-        bitmask1 = []
-        for x, y in zip(local_pos_x, local_pos_y):
-            current_pose = [x, y]
-            bitmask1.append(whether_in_polygon(current_pose, current_polygon))
+        bitmask1 = self.row_index_actual.contains_batch(local_pos_x, local_pos_y, row_index)
 
         ## bitmask2: check heading
-        if local_pos_x[0] > self.field_data['row_data'][row_index]['treelines_actual'][0][1][0]:
-            direction = -1 # from east to west
-            compass_heading_range = [np.pi, 2*np.pi]
-        else:
-            direction = 1 # from west to east
-            compass_heading_range = [0, np.pi]
+        direction = get_row_direction(local_pos_x[0], current_row_data)
         print("Flying direction: %d" % direction)
 
-        bitmask2 = []
-        for i in range(len(compass_heading)):
-            res = (compass_heading_range[0] <= compass_heading.iloc[i] <= compass_heading_range[1])
-            bitmask2.append(res)
+        compass_heading_range = get_compass_heading_range(direction)
+        bitmask2 = (compass_heading >= compass_heading_range[0]) & (compass_heading <= compass_heading_range[1])
 
         ## Apply bitmasks
-        filtered_results = pandas.DataFrame()
-        for i in range(len(results)):
-            if bitmask1[i] and bitmask2[i]:
-                res = {}
-                res['time'] = results['time'].iloc[i]
-                res['heading'] = wrap_2pi(results['compass_heading'].iloc[i] - np.pi/2)
-                res['pos_x'] = results['local_pos_x'].iloc[i]
-                res['pos_y'] = results['local_pos_y'].iloc[i]
-                res['index'] = i
-                filtered_results = filtered_results.append(res, ignore_index=True)
-
-        print("{:.2%} of valid data".format(float(len(filtered_results)) / len(results)))
-
-        ## read images
-        bridge = CvBridge()
-
-        color_image_list = []
-        # depth_image_list = []
-        for i in range(len(filtered_results)):
-            # rgb
-            idx = int(filtered_results['index'].iloc[i])
-            np_arr = np.frombuffer(color_image_sync['data'].iloc[idx], np.uint8)
-            image_np = cv2.imdecode(np_arr, cv2.IMREAD_COLOR) # RGB
-            color_image_list.append(image_np)
-
-            # depth
-            # np_arr = np.frombuffer(depth_image_sync['data'].iloc[idx], np.uint8)
-            # image_np = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-            # depth_image_list.append(image_np)
-
-        print("%d images extracted" % len(color_image_list))
+        valid_index = np.flatnonzero(bitmask1 & bitmask2)
+        filtered_results = pandas.DataFrame({
+            'time': piksi_global_position_sync['ros_time'].to_numpy()[valid_index],
+            # 'time': px4_global_position_sync['ros_time'].to_numpy()[valid_index],
+            'heading': wrap_2pi_array(compass_heading[valid_index] - np.pi/2),
+            'pos_x': local_pos_x[valid_index],
+            'pos_y': local_pos_y[valid_index],
+            'index': valid_index,
+        })
+
+        print("{:.2%} of valid data".format(float(len(filtered_results)) / len(local_pos_x)))
 
         ### calculate affordance
-        current_row_data = self.field_data['row_data'][row_index]
-        reference_heading = np.arctan2(
-            current_row_data['centerline_actual'][1][1] - current_row_data['centerline_actual'][0][1],
-            current_row_data['centerline_actual'][1][0] - current_row_data['centerline_actual'][0][0],
+        dist_center, rel_angle = label_affordance(
+            filtered_results['pos_x'],
+            filtered_results['pos_y'],
+            filtered_results['heading'],
+            current_row_data,
+            direction,
         )
-        if direction < 0:
-            reference_line = np.flip(current_row_data['centerline_actual'], axis=0)
-            reference_heading += np.pi
-        else:
-            reference_line = current_row_data['centerline_actual']
-        reference_heading = wrap_2pi(reference_heading)
-
-        rel_angle = []
-        dist_center = []
-        for i in range(len(filtered_results)):
-            point = [
-                filtered_results['pos_x'].iloc[i],
-                filtered_results['pos_y'].iloc[i],
-            ]
-            heading = filtered_results['heading'].iloc[i]
-            lat_proj, lon_proj = get_projection_point2line(point, reference_line)
-
-            rel_angle.append(wrap_pi(heading - reference_heading))
-            dist_center.append(lat_proj)
-
         filtered_results['dist_center'] = dist_center
         filtered_results['rel_angle'] = rel_angle
 
@@ -189,10 +140,22 @@ class ExtractData():
         row_folder_name = 'row_' + str(row_index)
         row_folder = os.path.join(self.output_folder, row_folder_name)
 
-        if not os.path.isdir(row_folder):
-            os.mkdir(row_folder)
+        os.makedirs(row_folder, exist_ok=True)
 
         output_data_folder = os.path.join(row_folder, self.bag_folder_name)
+        color_image_payloads = rosbag_utils.iter_payloads(bag, color_image_sync.iloc[filtered_results['index'].to_numpy()])
+
+        if self.shard_resize is not None:
+            num_images = write_shard(
+                output_data_folder,
+                color_image_payloads,
+                filtered_results[['time', 'pos_x', 'pos_y', 'heading', 'dist_center', 'rel_angle']],
+                self.shard_resize,
+                info={'bag': os.path.abspath(self.bag_path), 'row_index': row_index},
+            )
+            print("%d images packed" % num_images)
+            return
+
         if os.path.isdir(output_data_folder):
             shutil.rmtree(output_data_folder)
 
@@ -205,11 +168,56 @@ class ExtractData():
             index=False,
         )
 
-        for i in range(len(color_image_list)): 
-            cv2.imwrite(os.path.join(output_data_folder, "color/%07i.png" % i), color_image_list[i])
+        ## read and save images
+        num_images = extract_images(
+            color_image_payloads,
+            os.path.join(output_data_folder, 'color'),
+            self.image_format,
+        )
+        print("%d images extracted" % num_images)
+
+
+def relabel_pose_data(output_folder, field_data):
+    """
+    Recalculate dist_center and rel_angle of the extracted pose.csv files,
+    e.g., after the field map is updated
+    """
+    for row_folder_name in sorted(os.listdir(output_folder)):
+        if not row_folder_name.startswith('row_'):
+            continue
+        row_folder = os.path.join(output_folder, row_folder_name)
+        current_row_data = field_data['row_data'][int(row_folder_name[4:])]
+
+        for bag_folder_name in sorted(os.listdir(row_folder)):
+            pose_path = os.path.join(row_folder, bag_folder_name, 'pose.csv')
+            if not os.path.isfile(pose_path):
+                continue
+            pose_data = pandas.read_csv(pose_path)
+            if len(pose_data) == 0:
+                continue
+
+            direction = get_direction_from_heading(pose_data['heading'].iloc[0])
+            dist_center, rel_angle = label_affordance(
+                pose_data['pos_x'],
+                pose_data['pos_y'],
+                pose_data['heading'],
+                current_row_data,
+                direction,
+            )
+            pose_data['dist_center'] = dist_center
+            pose_data['rel_angle'] = rel_angle
+            pose_data.to_csv(pose_path, index=False)
+            print("Relabeled %s" % pose_path)
 
 
 if __name__ == "__main__":
+    NUM_WORKER = 4
+    RELABEL = False # only recalculate the labels of the extracted data
+    IMAGE_FORMAT = 'png' # 'jpg' writes the original JPEG bytes, skipping decoding and PNG re-encoding
+    NUM_READ_WORKER = 1 # >1 also splits each bag across processes, for a few very large bags
+    MAX_SKEW = None # e.g., 0.5 drops the samples without a match within 0.5 s (changes the dataset)
+    CATALOG_PATH = None # bag_catalog.db built by utils.bag_catalog, to select bags without opening them
+    SHARD_RESIZE = None # e.g., [256, 256] packs resized frames and labels into one shard per bag
     root_folder_path = '/media/lab/NEPTUNE2/field_raw_datasets/2022-11-15'
     output_folder = '/media/lab/NEPTUNE2/field_datasets'
 
@@ -221,12 +229,30 @@ if __name__ == "__main__":
     with open(ground_truth_path, 'rb') as file:
         field_data = pickle.load(file)
 
-    for file in tqdm(os.listdir(root_folder_path)):
-        bag_folder_name = file[11:-4]
-        bag_path = os.path.join(root_folder_path, file)
-        ExtractData(
-            bag_path,
-            output_folder,
-            bag_folder_name,
-            field_data,
-        )
\ No newline at end of file
+    if RELABEL:
+        relabel_pose_data(output_folder, field_data)
+    else:
+        if CATALOG_PATH is not None:
+            with BagCatalog(CATALOG_PATH) as catalog:
+                bag_paths = catalog.select_bags(folder=root_folder_path, topics=[
+                    "/d435i/color/image_raw/compressed",
+                    "/mavros/global_position/compass_hdg",
+                    "/piksi/navsatfix_best_fix",
+                ])
+        else:
+            bag_paths = [os.path.join(root_folder_path, file) for file in list_bag_files(root_folder_path)]
+
+        bag_jobs = []
+        for bag_path in bag_paths:
+            bag_folder_name = os.path.basename(bag_path)[11:-4]
+            bag_jobs.append((bag_path, (output_folder, bag_folder_name, field_data, IMAGE_FORMAT, NUM_READ_WORKER, SHARD_RESIZE, MAX_SKEW)))
+
+        # extract in parallel, completed bags in the manifest are skipped
+        batch_extract(
+            ExtractData,
+            bag_jobs,
+            os.path.join(output_folder, 'extraction_manifest.json'),
+            num_workers=NUM_WORKER,
+        )
+        if SHARD_RESIZE is not None:
+            write_shard_manifest(output_folder)
\ No newline at end of file
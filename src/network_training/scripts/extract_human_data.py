@@ -7,15 +7,19 @@ import shutil
 import numpy as np
 import pickle
 import pandas
-import cv2
-from cv_bridge import CvBridge
 
-from tqdm import tqdm
-
-import rosbag
 from utils import rosbag_utils
+from utils.batch_utils import batch_extract, list_bag_files
+from utils.bag_catalog import BagCatalog
+from utils.image_utils import extract_images
+from utils.shard_utils import write_shard, write_shard_manifest
 from utils.navigation_utils import *
-from utils.math_utils import euler_from_quaternion
+from utils.math_utils import euler_from_quaternion_array
+
+# the color images are read without their payload (loaded for the synced rows only),
+# which needs the pure-Python BagReader, so it is used even if rosbag is installed
+LAZY_TOPICS = ["/d435i/color/image_raw/compressed"]
+BAG_READER = 'python'
 
 
 class ExtractHumanData():
@@ -24,39 +28,71 @@ class ExtractHumanData():
         output_folder,
         bag_folder_name,
         field_data,
+        image_format='png',
+        num_read_workers=1,
+        shard_resize=None,
+        max_skew=None,
     ):
         # output config
+        self.bag_path = bag_path
         self.output_folder = output_folder
         self.bag_folder_name = bag_folder_name
+        self.image_format = image_format # 'jpg' writes the original JPEG bytes
+        self.num_read_workers = num_read_workers # >1 decodes the chunks of the bag in parallel
+        self.shard_resize = shard_resize # [width, height] writes a packed training shard instead
+        self.max_skew = max_skew # drop samples without a match within max_skew seconds in all topics
 
         # field data
         self.field_data = field_data
         self.utm_T_local = field_data['utm_T_local']
 
-        if not os.path.isdir(output_folder):
-            os.makedirs(output_folder)
+        os.makedirs(output_folder, exist_ok=True) # may run in parallel
 
         print(bag_path)
-        bag = rosbag.Bag(bag_path, "r")
-        self.extract_data_from_bag(bag)
+        with rosbag_utils.open_bag(bag_path, BAG_READER) as bag:
+            self.extract_data_from_bag(bag)
 
     def extract_data_from_bag(self, bag):
         ## read topics
-        color_image = rosbag_utils.get_topic_from_bag(bag, "/d435i/color/image_raw/compressed", False)
-        local_position = rosbag_utils.get_topic_from_bag(bag, "/mavros/local_position/pose", False)
-        velocity_body = rosbag_utils.get_topic_from_bag(bag, "/mavros/local_position/velocity_body", False)
-        rc_in = rosbag_utils.get_topic_from_bag(bag, "/mavros/rc/in", False)
-        setpoint_raw = rosbag_utils.get_topic_from_bag(bag, "/mavros/setpoint_raw/local", False)
-        my_pid = rosbag_utils.get_topic_from_bag(bag, "/my_controller/pos_z_pid", False)
+        available_topics = bag.get_type_and_topic_info()[1].keys()
+        has_gps_topic = "/mavros/global_position/global" in available_topics
+        has_yaw_cmd_topic = "/my_controller/yaw_cmd" in available_topics
+
+        topics_to_read = [
+            "/d435i/color/image_raw/compressed",
+            "/mavros/local_position/pose",
+            "/mavros/local_position/velocity_body",
+            "/mavros/rc/in",
+            "/mavros/setpoint_raw/local",
+            "/my_controller/pos_z_pid",
+        ]
+        if has_gps_topic:
+            topics_to_read += [
+                "/mavros/global_position/global",
+                "/mavros/global_position/compass_hdg",
+                "/mavros/home_position/home",
+            ]
+        if has_yaw_cmd_topic:
+            topics_to_read.append("/my_controller/yaw_cmd")
+
+        topic_msgs = rosbag_utils.read_topics(bag, topics_to_read, False, num_workers=self.num_read_workers,
+                                              lazy_topics=LAZY_TOPICS)
+        topic_msgs = {topic: rosbag_utils.as_topic_data(msgs) for topic, msgs in topic_msgs.items()}
+        color_image = topic_msgs["/d435i/color/image_raw/compressed"]
+        local_position = topic_msgs["/mavros/local_position/pose"]
+        velocity_body = topic_msgs["/mavros/local_position/velocity_body"]
+        rc_in = topic_msgs["/mavros/rc/in"]
+        setpoint_raw = topic_msgs["/mavros/setpoint_raw/local"]
+        my_pid = topic_msgs["/my_controller/pos_z_pid"]
 
         # compensate camera timestamp delay
-        color_image = rosbag_utils.add_timestamp_offset(color_image, time_offset=0.1)
+        color_image = color_image.shift(0.1)
 
         # crop data
         start_offset = 1.0
         stop_offset = 3.0
-        offboard_start_time = my_pid['ros_time'].iloc[0] + start_offset
-        offboard_stop_time = my_pid['ros_time'].iloc[-1] - stop_offset
+        offboard_start_time = my_pid['ros_time'][0] + start_offset
+        offboard_stop_time = my_pid['ros_time'][-1] - stop_offset
 
         color_image_crop = rosbag_utils.crop_data_with_start_end_time(color_image, offboard_start_time, offboard_stop_time)
         local_position_crop = rosbag_utils.crop_data_with_start_end_time(local_position, offboard_start_time, offboard_stop_time)
@@ -65,13 +101,12 @@ class ExtractHumanData():
         setpoint_raw_crop = rosbag_utils.crop_data_with_start_end_time(setpoint_raw, offboard_start_time, offboard_stop_time)
 
         # if has gps topic
-        has_gps_topic = "/mavros/global_position/global" in bag.get_type_and_topic_info()[1].keys()
         if has_gps_topic:
-            global_position = rosbag_utils.get_topic_from_bag(bag, "/mavros/global_position/global", False)
-            compass_hdg = rosbag_utils.get_topic_from_bag(bag, "/mavros/global_position/compass_hdg", False)
-            home_position = rosbag_utils.get_topic_from_bag(bag, "/mavros/home_position/home", False)
+            global_position = topic_msgs["/mavros/global_position/global"]
+            compass_hdg = topic_msgs["/mavros/global_position/compass_hdg"]
+            home_position = topic_msgs["/mavros/home_position/home"]
             # get home position
-            home_pos_z = home_position['position'].iloc[0].z
+            home_pos_z = home_position['position.z'][0]
             # crop data
             global_position_crop = rosbag_utils.crop_data_with_start_end_time(global_position, offboard_start_time, offboard_stop_time)
             compass_hdg_crop = rosbag_utils.crop_data_with_start_end_time(compass_hdg, offboard_start_time, offboard_stop_time)
@@ -79,9 +114,8 @@ class ExtractHumanData():
             home_pos_z = 0.1
 
         # if has yaw_cmd topic
-        has_yaw_cmd_topic = "/my_controller/yaw_cmd" in bag.get_type_and_topic_info()[1].keys()
         if has_yaw_cmd_topic:   
-            my_yaw_cmd = rosbag_utils.get_topic_from_bag(bag, "/my_controller/yaw_cmd", False)
+            my_yaw_cmd = topic_msgs["/my_controller/yaw_cmd"]
             my_yaw_cmd_crop = rosbag_utils.crop_data_with_start_end_time(my_yaw_cmd, offboard_start_time, offboard_stop_time)
 
         # sync data
@@ -97,9 +131,11 @@ class ExtractHumanData():
             topics_to_synced.append(compass_hdg_crop)
         if has_yaw_cmd_topic:
             topics_to_synced.append(my_yaw_cmd_crop)
+        if any(topic is None for topic in topics_to_synced):
+            raise ValueError("No data in the offboard window [%.2f, %.2f]" % (offboard_start_time, offboard_stop_time))
 
         ros_time, sync_topics = rosbag_utils.timesync_topics(
-            topics_to_synced, printout=False)
+            topics_to_synced, printout=False, max_skew=self.max_skew)
 
         color_image_sync = sync_topics[0]
         setpoint_raw_sync = sync_topics[1]
@@ -122,19 +158,13 @@ class ExtractHumanData():
             heading = np.array(heading)
 
             # local position utm
-            utm_local_pos_x = []
-            utm_local_pos_y = []
-            for i in range(len(global_position_sync)):
-                pos_xy = get_local_xy_from_latlon(
-                    global_position_sync['latitude'].iloc[i],
-                    global_position_sync['longitude'].iloc[i],
-                    self.utm_T_local,
-                )
-                utm_local_pos_x.append(pos_xy[0])
-                utm_local_pos_y.append(pos_xy[1])
-
-            utm_local_pos_x = np.array(utm_local_pos_x)
-            utm_local_pos_y = np.array(utm_local_pos_y)
+            utm_local_pos = get_local_xy_from_latlon_batch(
+                global_position_sync['latitude'].to_numpy(),
+                global_position_sync['longitude'].to_numpy(),
+                self.utm_T_local,
+            )
+            utm_local_pos_x = utm_local_pos[:,0]
+            utm_local_pos_y = utm_local_pos[:,1]
         
         else:
             N = len(local_position_sync)
@@ -143,47 +173,24 @@ class ExtractHumanData():
             utm_local_pos_y = np.array([0.0] * N)
 
         # local position odom
-        odom_local_pos_x = []
-        odom_local_pos_y = []
-        odom_local_pos_z = []
-        roll_angle = []
-        pitch_angle = []
-        yaw_angle = []
-        for pose_msg in local_position_sync['pose']:
-            odom_local_pos_x.append(pose_msg.position.x)
-            odom_local_pos_y.append(pose_msg.position.y)
-            odom_local_pos_z.append(pose_msg.position.z)
-            roll, pitch, yaw = euler_from_quaternion(pose_msg.orientation)
-            roll_angle.append(roll)
-            pitch_angle.append(pitch)
-            yaw_angle.append(yaw)
-
-        odom_local_pos_x = np.array(odom_local_pos_x)
-        odom_local_pos_y = np.array(odom_local_pos_y)
-        odom_local_pos_z = np.array(odom_local_pos_z)
-        odom_rel_height = np.array(odom_local_pos_z) - home_pos_z
-        roll_angle = np.array(roll_angle)
-        pitch_angle = np.array(pitch_angle)
-        yaw_angle = np.array(yaw_angle)
+        odom_local_pos_x = local_position_sync['pose.position.x'].to_numpy()
+        odom_local_pos_y = local_position_sync['pose.position.y'].to_numpy()
+        odom_local_pos_z = local_position_sync['pose.position.z'].to_numpy()
+        odom_rel_height = odom_local_pos_z - home_pos_z
+        roll_angle, pitch_angle, yaw_angle = euler_from_quaternion_array(
+            local_position_sync['pose.orientation.x'].to_numpy(),
+            local_position_sync['pose.orientation.y'].to_numpy(),
+            local_position_sync['pose.orientation.z'].to_numpy(),
+            local_position_sync['pose.orientation.w'].to_numpy(),
+        )
 
         # velocity body
-        linear_x, linear_y, linear_z = [], [], []
-        angular_x, angular_y, angular_z = [], [], []
-
-        for twist_msg in velocity_body_sync['twist']:
-            linear_x.append(twist_msg.linear.x)
-            linear_y.append(twist_msg.linear.y)
-            linear_z.append(twist_msg.linear.z)
-            angular_x.append(twist_msg.angular.x)
-            angular_y.append(twist_msg.angular.y)
-            angular_z.append(twist_msg.angular.z)
-
-        linear_x = np.array(linear_x)
-        linear_y = np.array(linear_y)  
-        linear_z = np.array(linear_z)
-        angular_x = np.array(angular_x)            
-        angular_y = np.array(angular_y)          
-        angular_z = np.array(angular_z)
+        linear_x = velocity_body_sync['twist.linear.x'].to_numpy()
+        linear_y = velocity_body_sync['twist.linear.y'].to_numpy()
+        linear_z = velocity_body_sync['twist.linear.z'].to_numpy()
+        angular_x = velocity_body_sync['twist.angular.x'].to_numpy()
+        angular_y = velocity_body_sync['twist.angular.y'].to_numpy()
+        angular_z = velocity_body_sync['twist.angular.z'].to_numpy()
 
         # human input
         control_cmd = setpoint_raw_sync['yaw_rate'].to_numpy()
@@ -196,18 +203,6 @@ class ExtractHumanData():
         else:
             ai_mode = np.array([False] * len(control_cmd))
 
-        ## read images
-        bridge = CvBridge()
-
-        color_image_list = []
-        for i in range(len(color_image_sync)):
-            # rgb
-            np_arr = np.frombuffer(color_image_sync['data'].iloc[i], np.uint8)
-            image_np = cv2.imdecode(np_arr, cv2.IMREAD_COLOR) # RGB
-            color_image_list.append(image_np)
-
-        print("%d images extracted!" % len(color_image_list))
-        
         ## save data
         states = pandas.DataFrame()
         states['time'] = color_image_sync['ros_time'].to_numpy()
@@ -231,6 +226,19 @@ class ExtractHumanData():
         states['ai_mode'] = ai_mode
 
         output_data_folder = os.path.join(self.output_folder, self.bag_folder_name)
+        color_image_payloads = rosbag_utils.iter_payloads(bag, color_image_sync)
+
+        if self.shard_resize is not None:
+            num_images = write_shard(
+                output_data_folder,
+                color_image_payloads,
+                states,
+                self.shard_resize,
+                info={'bag': os.path.abspath(self.bag_path)},
+            )
+            print("%d images packed!" % num_images)
+            return
+
         if os.path.isdir(output_data_folder):
             shutil.rmtree(output_data_folder)
 
@@ -263,11 +271,22 @@ class ExtractHumanData():
             index=False,
         )
 
-        for i in range(len(color_image_list)): 
-            cv2.imwrite(os.path.join(output_data_folder, "color/%07i.png" % i), color_image_list[i])
+        ## read and save images
+        num_images = extract_images(
+            color_image_payloads,
+            os.path.join(output_data_folder, 'color'),
+            self.image_format,
+        )
+        print("%d images extracted!" % num_images)
 
 
 if __name__ == "__main__":
+    NUM_WORKER = 4
+    IMAGE_FORMAT = 'png' # 'jpg' writes the original JPEG bytes, skipping decoding and PNG re-encoding
+    NUM_READ_WORKER = 1 # >1 also splits each bag across processes, for a few very large bags
+    MAX_SKEW = None # e.g., 0.5 drops the samples without a match within 0.5 s (changes the dataset)
+    CATALOG_PATH = None # bag_catalog.db built by utils.bag_catalog, to select bags without opening them
+    SHARD_RESIZE = None # e.g., [128, 128] packs resized frames and states into one shard per bag
     root_folder_path = '/media/lab/NEPTUNE2/field_raw_datasets/2023-02-07_Dagger_eval2'
     output_folder = '/media/lab/NEPTUNE2/field_datasets/human_data/iter4'
 
@@ -279,12 +298,30 @@ if __name__ == "__main__":
     with open(ground_truth_path, 'rb') as file:
         field_data = pickle.load(file)
 
-    for file in tqdm(os.listdir(root_folder_path)):
-        bag_folder_name = file[4:-4]
-        bag_path = os.path.join(root_folder_path, file)
-        ExtractHumanData(
-            bag_path,
-            output_folder,
-            bag_folder_name,
-            field_data,
-        )
+    if CATALOG_PATH is not None:
+        with BagCatalog(CATALOG_PATH) as catalog:
+            bag_paths = catalog.select_bags(folder=root_folder_path, topics=[
+                "/d435i/color/image_raw/compressed",
+                "/mavros/local_position/pose",
+                "/mavros/local_position/velocity_body",
+                "/mavros/rc/in",
+                "/mavros/setpoint_raw/local",
+                "/my_controller/pos_z_pid",
+            ])
+    else:
+        bag_paths = [os.path.join(root_folder_path, file) for file in list_bag_files(root_folder_path)]
+
+    bag_jobs = []
+    for bag_path in bag_paths:
+        bag_folder_name = os.path.basename(bag_path)[4:-4]
+        bag_jobs.append((bag_path, (output_folder, bag_folder_name, field_data, IMAGE_FORMAT, NUM_READ_WORKER, SHARD_RESIZE, MAX_SKEW)))
+
+    # extract in parallel, completed bags in the manifest are skipped
+    batch_extract(
+        ExtractHumanData,
+        bag_jobs,
+        os.path.join(output_folder, 'extraction_manifest.json'),
+        num_workers=NUM_WORKER,
+    )
+    if SHARD_RESIZE is not None:
+        write_shard_manifest(output_folder)
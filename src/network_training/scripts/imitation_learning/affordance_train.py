@@ -43,13 +43,13 @@ class AffordanceTrain(BaseTrain):
             train_total_loss = 0.0
             for _, batch_data in enumerate(self.train_dataloader):
                 self.num_iter += 1
-                batch_image = batch_data['image'].to(self.device)
+                batch_data = self.prepare_batch(batch_data, augment=True)
+                batch_image = self.image_to_device(batch_data['image'])
                 batch_y = batch_data['affordance'].to(self.device)
-                batch_y_pred = self.model(batch_image)          
-                train_loss = self.model.loss_function(batch_y_pred, batch_y)
-                self.optimizer.zero_grad()
-                train_loss['total_loss'].backward()
-                self.optimizer.step()
+                with self.autocast():
+                    batch_y_pred = self.model(batch_image)
+                train_loss = self.model.loss_function(batch_y_pred.float(), batch_y)
+                self.optimize(train_loss['total_loss'])
 
                 train_total_loss += train_loss['total_loss'].item()
                 self.iteration.append(self.num_iter)
@@ -91,10 +91,12 @@ class AffordanceTrain(BaseTrain):
         self.model.eval()
         test_total_loss = 0.0
         for _, batch_data in enumerate(self.test_dataloader):
-            batch_image = batch_data['image'].to(self.device)
+            batch_data = self.prepare_batch(batch_data)
+            batch_image = self.image_to_device(batch_data['image'])
             batch_y = batch_data['affordance'].to(self.device)
-            batch_y_pred = self.model(batch_image)          
-            test_loss = self.model.loss_function(batch_y_pred, batch_y)
+            with self.autocast():
+                batch_y_pred = self.model(batch_image)
+            test_loss = self.model.loss_function(batch_y_pred.float(), batch_y)
             test_total_loss += test_loss['total_loss'].item()
         
         n_batch = len(self.test_dataloader)
@@ -8,7 +8,31 @@ from torch.optim.lr_scheduler import StepLR
 from torch.utils.tensorboard import SummaryWriter
 
 SAMPLE_SIZE = 64 # number of images in the sample
-NUM_WORKER  = 4 # number of workers in parallel
+NUM_WORKER  = 4 # number of workers in parallel, if not set in train_params['dataloader']
+
+
+def get_dataloader_kwargs(dataloader_params=None):
+    '''
+    DataLoader keyword arguments from the dataloader settings of train_params,
+    i.e., num_workers, pin_memory, persistent_workers and prefetch_factor
+    '''
+    params = {
+        'num_workers': NUM_WORKER,
+        'pin_memory': True,
+        'persistent_workers': False,
+        'prefetch_factor': None, # torch default
+    }
+    params.update(dataloader_params or {})
+
+    kwargs = {
+        'num_workers': params['num_workers'],
+        'pin_memory': params['pin_memory'],
+    }
+    if params['num_workers'] > 0:
+        kwargs['persistent_workers'] = params['persistent_workers']
+        if params['prefetch_factor'] is not None:
+            kwargs['prefetch_factor'] = params['prefetch_factor']
+    return kwargs
 
 
 def genereate_sample_folder(folder_path, dataloader, checkpoint_preload):
@@ -51,10 +75,20 @@ class BaseTrain():
         self.train_dataloader = None
         self.test_dataloader  = None
         self.validation_data  = None
+        self.batch_augment    = None
 
         # Training parameters
         self.max_epochs = train_params['n_epochs']
         self.batch_size = train_params['batch_size']
+        self.dataloader_kwargs = get_dataloader_kwargs(train_params.get('dataloader'))
+
+        # Mixed precision: autocast of the forward passes, channels-last convolutions
+        amp_params = train_params.get('mixed_precision') or {}
+        self.amp_enable    = amp_params.get('enable', False)
+        self.amp_dtype     = getattr(torch, amp_params.get('dtype', 'float16'))
+        self.channels_last = amp_params.get('channels_last', False)
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last)
        
         # Logging parameters
         self.last_epoch     = 0
@@ -78,6 +112,7 @@ class BaseTrain():
 
         # Filename, optimizer and loss history configure
         self.configure(train_params, log_params)
+        self.grad_scaler = self.get_grad_scaler()
 
         # Load a checkpoint
         self.checkpoint_filename    = os.path.join(self.log_folder, self.checkpoint_filename)
@@ -119,15 +154,50 @@ class BaseTrain():
         self.num_iter       = self.iteration[-1]
         if 'lr_scheduler' in checkpoint:
             self.last_lr_scheduler = checkpoint['lr_scheduler']
+        if 'grad_scaler_state_dict' in checkpoint:
+            self.load_grad_scaler(self.grad_scaler, checkpoint['grad_scaler_state_dict'])
+        return checkpoint
+
+    def get_grad_scaler(self):
+        """Loss scaling of float16 autocast, a pass-through otherwise (bfloat16 needs none)"""
+        enable = self.amp_enable and self.amp_dtype == torch.float16
+        if hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler(self.device.type, enabled=enable)
+        return torch.cuda.amp.GradScaler(enabled=enable and self.device.type == 'cuda') # torch < 2.3
+
+    @staticmethod
+    def load_grad_scaler(grad_scaler, state_dict):
+        # a disabled scaler saves an empty state
+        if grad_scaler.is_enabled() and state_dict:
+            grad_scaler.load_state_dict(state_dict)
+
+    def autocast(self):
+        """Context of the forward passes, in amp_dtype if mixed precision is enabled"""
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_enable)
+
+    def image_to_device(self, image):
+        image = image.to(self.device)
+        if self.channels_last:
+            image = image.contiguous(memory_format=torch.channels_last)
+        return image
+
+    def optimize(self, loss, optimizer=None, grad_scaler=None, retain_graph=False):
+        """zero_grad, backward and step of an optimizer (self.optimizer by default) with its grad scaler"""
+        optimizer = optimizer or self.optimizer
+        grad_scaler = grad_scaler or self.grad_scaler
+        optimizer.zero_grad()
+        grad_scaler.scale(loss).backward(retain_graph=retain_graph)
+        grad_scaler.step(optimizer)
+        grad_scaler.update()
   
-    def load_train_dataset(self, train_data, is_shuffle=True):
+    def load_train_dataset(self, train_data, is_shuffle=True, sampler=None):
         if train_data is not None:
             self.train_dataloader = DataLoader(train_data,
                                     batch_size=self.batch_size,
-                                    shuffle=is_shuffle,
-                                    num_workers=NUM_WORKER,
+                                    shuffle=is_shuffle if sampler is None else False,
+                                    sampler=sampler,
                                     drop_last=False,
-                                    pin_memory=True)
+                                    **self.dataloader_kwargs)
         else:
             raise Exception('No training data found!')
 
@@ -136,21 +206,30 @@ class BaseTrain():
             self.test_dataloader = DataLoader(test_data,
                                     batch_size=self.batch_size,
                                     shuffle=is_shuffle,
-                                    num_workers=NUM_WORKER,
-                                    drop_last=False)
+                                    drop_last=False,
+                                    **self.dataloader_kwargs)
             # Generate sample folder
             if self.generate_samples:
                 sample_dataloader = DataLoader(test_data,
                                     batch_size=SAMPLE_SIZE,
                                     shuffle=is_shuffle,
-                                    num_workers=NUM_WORKER,
+                                    num_workers=self.dataloader_kwargs['num_workers'],
                                     drop_last=True)
                 self.validation_data = genereate_sample_folder(self.sample_folder_path, sample_dataloader, self.checkpoint_preload)
         else:
             self.generate_samples = False
 
-    def load_dataset(self, train_data, test_data):
-        self.load_train_dataset(train_data)
+    def set_batch_augment(self, batch_augment):
+        """Augment the training batches on the device, e.g., with utils.augment_utils.BatchAugment"""
+        self.batch_augment = batch_augment
+
+    def prepare_batch(self, batch_data, augment=False):
+        if self.batch_augment is None:
+            return batch_data
+        return self.batch_augment(batch_data, self.device, augment)
+
+    def load_dataset(self, train_data, test_data, train_sampler=None):
+        self.load_train_dataset(train_data, sampler=train_sampler)
         self.load_test_dataset(test_data) 
 
     def save_model(self, file_path):
@@ -195,6 +274,7 @@ class BaseTrain():
             'iteration': self.iteration,
             'model_state_dict': self.model.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
+            'grad_scaler_state_dict': self.grad_scaler.state_dict(),
             'loss_history': self.loss_history,
             'tb_folder_name': self.tb_folder_name,
         }
@@ -20,6 +20,8 @@ class LatentCtrlTrain(BaseTrain):
         self.VAE_model = VAE_model.to(device)
         
         super().__init__(model, device, is_eval, train_params, log_params)
+        if self.channels_last:
+            self.VAE_model = self.VAE_model.to(memory_format=torch.channels_last)
 
     def configure(self, train_params, log_params):
         # z dimension check
@@ -52,19 +54,19 @@ class LatentCtrlTrain(BaseTrain):
             train_total_loss = 0
             for _, batch_data in enumerate(self.train_dataloader):
                 self.num_iter += 1
-                batch_image = batch_data['image'].to(self.device)
+                batch_data = self.prepare_batch(batch_data, augment=True)
+                batch_image = self.image_to_device(batch_data['image'])
                 batch_y = batch_data['action'].to(self.device)
                 if 'state_extra' in batch_data:
                     batch_extra = batch_data['state_extra'].to(self.device)
                 else:
                     batch_extra = None
                 
-                batch_z = self.VAE_model.get_latent(batch_image, with_logvar=True)
-                batch_y_pred = self.model(batch_z, batch_extra).view(-1)
-                train_loss = self.model.loss_function(batch_y_pred, batch_y)
-                self.optimizer.zero_grad()
-                train_loss['total_loss'].backward()
-                self.optimizer.step()
+                with self.autocast():
+                    batch_z = self.VAE_model.get_latent(batch_image, with_logvar=True)
+                    batch_y_pred = self.model(batch_z, batch_extra).view(-1)
+                train_loss = self.model.loss_function(batch_y_pred.float(), batch_y)
+                self.optimize(train_loss['total_loss'])
 
                 train_total_loss += train_loss['total_loss'].item()
                 self.iteration.append(self.num_iter)
@@ -104,16 +106,18 @@ class LatentCtrlTrain(BaseTrain):
         test_total_loss = 0
         with torch.no_grad():
             for _, batch_data in enumerate(self.test_dataloader):
-                batch_image = batch_data['image'].to(self.device)
+                batch_data = self.prepare_batch(batch_data)
+                batch_image = self.image_to_device(batch_data['image'])
                 batch_y = batch_data['action'].to(self.device)
                 if 'extra' in batch_data:
                     batch_extra = batch_data['extra'].to(self.device)
                 else:
                     batch_extra = None
 
-                batch_z = self.VAE_model.get_latent(batch_image, with_logvar=False)
-                batch_y_pred = self.model(batch_z, batch_extra).view(-1)
-                test_loss = self.model.loss_function(batch_y_pred, batch_y)
+                with self.autocast():
+                    batch_z = self.VAE_model.get_latent(batch_image, with_logvar=False)
+                    batch_y_pred = self.model(batch_z, batch_extra).view(-1)
+                test_loss = self.model.loss_function(batch_y_pred.float(), batch_y)
                 test_total_loss += test_loss['total_loss'].item()
         
         n_batch = len(self.test_dataloader)
@@ -48,12 +48,12 @@ class VAETrain(BaseTrain):
             train_total_loss = 0.0
             for _, batch_data in enumerate(self.train_dataloader):
                 self.num_iter += 1
-                batch_img = batch_data['image'].to(self.device)
-                results = self.model(batch_img)
+                batch_img = self.image_to_device(batch_data['image'])
+                with self.autocast():
+                    results = self.model(batch_img)
+                results = [result.float() for result in results]
                 train_loss = self.model.loss_function(*results, num_iter=self.num_iter)
-                self.optimizer.zero_grad()
-                train_loss['total_loss'].backward()
-                self.optimizer.step()
+                self.optimize(train_loss['total_loss'])
 
                 train_total_loss += train_loss['total_loss'].item()
                 self.iteration.append(self.num_iter)
@@ -98,8 +98,10 @@ class VAETrain(BaseTrain):
         test_total_loss = 0.0
         with torch.no_grad():
             for _, batch_data in enumerate(self.test_dataloader):
-                batch_img = batch_data['image'].to(self.device)
-                results = self.model(batch_img)
+                batch_img = self.image_to_device(batch_data['image'])
+                with self.autocast():
+                    results = self.model(batch_img)
+                results = [result.float() for result in results]
                 test_loss = self.model.loss_function(*results, num_iter=self.num_iter, mode='VAE')
                 test_total_loss += test_loss['total_loss'].item()
         
@@ -113,6 +115,7 @@ class VAETrain(BaseTrain):
             'iteration': self.iteration,
             'model_state_dict': self.model.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
+            'grad_scaler_state_dict': self.grad_scaler.state_dict(),
             'loss_history': self.loss_history,
             'tb_folder_name': self.tb_folder_name,
         }
@@ -41,6 +41,10 @@ class VAEGANTrain(BaseTrain):
                                 lr=train_params['optimizerD']['learning_rate'],
                                 betas=eval(train_params['optimizerD']['betas']),
                                 weight_decay=train_params['optimizerD']['weight_decay'])
+        # one grad scaler per optimizer, their losses have different scales
+        self.scalerE = self.get_grad_scaler()
+        self.scalerG = self.get_grad_scaler()
+        self.scalerD = self.get_grad_scaler()
 
         # loss history
         self.loss_history = {
@@ -59,57 +63,58 @@ class VAEGANTrain(BaseTrain):
         batch_size = batch_x_real.size(0)
         y_real = torch.full((batch_size,), 0.9).to(self.device)
         y_fake = torch.full((batch_size,), 0.1).to(self.device)
-        # Extract fake images corresponding to real images
-        mu, logvar = self.model.encode(batch_x_real)
-        batch_z = self.model.reparameterize(mu, logvar)
-        batch_x_fake = self.model.decode(batch_z.detach())
-        # Extract fake images corresponding to noise (prior)
-        batch_x_prior = self.model.sample(batch_size, self.device)
+        # Forward passes in autocast, losses in float32 (binary_cross_entropy is not autocast safe)
+        with self.autocast():
+            # Extract fake images corresponding to real images
+            mu, logvar = self.model.encode(batch_x_real)
+            batch_z = self.model.reparameterize(mu, logvar)
+            batch_x_fake = self.model.decode(batch_z.detach())
+            # Extract fake images corresponding to noise (prior)
+            batch_x_prior = self.model.sample(batch_size, self.device)
+        mu, logvar = mu.float(), logvar.float()
         #######################
         # (1) Update Discriminator
         #######################
-        l_real, _ = self.model.discriminate(batch_x_real)
-        l_fake, _ = self.model.discriminate(batch_x_fake.detach())
-        l_prior, _ = self.model.discriminate(batch_x_prior.detach())
-        loss_D = F.binary_cross_entropy(l_real, y_real) \
-                + F.binary_cross_entropy(l_fake, y_fake) \
-                + F.binary_cross_entropy(l_prior, y_fake)
-        self.optimizerD.zero_grad()
-        loss_D.backward(retain_graph=True)
-        self.optimizerD.step()
+        with self.autocast():
+            l_real, _ = self.model.discriminate(batch_x_real)
+            l_fake, _ = self.model.discriminate(batch_x_fake.detach())
+            l_prior, _ = self.model.discriminate(batch_x_prior.detach())
+        loss_D = F.binary_cross_entropy(l_real.float(), y_real) \
+                + F.binary_cross_entropy(l_fake.float(), y_fake) \
+                + F.binary_cross_entropy(l_prior.float(), y_fake)
+        self.optimize(loss_D, self.optimizerD, self.scalerD, retain_graph=True)
         ######################
         # (2) Update Generator
         ######################
-        l_real, s_real = self.model.discriminate(batch_x_real)
-        l_fake, s_fake = self.model.discriminate(batch_x_fake) 
-        l_prior, s_prior = self.model.discriminate(batch_x_prior)
-        loss_D = F.binary_cross_entropy(l_real, y_real) \
-                + F.binary_cross_entropy(l_fake, y_fake) \
-                + F.binary_cross_entropy(l_prior, y_fake)
-        feature_loss = F.mse_loss(s_fake, s_real, reduction='sum').div(batch_size)
+        with self.autocast():
+            l_real, s_real = self.model.discriminate(batch_x_real)
+            l_fake, s_fake = self.model.discriminate(batch_x_fake)
+            l_prior, s_prior = self.model.discriminate(batch_x_prior)
+        loss_D = F.binary_cross_entropy(l_real.float(), y_real) \
+                + F.binary_cross_entropy(l_fake.float(), y_fake) \
+                + F.binary_cross_entropy(l_prior.float(), y_fake)
+        s_real = s_real.float()
+        feature_loss = F.mse_loss(s_fake.float(), s_real, reduction='sum').div(batch_size)
         gamma = 1e-3
         loss_G = gamma * feature_loss - loss_D
-        self.optimizerG.zero_grad()
-        loss_G.backward(retain_graph=True)
-        self.optimizerG.step()
+        self.optimize(loss_G, self.optimizerG, self.scalerG, retain_graph=True)
         #####################
         # (3) Update Encoder
         #####################  
         kld = -0.5 * (1 + logvar - mu.pow(2) - logvar.exp())
         # kld_z = kld.mean(0)
         kld = kld.sum(1).mean(0)
-        batch_x_fake = self.model.decode(batch_z)
-        _, s_fake = self.model.discriminate(batch_x_fake)
-        feature_loss = F.mse_loss(s_fake, s_real, reduction='sum').div(batch_size)
+        with self.autocast():
+            batch_x_fake = self.model.decode(batch_z)
+            _, s_fake = self.model.discriminate(batch_x_fake)
+        feature_loss = F.mse_loss(s_fake.float(), s_real, reduction='sum').div(batch_size)
         # beta-VAE
         loss_E = feature_loss + self.beta * kld
-        self.optimizerE.zero_grad()
-        loss_E.backward()
-        self.optimizerE.step()
+        self.optimize(loss_E, self.optimizerE, self.scalerE)
         #######################
         # reconstrunction loss
         #######################
-        mse_loss = F.mse_loss(batch_x_real, batch_x_fake, reduction='sum').div(batch_size)
+        mse_loss = F.mse_loss(batch_x_real, batch_x_fake.float(), reduction='sum').div(batch_size)
 
         return {'netE_loss': loss_E,
                 'netG_loss': loss_G,
@@ -126,7 +131,7 @@ class VAEGANTrain(BaseTrain):
             netE_loss, netG_loss, netD_loss, kld_loss = 0.0, 0.0, 0.0, 0.0
             for _, batch_data, in enumerate(self.train_dataloader):
                 self.num_iter += 1
-                batch_x = batch_data['image'].to(self.device)
+                batch_x = self.image_to_device(batch_data['image'])
                 train_loss = self.train_batch(batch_x)
                 netD_loss += train_loss['netD_loss'].item()
                 netG_loss += train_loss['netG_loss'].item()
@@ -175,6 +180,12 @@ class VAEGANTrain(BaseTrain):
     def test(self):
         pass
 
+    def load_checkpoint(self, file_path):
+        checkpoint = super().load_checkpoint(file_path)
+        for name in ['scalerE', 'scalerG', 'scalerD']:
+            if name + '_state_dict' in checkpoint:
+                self.load_grad_scaler(getattr(self, name), checkpoint[name + '_state_dict'])
+
     def save_checkpoint(self, file_path):
         checkpoint_dict = {
             'epoch': self.epoch,
@@ -183,6 +194,9 @@ class VAEGANTrain(BaseTrain):
             'optimizerE_state_dict': self.optimizerE.state_dict(),
             'optimizerG_state_dict': self.optimizerG.state_dict(),
             'optimizerD_state_dict': self.optimizerD.state_dict(),
+            'scalerE_state_dict': self.scalerE.state_dict(),
+            'scalerG_state_dict': self.scalerG.state_dict(),
+            'scalerD_state_dict': self.scalerD.state_dict(),
             'loss_history': self.loss_history,
             'tb_folder_name': self.tb_folder_name,
         }
@@ -9,11 +9,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from controller.vae_latent_control import VAELatentController
+from utils.train_utils import get_color_file_list
 
 def read_data(folder_path):
     # image file
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     mavros_data = pandas.read_csv(os.path.join(folder_path, 'states.csv'))
     # ai_mode
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 
 from utils.plot_utils import plot_single_data
 from controller import AffordanceController
+from utils.train_utils import get_color_file_list
 
 
 if __name__ == "__main__":
@@ -51,8 +52,7 @@ if __name__ == "__main__":
     affordance = np.column_stack([dist_center, rel_angle]).astype(np.float32)
 
     # image files
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     dist_center_width_pred = []
     rel_angle_pred = []
@@ -9,6 +9,7 @@ import pandas
 import time
 
 from controller.end_to_end_control import EndToEndController, EndToEndController_TRT
+from utils.train_utils import get_color_file_list
 
 BLACK = (0,0,0)
 WHITE = (255,255,255)
@@ -18,8 +19,7 @@ GREEN = (0,255,0)
 
 def read_data(folder_path, image_only=False):
     # image file
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     results = {'color_file_list': color_file_list}
 
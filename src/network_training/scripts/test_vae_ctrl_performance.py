@@ -10,6 +10,7 @@ import time
 import argparse
 
 from controller.vae_latent_control import VAELatentController_Full, VAELatentController, VAELatentController_TRT
+from utils.train_utils import get_color_file_list
 
 BLACK = (0,0,0)
 WHITE = (255,255,255)
@@ -19,8 +20,7 @@ GREEN = (0,255,0)
 
 def read_data(folder_path, image_only=False):
     # image file
-    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
-    color_file_list.sort()
+    color_file_list = get_color_file_list(folder_path)
 
     results = {'color_file_list': color_file_list}
 
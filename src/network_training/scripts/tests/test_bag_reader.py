@@ -0,0 +1,387 @@
+"""
+Tests of utils.bag_reader and its use in utils.rosbag_utils
+
+Small bag files (format version 2.0) are written with uncompressed, bz2 and lz4
+chunks. They hold a PoseStamped, a CompressedImage and a Float64 topic, and are
+written out of time order, so the chunks overlap in time. The tests that decode
+msgs need genpy, the comparison against the rosbag path needs rosbag, and both
+are skipped if those are not installed.
+
+python -m pytest tests/test_bag_reader.py
+
+"""
+import bz2
+import math
+import random
+import struct
+import operator
+from collections import namedtuple
+
+import numpy as np
+import pandas
+import pytest
+
+from utils.bag_reader import (BagReader, Time, BAG_VERSION_LINE, OP_MSG_DATA, OP_BAG_HEADER,
+                              OP_INDEX_DATA, OP_CHUNK, OP_CHUNK_INFO, OP_CONNECTION)
+from utils.rosbag_utils import read_topics, read_topic_columns, read_topics_by_chunk, iter_payloads, TopicData
+
+MSG_DEF_SEPARATOR = '=' * 80 + '\n'
+
+HEADER_DEF = """uint32 seq
+time stamp
+string frame_id
+"""
+
+POSE_STAMPED_DEF = ("Header header\ngeometry_msgs/Pose pose\n\n" +
+    MSG_DEF_SEPARATOR + "MSG: std_msgs/Header\n" + HEADER_DEF +
+    MSG_DEF_SEPARATOR + "MSG: geometry_msgs/Pose\nPoint position\nQuaternion orientation\n\n" +
+    MSG_DEF_SEPARATOR + "MSG: geometry_msgs/Point\nfloat64 x\nfloat64 y\nfloat64 z\n\n" +
+    MSG_DEF_SEPARATOR + "MSG: geometry_msgs/Quaternion\nfloat64 x\nfloat64 y\nfloat64 z\nfloat64 w\n")
+
+COMPRESSED_IMAGE_DEF = ("Header header\nstring format\nuint8[] data\n\n" +
+    MSG_DEF_SEPARATOR + "MSG: std_msgs/Header\n" + HEADER_DEF)
+
+FLOAT64_DEF = "float64 data\n"
+
+# topic: (datatype, md5sum, message definition), in connection id order
+CONNECTIONS = {
+    '/mavros/local_position/pose': ('geometry_msgs/PoseStamped', 'd3812c3cbc69362b77dc0b19b345f8f5', POSE_STAMPED_DEF),
+    '/camera/image_raw/compressed': ('sensor_msgs/CompressedImage', '8f7a12909da2c9d3332d540a0977563f', COMPRESSED_IMAGE_DEF),
+    '/command/value': ('std_msgs/Float64', 'fdb28210bfa9d7c91146260178d9a584', FLOAT64_DEF),
+}
+POSE_TOPIC, IMAGE_TOPIC, VALUE_TOPIC = CONNECTIONS
+TOPICS = list(CONNECTIONS)
+
+# number of msgs per chunk
+CHUNK_SIZE = 12
+
+# time (in nsec) of a msg, its serialized data and the expected {field: value} of the decoded msg
+Message = namedtuple('Message', ['topic', 'time', 'data', 'values'])
+
+
+def pack_string(value):
+    value = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('<I', len(value)) + value
+
+def pack_time(nsec):
+    return struct.pack('<II', nsec // 1000000000, nsec % 1000000000)
+
+def pack_header(seq, stamp, frame_id):
+    return struct.pack('<I', seq) + pack_time(stamp) + pack_string(frame_id)
+
+def to_sec(nsec):
+    """Float seconds of a time in nsec, as computed by the readers"""
+    return (nsec // 1000000000) + (nsec % 1000000000) * 1e-9
+
+def make_messages():
+    """Msgs of the synthetic bags, sorted by topic then time"""
+    rng = random.Random(0)
+    t0 = 1600000000 * 1000000000 + 123456789
+    messages = []
+    for i in range(40):
+        t = t0 + i * 50000000
+        stamp = t - 10000000 # header stamp different from the bag time
+        position = (0.5 * i, -1.0 * i, 2.0)
+        messages.append(Message(POSE_TOPIC, t,
+            pack_header(i, stamp, 'map') + struct.pack('<7d', *(position + (0.0, 0.0, 0.0, 1.0))),
+            {'header.seq': i, 'header.stamp': stamp, 'header.frame_id': 'map',
+             'pose.position.x': position[0], 'pose.position.y': position[1], 'pose.position.z': position[2],
+             'pose.orientation.w': 1.0}))
+    for i in range(15):
+        t = t0 + 1000000 + i * 133333333
+        payload = bytes(rng.getrandbits(8) for _ in range(rng.randint(10, 2000)))
+        messages.append(Message(IMAGE_TOPIC, t,
+            pack_header(100 + i, t, 'camera') + pack_string('jpeg') + pack_string(payload),
+            {'header.seq': 100 + i, 'header.stamp': t, 'header.frame_id': 'camera',
+             'format': 'jpeg', 'data': payload}))
+    for i in range(25):
+        t = t0 + 2300000 + i * 80000000
+        messages.append(Message(VALUE_TOPIC, t, struct.pack('<d', 0.25 * i), {'data': 0.25 * i}))
+    return messages
+
+MESSAGES = make_messages()
+
+def get_write_order(messages):
+    """
+    Shuffled msgs, with the Float64 topic written last, so that the chunks overlap
+    in time and the Float64 topic is only in the last chunks
+    """
+    rng = random.Random(1)
+    first = [msg for msg in messages if msg.topic != VALUE_TOPIC]
+    last = [msg for msg in messages if msg.topic == VALUE_TOPIC]
+    rng.shuffle(first)
+    rng.shuffle(last)
+    return first + last
+
+def get_expected(topics=None, start_time=None, end_time=None):
+    """Msgs sorted by time, as returned by read_messages"""
+    return sorted([msg for msg in MESSAGES
+                   if (topics is None or msg.topic in topics) and
+                      (start_time is None or msg.time >= start_time) and
+                      (end_time is None or msg.time <= end_time)],
+                  key=lambda msg: msg.time)
+
+
+def make_record(fields, data):
+    """Record with the header fields [(name, bytes value)]"""
+    header = b''
+    for name, value in fields:
+        field = name.encode('utf-8') + b'=' + value
+        header += struct.pack('<I', len(field)) + field
+    return struct.pack('<I', len(header)) + header + struct.pack('<I', len(data)) + data
+
+def make_connection_record(conn_id, topic):
+    datatype, md5sum, msg_def = CONNECTIONS[topic]
+    data = b''
+    for name, value in [('topic', topic), ('type', datatype), ('md5sum', md5sum), ('message_definition', msg_def)]:
+        field = name.encode('utf-8') + b'=' + value.encode('utf-8')
+        data += struct.pack('<I', len(field)) + field
+    return make_record([('op', bytes([OP_CONNECTION])),
+                        ('conn', struct.pack('<I', conn_id)),
+                        ('topic', topic.encode('utf-8'))], data)
+
+def make_bag_header_record(index_pos, conn_count, chunk_count):
+    """Bag header record, padded to 4096 bytes as written by rosbag"""
+    record = make_record([('op', bytes([OP_BAG_HEADER])),
+                          ('index_pos', struct.pack('<Q', index_pos)),
+                          ('conn_count', struct.pack('<I', conn_count)),
+                          ('chunk_count', struct.pack('<I', chunk_count))], b'')
+    return record[:-4] + struct.pack('<I', 4096 - len(record)) + b' ' * (4096 - len(record))
+
+def compress_chunk(compression, data):
+    if compression == 'none':
+        return data
+    if compression == 'bz2':
+        return bz2.compress(data)
+    import lz4.frame
+    return lz4.frame.compress(data)
+
+def write_bag(bag_path, messages, compression='none', chunk_size=CHUNK_SIZE):
+    """Write the msgs in the given order, chunk_size msgs per chunk"""
+    conn_ids = {topic: conn_id for conn_id, topic in enumerate(TOPICS)}
+    buffer = bytearray(BAG_VERSION_LINE)
+    header_pos = len(buffer)
+    buffer += make_bag_header_record(0, 0, 0)
+
+    written_conns = set()
+    chunk_infos = []
+    for start in range(0, len(messages), chunk_size):
+        chunk_msgs = messages[start:start + chunk_size]
+        chunk = bytearray()
+        entries = {}
+        for msg in chunk_msgs:
+            conn_id = conn_ids[msg.topic]
+            if conn_id not in written_conns:
+                chunk += make_connection_record(conn_id, msg.topic)
+                written_conns.add(conn_id)
+            entries.setdefault(conn_id, []).append((msg.time, len(chunk)))
+            chunk += make_record([('op', bytes([OP_MSG_DATA])),
+                                  ('conn', struct.pack('<I', conn_id)),
+                                  ('time', pack_time(msg.time))], msg.data)
+
+        chunk_pos = len(buffer)
+        buffer += make_record([('op', bytes([OP_CHUNK])),
+                               ('compression', compression.encode('utf-8')),
+                               ('size', struct.pack('<I', len(chunk)))], compress_chunk(compression, bytes(chunk)))
+        for conn_id, conn_entries in sorted(entries.items()):
+            buffer += make_record([('op', bytes([OP_INDEX_DATA])),
+                                   ('ver', struct.pack('<I', 1)),
+                                   ('conn', struct.pack('<I', conn_id)),
+                                   ('count', struct.pack('<I', len(conn_entries)))],
+                                  b''.join(pack_time(t) + struct.pack('<I', offset) for t, offset in conn_entries))
+        times = [msg.time for msg in chunk_msgs]
+        counts = {conn_id: len(conn_entries) for conn_id, conn_entries in entries.items()}
+        chunk_infos.append((chunk_pos, min(times), max(times), counts))
+
+    index_pos = len(buffer)
+    for topic, conn_id in conn_ids.items():
+        buffer += make_connection_record(conn_id, topic)
+    for chunk_pos, start_time, end_time, counts in chunk_infos:
+        buffer += make_record([('op', bytes([OP_CHUNK_INFO])),
+                               ('ver', struct.pack('<I', 1)),
+                               ('chunk_pos', struct.pack('<Q', chunk_pos)),
+                               ('start_time', pack_time(start_time)),
+                               ('end_time', pack_time(end_time)),
+                               ('count', struct.pack('<I', len(counts)))],
+                              b''.join(struct.pack('<II', conn_id, count) for conn_id, count in sorted(counts.items())))
+    buffer[header_pos:header_pos + 4096] = make_bag_header_record(index_pos, len(conn_ids), len(chunk_infos))
+
+    with open(bag_path, 'wb') as file:
+        file.write(buffer)
+
+
+@pytest.fixture(params=['none', 'bz2', 'lz4'])
+def compression(request):
+    if request.param == 'lz4':
+        pytest.importorskip('lz4.frame')
+    return request.param
+
+@pytest.fixture
+def bag_file(compression, tmp_path):
+    bag_path = str(tmp_path / ('synthetic_%s.bag' % compression))
+    write_bag(bag_path, get_write_order(MESSAGES), compression)
+    return bag_path
+
+@pytest.fixture
+def genpy():
+    return pytest.importorskip('genpy.dynamic')
+
+
+def assert_columns(topic_msgs, messages, columns=None):
+    """Compare the columns of a topic pandas.Dataframe (or TopicData) with the expected msgs"""
+    np.testing.assert_allclose(topic_msgs['bag_time'], [to_sec(msg.time) for msg in messages], rtol=0, atol=1e-6)
+    for name in (columns or messages[0].values):
+        expected = [msg.values[name] for msg in messages]
+        if name == 'header.stamp':
+            np.testing.assert_allclose(topic_msgs[name], [to_sec(t) for t in expected], rtol=0, atol=1e-6)
+            np.testing.assert_allclose(topic_msgs['ros_time'], [to_sec(t) for t in expected], rtol=0, atol=1e-6)
+        else:
+            assert list(topic_msgs[name]) == expected, name
+
+
+def test_index(bag_file, compression):
+    with BagReader(bag_file) as bag:
+        assert len(bag.chunks) == math.ceil(len(MESSAGES) / CHUNK_SIZE)
+        assert set(chunk.compression for chunk in bag.chunks) == {compression}
+        assert bag.get_message_count() == len(MESSAGES)
+        assert bag.get_start_time() == pytest.approx(min(msg.time for msg in MESSAGES) * 1e-9)
+        assert bag.get_end_time() == pytest.approx(max(msg.time for msg in MESSAGES) * 1e-9)
+
+        info = bag.get_type_and_topic_info()
+        assert sorted(info.topics) == sorted(TOPICS)
+        for topic, (datatype, md5sum, _) in CONNECTIONS.items():
+            assert info.msg_types[datatype] == md5sum
+            assert info.topics[topic].msg_type == datatype
+            assert info.topics[topic].message_count == len(get_expected([topic]))
+            assert info.topics[topic].connections == 1
+        assert info.topics[POSE_TOPIC].frequency == pytest.approx(20.0)
+
+def test_read_messages_raw(bag_file):
+    expected = get_expected()
+    assert [msg.time for msg in get_write_order(MESSAGES)] != [msg.time for msg in expected]
+
+    with BagReader(bag_file) as bag:
+        messages = list(bag.read_messages(raw=True))
+    assert [topic for topic, _, _ in messages] == [msg.topic for msg in expected]
+    assert [t.to_nsec() for _, _, t in messages] == [msg.time for msg in expected]
+    assert [raw[1] for _, raw, _ in messages] == [msg.data for msg in expected]
+    for topic, raw, _ in messages:
+        assert raw[0] == CONNECTIONS[topic][0]
+        assert raw[2] == CONNECTIONS[topic][1]
+
+def test_read_messages_filter(bag_file):
+    start_time = MESSAGES[10].time
+    end_time = MESSAGES[30].time
+    expected = get_expected([POSE_TOPIC, VALUE_TOPIC], start_time, end_time)
+
+    with BagReader(bag_file) as bag:
+        messages = list(bag.read_messages(topics=[POSE_TOPIC, VALUE_TOPIC],
+                                          start_time=Time.from_nsec(start_time),
+                                          end_time=Time.from_nsec(end_time), raw=True))
+        assert list(bag.read_messages(topics=['/missing'], raw=True)) == []
+    assert [(topic, t.to_nsec()) for topic, _, t in messages] == [(msg.topic, msg.time) for msg in expected]
+
+def test_read_messages_decoded(bag_file, genpy):
+    expected = get_expected()
+    with BagReader(bag_file) as bag:
+        messages = list(bag.read_messages())
+    assert [(topic, t.to_nsec()) for topic, _, t in messages] == [(msg.topic, msg.time) for msg in expected]
+
+    for (_, msg, _), expected_msg in zip(messages, expected):
+        for name, value in expected_msg.values.items():
+            if name == 'header.stamp':
+                assert msg.header.stamp.secs * 1000000000 + msg.header.stamp.nsecs == value
+            else:
+                assert operator.attrgetter(name)(msg) == value, name
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_read_topics(bag_file, genpy, num_workers):
+    with BagReader(bag_file) as bag:
+        if num_workers > 1:
+            assert len(bag.get_chunk_groups(TOPICS, num_workers)) > 1
+        topic_msgs = read_topics(bag, TOPICS + ['/missing'], printout=False, use_cache=False, num_workers=num_workers)
+
+    assert topic_msgs['/missing'] is None
+    for topic in TOPICS:
+        assert_columns(topic_msgs[topic], get_expected([topic]))
+    assert 'ros_time' in topic_msgs[VALUE_TOPIC]
+    assert topic_msgs[POSE_TOPIC]['header.seq'].dtype == np.uint32
+    assert topic_msgs[POSE_TOPIC]['pose.position.x'].dtype == np.float64
+
+def test_read_topics_by_chunk(bag_file, genpy):
+    with BagReader(bag_file) as bag:
+        by_chunk = read_topics_by_chunk(bag, TOPICS, num_workers=4)
+        sequential = read_topic_columns(bag.read_messages(topics=TOPICS))
+
+    assert sorted(by_chunk) == sorted(sequential)
+    for topic, (fields, data, bag_time) in sequential.items():
+        assert by_chunk[topic][0] == fields
+        np.testing.assert_array_equal(by_chunk[topic][2], bag_time)
+        for name, column in data.items():
+            assert list(by_chunk[topic][1][name]) == list(column), name
+
+def test_chunk_groups(bag_file):
+    with BagReader(bag_file) as bag:
+        num_chunks = len(bag.chunks)
+        value_chunks = [i for i, chunk in enumerate(bag.chunks) if TOPICS.index(VALUE_TOPIC) in chunk.connection_counts]
+        assert 0 < value_chunks[0] and value_chunks == list(range(value_chunks[0], num_chunks))
+
+        for topics, chunk_indices in [(None, list(range(num_chunks))),
+                                      (TOPICS, list(range(num_chunks))),
+                                      ([VALUE_TOPIC], value_chunks)]:
+            for num_groups in [1, 2, 3, 4, 100]:
+                groups = bag.get_chunk_groups(topics, num_groups)
+                assert 1 <= len(groups) <= min(num_groups, len(chunk_indices))
+                assert all(len(group) > 0 for group in groups)
+                # contiguous groups covering each chunk once, in order
+                assert [i for group in groups for i in group] == chunk_indices
+
+        # similar sizes
+        groups = bag.get_chunk_groups(None, 3)
+        sizes = [sum(bag.chunks[i].data_size for i in group) for group in groups]
+        assert max(sizes) - min(sizes) <= 2 * max(chunk.data_size for chunk in bag.chunks)
+
+        assert bag.get_chunk_groups(['/missing'], 4) == []
+
+def test_lazy_payloads(bag_file):
+    expected = get_expected([IMAGE_TOPIC])
+    with BagReader(bag_file) as bag:
+        topic_msgs = read_topics(bag, [IMAGE_TOPIC], printout=False, use_cache=False, lazy_topics=[IMAGE_TOPIC])[IMAGE_TOPIC]
+        assert 'data' not in topic_msgs and 'format' not in topic_msgs
+        assert_columns(topic_msgs, expected, ['header.seq', 'header.stamp', 'header.frame_id'])
+        assert list(iter_payloads(bag, topic_msgs)) == [msg.values['data'] for msg in expected]
+
+        # payloads of the rows that are kept, in any order
+        topic_data = TopicData.from_dataframe(topic_msgs)
+        start_time, end_time = to_sec(expected[3].time), to_sec(expected[9].time)
+        window = topic_data.window(start_time, end_time)
+        assert list(iter_payloads(bag, window)) == [msg.values['data'] for msg in expected[3:9]]
+        assert list(iter_payloads(bag, topic_msgs.iloc[::-1])) == [msg.values['data'] for msg in expected[::-1]]
+
+def test_lazy_and_decoded_topics(bag_file, genpy):
+    with BagReader(bag_file) as bag:
+        topic_msgs = read_topics(bag, TOPICS, printout=False, use_cache=False, lazy_topics=[IMAGE_TOPIC])
+        decoded = read_topics(bag, [IMAGE_TOPIC], printout=False, use_cache=False)[IMAGE_TOPIC]
+        assert list(iter_payloads(bag, topic_msgs[IMAGE_TOPIC])) == list(iter_payloads(bag, decoded))
+
+    assert_columns(topic_msgs[POSE_TOPIC], get_expected([POSE_TOPIC]))
+    assert_columns(topic_msgs[VALUE_TOPIC], get_expected([VALUE_TOPIC]))
+    assert_columns(decoded, get_expected([IMAGE_TOPIC]))
+
+def test_against_rosbag(bag_file):
+    rosbag = pytest.importorskip('rosbag')
+    with rosbag.Bag(bag_file, 'r') as ros_bag, BagReader(bag_file) as bag:
+        ros_messages = [(topic, raw[1], t.to_nsec()) for topic, raw, t in ros_bag.read_messages(raw=True)]
+        messages = [(topic, raw[1], t.to_nsec()) for topic, raw, t in bag.read_messages(raw=True)]
+        assert messages == ros_messages
+
+        ros_info = ros_bag.get_type_and_topic_info()
+        info = bag.get_type_and_topic_info()
+        assert info.msg_types == ros_info.msg_types
+        for topic in TOPICS:
+            assert info.topics[topic].message_count == ros_info.topics[topic].message_count
+
+        ros_topic_msgs = read_topics(ros_bag, TOPICS, printout=False, use_cache=False)
+        topic_msgs = read_topics(bag, TOPICS, printout=False, use_cache=False, num_workers=2)
+    for topic in TOPICS:
+        pandas.testing.assert_frame_equal(topic_msgs[topic], ros_topic_msgs[topic])
@@ -0,0 +1,57 @@
+"""
+Tests of the bag reading of the extractors (extract_human_data, extract_camera_gps_data)
+
+The color images must be read as lazy columns (chunk position and offset of each
+msg, no payload) by default, also when rosbag is installed. A synthetic bag with
+the image topic of the extractors is written with the helpers of test_bag_reader.
+
+python -m pytest tests/test_extractors.py
+
+"""
+import sys
+import types
+
+import pytest
+
+import test_bag_reader
+import extract_human_data
+import extract_camera_gps_data
+from utils import rosbag_utils
+from utils.bag_reader import BagReader
+
+
+@pytest.fixture
+def image_bag_file(monkeypatch, tmp_path):
+    """Bag with the msgs of the synthetic image topic renamed to the image topic of the extractors"""
+    image_topic, = extract_human_data.LAZY_TOPICS
+    monkeypatch.setattr(test_bag_reader, 'CONNECTIONS', {image_topic: test_bag_reader.CONNECTIONS[test_bag_reader.IMAGE_TOPIC]})
+    monkeypatch.setattr(test_bag_reader, 'TOPICS', [image_topic])
+    messages = [msg._replace(topic=image_topic) for msg in test_bag_reader.get_expected([test_bag_reader.IMAGE_TOPIC])]
+
+    bag_path = str(tmp_path / 'images.bag')
+    test_bag_reader.write_bag(bag_path, messages)
+    return bag_path, messages
+
+@pytest.fixture
+def rosbag_installed(monkeypatch):
+    """rosbag importable, with a Bag that fails the test if it is opened"""
+    try:
+        import rosbag # noqa: F401
+    except ImportError:
+        def fail(*args, **kwargs):
+            raise AssertionError("rosbag.Bag opened instead of the BagReader")
+        monkeypatch.setitem(sys.modules, 'rosbag', types.SimpleNamespace(Bag=fail))
+
+
+@pytest.mark.parametrize('extractor', [extract_human_data, extract_camera_gps_data])
+def test_lazy_images_by_default(extractor, image_bag_file, rosbag_installed):
+    bag_path, messages = image_bag_file
+    assert extractor.LAZY_TOPICS == extract_human_data.LAZY_TOPICS
+
+    with rosbag_utils.open_bag(bag_path, extractor.BAG_READER) as bag:
+        assert isinstance(bag, BagReader)
+        topic_msgs = rosbag_utils.read_topics(bag, extractor.LAZY_TOPICS, printout=False, use_cache=False,
+                                              lazy_topics=extractor.LAZY_TOPICS)[extractor.LAZY_TOPICS[0]]
+        assert 'bag_chunk_pos' in topic_msgs and 'bag_offset' in topic_msgs
+        assert 'data' not in topic_msgs
+        assert list(rosbag_utils.iter_payloads(bag, topic_msgs)) == [msg.values['data'] for msg in messages]
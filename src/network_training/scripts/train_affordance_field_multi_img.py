@@ -7,9 +7,13 @@ import random
 import torch 
 from torchvision import transforms
 from torch.utils.data import Dataset
-from sklearn.model_selection import train_test_split
 
 from utils.train_utils import *
+from utils.shard_utils import FrameList, read_label_table
+from utils.frame_cache import SharedFrameCache, WindowSampler, get_shm_num_slots
+from utils.augment_utils import BatchAugment, ToUInt8Tensor
+from utils.split_utils import split_dataset_by_group
+from utils.dataset_manifest import DatasetManifest, list_data_folders
 from models import AffordanceNet_Resnet18, AffordanceNet_Resnet50
 from imitation_learning import AffordanceTrain
 
@@ -58,30 +62,49 @@ class AffordanceDataset(Dataset):
             dataset_dir,
             resize=None,
             affordance_dim=2,
-            transform=None):
+            transform=None,
+            frame_cache_size=0,
+            random_flip=True):
 
-        self.rgb_file_list = []
+        self.frames = FrameList(resize) # extracted folders or shards
         self.transform = transform
         self.resize = resize
         self.affordance_dim = affordance_dim
-        self.affordance = np.empty((0, affordance_dim), dtype=np.float32)
+        self.random_flip = random_flip # False if flipped by BatchAugment
 
         # Configure
         self.configure(dataset_dir)
 
+        # Decoded frames shared by the workers, each frame is read by up to 4 samples
+        # (frame_cache_size is the maximum, the cache is sized to the free /dev/shm space)
+        self.frame_cache = None
+        if frame_cache_size > 0:
+            if resize is None:
+                raise ValueError("frame_cache_size requires a fixed resize")
+            frame_shape = (resize[1], resize[0], 3)
+            num_slots = get_shm_num_slots(frame_cache_size, frame_shape, len(self.frames))
+            if num_slots < frame_cache_size:
+                print("Warning: only %d of %d frames fit in the free shared memory, increase /dev/shm (e.g., docker run --shm-size=2g)" % (
+                    num_slots, frame_cache_size))
+            if num_slots > 0:
+                try:
+                    self.frame_cache = SharedFrameCache(num_slots, frame_shape, len(self.frames))
+                except (OSError, ValueError) as e:
+                    print("Warning: frame cache disabled, cannot allocate shared memory: %s" % e)
+
     def configure(self, dataset_dir):
-        for subfolder in os.listdir(dataset_dir):
-            subfolder_path = os.path.join(dataset_dir, subfolder)
+        manifest = DatasetManifest(dataset_dir) # cached file lists and labels
+        affordance_list = [np.empty((0, self.affordance_dim), dtype=np.float32)]
+        for subfolder_path in list_data_folders(dataset_dir):
             print(subfolder_path)
             # RGB image
-            rgb_file_list = glob.glob(os.path.join(subfolder_path, 'color', '*.png'))
-            rgb_file_list.sort()
-            affordance = self.get_affordance(subfolder_path)
-            self.rgb_file_list.extend(rgb_file_list)
-            self.affordance = np.concatenate((self.affordance, affordance), axis=0)
+            self.frames.add_folder(subfolder_path, manifest=manifest)
+            affordance_list.append(self.get_affordance(subfolder_path, manifest))
+        self.affordance = np.concatenate(affordance_list, axis=0)
+        manifest.save()
             
-    def get_affordance(self, folder_path):
-        data = pandas.read_csv(os.path.join(folder_path, 'pose.csv'))
+    def get_affordance(self, folder_path, manifest=None):
+        data = read_label_table(folder_path, 'pose.csv', manifest)
         # Distance to centerline
         dist_center = data['dist_center'].to_numpy()
         # relative angle to centerline
@@ -99,7 +122,16 @@ class AffordanceDataset(Dataset):
         return result.astype(np.float32)
 
     def __len__(self):
-        return len(self.rgb_file_list)
+        return len(self.frames)
+
+    def read_frame(self, idx):
+        if self.frame_cache is None:
+            return self.frames[idx]
+        rgb_img = self.frame_cache.get(idx)
+        if rgb_img is None:
+            rgb_img = self.frames[idx]
+            self.frame_cache.put(idx, rgb_img)
+        return rgb_img
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
@@ -107,16 +139,13 @@ class AffordanceDataset(Dataset):
         
         # Read RGB image
         prev_idx_range = [0, 2, 4, 10] # relative index
-        query_img_idx = int(self.rgb_file_list[idx][-11:-4])
+        query_img_idx = self.frames.get_frame_number(idx)
         output_img_list = []
         for j in prev_idx_range:
             new_img_idx = max(0, query_img_idx - j)
             new_idx = idx - (query_img_idx - new_img_idx)
         
-            bgr_img = cv2.imread(self.rgb_file_list[new_idx], cv2.IMREAD_UNCHANGED)
-            rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
-            if self.resize is not None:
-                rgb_img = cv2.resize(rgb_img, (self.resize[0], self.resize[1]))
+            rgb_img = self.read_frame(new_idx)
             if self.transform is not None:
                 rgb_img = self.transform(rgb_img)
             
@@ -124,7 +153,7 @@ class AffordanceDataset(Dataset):
 
         output_img = torch.cat(tuple(img for img in output_img_list), dim=0)
 
-        if random.random() > 0.5:
+        if self.random_flip and random.random() > 0.5:
             output_img = transforms.functional.hflip(output_img)
             is_flip = True
         else:
@@ -157,6 +186,8 @@ if __name__ == '__main__':
     # Load Dataloader settings
     test_size           = train_config['dataset_params']['test_size']
     random_state        = train_config['dataset_params']['random_state']
+    frame_cache_size    = 4096 # max. number of decoded frames shared by the workers (~800 MB at 256x256), capped by the free /dev/shm space, 0 to disable
+    batch_augment       = True # augment the batches on the device instead of MyTransform in the workers
 
     ##########  Training   ###########
     print('============== Affordance training ================')
@@ -178,11 +209,26 @@ if __name__ == '__main__':
     torch.cuda.manual_seed(model_config['train_params']['manual_seed'])
     # np.random.seed(model_config['train_params']['manual_seed'])
 
+    # Augmentation
+    if batch_augment:
+        train_agent.set_batch_augment(BatchAugment(
+            n_image=model_config['model_params']['n_image'],
+            flip_signs={'affordance': -1},
+            rotate=10, translate=8, scale=0.1, shear=5,
+            blur_kernels=[1,3,5,7],
+            salt_pepper=0.03,
+            sharpness=0.3, brightness=0.3, contrast=0.3, saturation=0.3, hue=0.3))
+        transform = ToUInt8Tensor()
+    else:
+        transform = MyTransform()
+
     # DataLoader
     all_data = AffordanceDataset(dataset_dir,
                 resize=[image_resize[0],image_resize[1]],
                 affordance_dim=model_config['model_params']['output_dim'],
-                transform=MyTransform())
+                transform=transform,
+                frame_cache_size=frame_cache_size,
+                random_flip=not batch_augment)
 
     print('Total length of data: ', str(len(all_data)))
     print(all_data.affordance[:,0].min(), all_data.affordance[:,0].max(), all_data.affordance[:,0].mean())
@@ -196,17 +242,24 @@ if __name__ == '__main__':
         test_data = AffordanceDataset("/media/lab/NEPTUNE2/field_datasets/row_18",
                 resize=[image_resize[0],image_resize[1]],
                 affordance_dim=model_config['model_params']['output_dim'],
-                transform=MyTransform())
+                transform=transform,
+                random_flip=not batch_augment)
 
     else:
-        train_data, test_data = train_test_split(all_data,
+        # split by flight, only the indices are split
+        train_data, test_data = split_dataset_by_group(all_data,
+                                            all_data.frames.get_groups(),
                                             test_size=test_size,
-                                            random_state=random_state)       
+                                            random_state=random_state)
     print('Loaded Affordance datasets successfully!')
 
     # Training loop
     print('\n*** Start training ***')
-    train_agent.load_dataset(train_data, test_data)
+    if all_data.frame_cache is not None:
+        # draw neighbouring samples close together so their frames are decoded once
+        train_agent.load_dataset(train_data, test_data, train_sampler=WindowSampler(train_data))
+    else:
+        train_agent.load_dataset(train_data, test_data)
     train_agent.train()
     print('Trained the model successfully.')
 
@@ -6,7 +6,6 @@ import torch
 import random
 import pandas
 import math
-from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
 from torchvision import transforms
 from torch.utils.data import Dataset
@@ -14,6 +13,10 @@ from torch.utils.data import Dataset
 from models import VanillaVAE, LatentCtrl
 from imitation_learning import LatentCtrlTrain
 from utils.train_utils import *
+from utils.shard_utils import FrameList, read_label_table
+from utils.augment_utils import BatchAugment, ToUInt8Tensor
+from utils.split_utils import split_dataset_by_group
+from utils.dataset_manifest import DatasetManifest, list_data_folders
 
 # Path settings
 curr_dir    = os.path.dirname(os.path.abspath(__file__))
@@ -56,35 +59,35 @@ class LatentCtrlDataset(Dataset):
             transform=None,
             enable_extra=True):
 
-        self.rgb_file_list = []
+        self.frames = FrameList(resize) # extracted folders or shards
         self.transform = transform
         self.resize = resize
         self.enable_extra = enable_extra
-        self.action = np.empty((0,), dtype=np.float32)
-        self.state_extra = np.empty((0, 6), dtype=np.float32)
 
         # Configure
         self.configure(dataset_dir, iteration)
 
     def configure(self, dataset_dir, iteration):
+        manifest = DatasetManifest(dataset_dir) # cached file lists and states of all iterations
+        action_list = [np.empty((0,), dtype=np.float32)]
+        state_extra_list = [np.empty((0, 6), dtype=np.float32)]
         for iter in range(iteration+1):
             folder_path = os.path.join(dataset_dir, 'iter' + str(iter))
-            for subfolder in os.listdir(folder_path):
-                subfolder_path = os.path.join(folder_path, subfolder)
+            for subfolder_path in list_data_folders(folder_path):
                 print(subfolder_path)
                 # Mavros
-                state_extra, action, is_pilot = self.read_mavros_data(subfolder_path)
+                state_extra, action, is_pilot = self.read_mavros_data(subfolder_path, manifest)
                 # RGB image
-                rgb_file_list = glob.glob(os.path.join(subfolder_path, 'color', '*.png'))
-                rgb_file_list.sort()
-                rgb_file_list = np.array(rgb_file_list)[is_pilot]
-                self.rgb_file_list.extend(rgb_file_list.tolist())
-                self.action = np.concatenate((self.action, action[is_pilot]), axis=0)
+                self.frames.add_folder(subfolder_path, is_pilot, manifest)
+                action_list.append(action[is_pilot])
                 if state_extra is not None:
-                    self.state_extra = np.concatenate((self.state_extra, state_extra[is_pilot,:]), axis=0)
+                    state_extra_list.append(state_extra[is_pilot,:])
+        self.action = np.concatenate(action_list, axis=0)
+        self.state_extra = np.concatenate(state_extra_list, axis=0)
+        manifest.save()
 
-    def read_mavros_data(self, folder_dir):
-        mavros_data = pandas.read_csv(os.path.join(folder_dir, 'states.csv'))
+    def read_mavros_data(self, folder_dir, manifest=None):
+        mavros_data = read_label_table(folder_dir, 'states.csv', manifest)
         N = len(mavros_data) # length of data 
 
         # angles
@@ -128,17 +131,14 @@ class LatentCtrlDataset(Dataset):
 
 
     def __len__(self):
-        return len(self.rgb_file_list)
+        return len(self.frames)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         
         # Read RGB image
-        rgb_img = cv2.imread(self.rgb_file_list[idx], cv2.IMREAD_UNCHANGED)
-        rgb_img = cv2.cvtColor(rgb_img, cv2.COLOR_BGR2RGB)
-        if self.resize is not None:
-            rgb_img = cv2.resize(rgb_img, (self.resize[0], self.resize[1]))
+        rgb_img = self.frames[idx]
         if self.transform is not None:
             rgb_img, is_flip = self.transform(rgb_img)
         
@@ -183,6 +183,7 @@ if __name__ == '__main__':
     test_size           = train_config['dataset_params']['test_size']
     random_state        = train_config['dataset_params']['random_state']
     iteration           = train_config['dataset_params']['iteration']
+    batch_augment       = True # augment the batches on the device instead of MyTransform in the workers
 
     ##########  Training   ###########
     print('============== Latent Controller ================')
@@ -221,10 +222,17 @@ if __name__ == '__main__':
     print('Loading datasets from {:s}'.format(dataset_dir))
     image_resize = [vae_model.input_dim, vae_model.input_dim]
     enable_extra = latent_model_config['model_params']['enable_extra']
+    if batch_augment:
+        train_agent.set_batch_augment(BatchAugment(
+            flip_signs={'action': -1, 'state_extra': [-1, 1, 1, -1, -1, 1]},
+            sharpness=0.3, brightness=0.3, contrast=0.3, saturation=0.3))
+        transform = ToUInt8Tensor(return_flip=True)
+    else:
+        transform = MyTransform()
     all_data = LatentCtrlDataset(dataset_dir,
                     iteration=iteration,
                     resize=image_resize,
-                    transform=MyTransform(),
+                    transform=transform,
                     enable_extra=enable_extra)
 
     # Split the training and testing datasets
@@ -233,9 +241,11 @@ if __name__ == '__main__':
         train_data = all_data
         test_data = all_data
     else:
-        train_data, test_data = train_test_split(all_data,
+        # split by flight (get_groups(level=1) to split by DAgger iteration), only the indices are split
+        train_data, test_data = split_dataset_by_group(all_data,
+                                            all_data.frames.get_groups(),
                                             test_size=test_size,
-                                            random_state=random_state)       
+                                            random_state=random_state)
     print('Loaded datasets successfully!')
     print('Total number of data = %d' % len(train_data))
 
@@ -3,12 +3,14 @@ import numpy as np
 import cv2
 import glob
 import torch
-from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
 from torchvision import transforms
 from torch.utils.data import Dataset
 
 from utils.train_utils import read_yaml
+from utils.shard_utils import FrameList
+from utils.split_utils import split_dataset_by_group
+from utils.dataset_manifest import DatasetManifest, list_data_folders
 from models import VAEGAN
 from imitation_learning import VAEGANTrain
 
@@ -37,7 +39,7 @@ class VAEDataset(Dataset):
             resize=None,
             transform=None):
 
-        self.rgb_file_list = []
+        self.frames = FrameList(resize) # extracted folders or shards
         self.transform = transform
         self.resize = resize
 
@@ -46,26 +48,22 @@ class VAEDataset(Dataset):
 
     def configure(self, dataset_dir):
         for folder in dataset_dir:
-            for subfolder in os.listdir(folder):
-                subfolder_path = os.path.join(folder, subfolder)
+            manifest = DatasetManifest(folder) # cached file lists
+            for subfolder_path in list_data_folders(folder):
                 print(subfolder_path)
                 # RGB image
-                rgb_file_list = glob.glob(os.path.join(subfolder_path, 'color', '*.png'))
-                rgb_file_list.sort()
-                self.rgb_file_list.extend(rgb_file_list)
+                self.frames.add_folder(subfolder_path, manifest=manifest)
+            manifest.save()
 
     def __len__(self):
-        return len(self.rgb_file_list)
+        return len(self.frames)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         
         # Read RGB image
-        rgb_img = cv2.imread(self.rgb_file_list[idx], cv2.IMREAD_UNCHANGED)
-        rgb_img = cv2.cvtColor(rgb_img, cv2.COLOR_BGR2RGB)
-        if self.resize is not None:
-            rgb_img = cv2.resize(rgb_img, (self.resize[0], self.resize[1]))
+        rgb_img = self.frames[idx]
         if self.transform is not None:
             rgb_img = self.transform(rgb_img)
 
@@ -129,9 +127,11 @@ if __name__ == '__main__':
         train_data = all_data
         test_data = all_data
     else:
-        train_data, test_data = train_test_split(all_data,
+        # split by flight, only the indices are split
+        train_data, test_data = split_dataset_by_group(all_data,
+                                            all_data.frames.get_groups(),
                                             test_size=test_size,
-                                            random_state=random_state)       
+                                            random_state=random_state)
     print('Loaded VAE GAN datasets successfully!')
     print('Total number of images = %d' % len(train_data))
 
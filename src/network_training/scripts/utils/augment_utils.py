@@ -0,0 +1,250 @@
+"""
+Batched image augmentation on the training device
+
+The DataLoader workers only load uint8 images (ToUInt8Tensor) and the whole batch
+is augmented after collation, with random parameters drawn per sample: horizontal
+flip, affine, gaussian blur, salt and pepper and gaussian noise, then sharpness,
+brightness, contrast, saturation and hue as in torchvision.transforms.functional.
+A flip also changes the sign of the labels listed in flip_signs (e.g., affordance
+or yaw rate command), so images and labels stay consistent.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class ToUInt8Tensor():
+    """
+    HWC uint8 image to CHW uint8 tensor, the per-sample transform used with BatchAugment
+
+    return_flip mimics the (image, is_flip) output of the MyTransform of the
+    controller datasets, the flip itself is done by BatchAugment.
+    """
+    def __init__(self, return_flip=False):
+        self.return_flip = return_flip
+
+    def __call__(self, img):
+        img = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+        if self.return_flip:
+            return img, False
+        return img
+
+
+def uniform(low, high, size, device):
+    return low + (high - low) * torch.rand(size, device=device)
+
+def blend(img1, img2, ratio):
+    return (ratio * img1 + (1.0 - ratio) * img2).clamp(0, 1)
+
+def rgb_to_grayscale(img):
+    return (0.2989 * img[:, 0:1] + 0.587 * img[:, 1:2] + 0.114 * img[:, 2:3])
+
+def rgb_to_hsv(img):
+    r, g, b = img.unbind(dim=1)
+    maxc = img.max(dim=1).values
+    minc = img.min(dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+def hsv_to_rgb(img):
+    h, s, v = img.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+    mask = i.unsqueeze(dim=1) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=img.dtype), a4)
+
+def gaussian_kernel1d(kernel_size, device):
+    # same sigma as torchvision gaussian_blur with sigma=None
+    sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+    x = torch.arange(kernel_size, dtype=torch.float32, device=device) - (kernel_size - 1) * 0.5
+    kernel = torch.exp(-0.5 * (x / sigma)**2)
+    return kernel / kernel.sum()
+
+
+class BatchAugment():
+    def __init__(self,
+        n_image=1,
+        flip_prob=0.5,
+        flip_signs=None,
+        rotate=0.0,
+        translate=0,
+        scale=0.0,
+        shear=0.0,
+        blur_kernels=(1,),
+        salt_pepper=0.0,
+        gaussian_noise=0.0,
+        sharpness=0.0,
+        brightness=0.0,
+        contrast=0.0,
+        saturation=0.0,
+        hue=0.0,
+    ):
+        """
+        n_image: number of RGB frames stacked along the channels of an image, the
+            frames get their own parameters but are flipped together
+        flip_signs: {key: sign} applied to the labels of the flipped samples, e.g.,
+            {'action': -1, 'state_extra': [-1, 1, 1, -1, -1, 1]}
+        rotate, shear (in degrees), translate (in pixels), scale: ranges of the affine
+        blur_kernels: gaussian blur kernel sizes to choose from, 1 for no blur
+        salt_pepper: probability of a pixel set to 0 and to 1
+        gaussian_noise: std of the additive gaussian noise
+        sharpness, brightness, contrast, saturation: factors in [1-x, 1+x]
+        hue: hue shift in [-x, x]
+        """
+        self.n_image = n_image
+        self.flip_prob = flip_prob
+        self.flip_signs = flip_signs or {}
+        self.rotate = rotate
+        self.translate = translate
+        self.scale = scale
+        self.shear = shear
+        self.blur_kernels = list(blur_kernels)
+        self.salt_pepper = salt_pepper
+        self.gaussian_noise = gaussian_noise
+        self.sharpness = sharpness
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def __call__(self, batch_data, device, augment=True):
+        """
+        Move a collated batch to the device, augment it if augment is True and
+        normalize the images to [-1, 1]
+        """
+        batch_data = {key: value.to(device, non_blocking=True) if torch.is_tensor(value) else value
+                      for key, value in batch_data.items()}
+        img = batch_data['image']
+        if img.dtype == torch.uint8:
+            img = img.float().div_(255)
+        else: # already normalized by a per-sample transform
+            img = img * 0.5 + 0.5
+
+        if augment:
+            img = self.flip(img, batch_data)
+            B, C, H, W = img.shape
+            img = img.reshape(B * self.n_image, C // self.n_image, H, W)
+            img = self.augment(img)
+            img = img.reshape(B, C, H, W)
+
+        batch_data['image'] = (img - 0.5) / 0.5
+        return batch_data
+
+    def flip(self, img, batch_data):
+        """Flip the samples with all their frames and the signs of the coupled labels"""
+        B = img.shape[0]
+        is_flip = torch.rand(B, device=img.device) < self.flip_prob
+        img = torch.where(is_flip.view(B, 1, 1, 1), img.flip(-1), img)
+        for key, sign in self.flip_signs.items():
+            if key not in batch_data:
+                continue
+            value = batch_data[key]
+            sign = torch.as_tensor(sign, dtype=value.dtype, device=value.device)
+            batch_data[key] = torch.where(is_flip.view((B,) + (1,) * (value.dim() - 1)), value * sign, value)
+        return img
+
+    def augment(self, img):
+        N = img.shape[0]
+        device = img.device
+        size = (N, 1, 1, 1)
+
+        if self.rotate > 0 or self.translate > 0 or self.scale > 0 or self.shear > 0:
+            img = self.affine(img)
+        if max(self.blur_kernels) > 1:
+            img = self.gaussian_blur(img)
+        if self.salt_pepper > 0:
+            noise = torch.rand_like(img)
+            img = img.masked_fill(noise >= 1 - self.salt_pepper, 1.0).masked_fill(noise <= self.salt_pepper, 0.0)
+        if self.gaussian_noise > 0:
+            img = (img + self.gaussian_noise * torch.randn_like(img)).clamp(0, 1)
+        if self.sharpness > 0:
+            img = self.adjust_sharpness(img, uniform(max(0, 1 - self.sharpness), 1 + self.sharpness, size, device))
+        if self.brightness > 0:
+            img = blend(img, torch.zeros_like(img), uniform(max(0, 1 - self.brightness), 1 + self.brightness, size, device))
+        if self.contrast > 0:
+            mean = rgb_to_grayscale(img).mean(dim=(-3, -2, -1), keepdim=True)
+            img = blend(img, mean, uniform(max(0, 1 - self.contrast), 1 + self.contrast, size, device))
+        if self.saturation > 0:
+            img = blend(img, rgb_to_grayscale(img), uniform(max(0, 1 - self.saturation), 1 + self.saturation, size, device))
+        if self.hue > 0:
+            hsv = rgb_to_hsv(img)
+            hue_factor = uniform(-self.hue, self.hue, (N, 1, 1), device)
+            hsv = torch.stack((torch.remainder(hsv[:, 0] + hue_factor, 1.0), hsv[:, 1], hsv[:, 2]), dim=1)
+            img = hsv_to_rgb(hsv)
+        return img
+
+    def affine(self, img):
+        """Random rotation, translation, scale and shear around the image center"""
+        N, _, H, W = img.shape
+        device = img.device
+        angle = torch.deg2rad(uniform(-self.rotate, self.rotate, N, device))
+        shear = torch.deg2rad(uniform(-self.shear, self.shear, N, device))
+        scale = uniform(1 - self.scale, 1 + self.scale, N, device)
+        tx = torch.randint(-self.translate, self.translate + 1, (N,), device=device).float()
+        ty = torch.randint(-self.translate, self.translate + 1, (N,), device=device).float()
+
+        # forward matrix in pixels: scale * rotation * shear (along x), as torchvision affine
+        cos_a, sin_a = torch.cos(angle), torch.sin(angle)
+        tan_s = torch.tan(shear)
+        a = scale * cos_a
+        b = -scale * (cos_a * tan_s + sin_a)
+        c = scale * sin_a
+        d = scale * (cos_a - sin_a * tan_s)
+        det = a * d - b * c
+
+        # grid_sample maps output to input, i.e., the inverse in normalized coordinates
+        theta = torch.empty(N, 2, 3, device=device)
+        theta[:, 0, 0] = d / det
+        theta[:, 0, 1] = -b / det * H / W
+        theta[:, 1, 0] = -c / det * W / H
+        theta[:, 1, 1] = a / det
+        theta[:, 0, 2] = -(d * tx - b * ty) / det * 2 / W
+        theta[:, 1, 2] = -(-c * tx + a * ty) / det * 2 / H
+        grid = F.affine_grid(theta, img.shape, align_corners=False)
+        return F.grid_sample(img, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+    def gaussian_blur(self, img):
+        """Gaussian blur with a kernel size picked per sample from blur_kernels"""
+        N, C, _, _ = img.shape
+        choice = torch.randint(len(self.blur_kernels), (N,), device=img.device)
+        output = img.clone()
+        for i, kernel_size in enumerate(self.blur_kernels):
+            index = torch.nonzero(choice == i).view(-1)
+            if kernel_size <= 1 or len(index) == 0:
+                continue
+            kernel = gaussian_kernel1d(kernel_size, img.device)
+            padding = kernel_size // 2
+            x = F.pad(img[index], [padding, padding, padding, padding], mode='reflect')
+            x = F.conv2d(x, kernel.view(1, 1, 1, -1).repeat(C, 1, 1, 1), groups=C)
+            x = F.conv2d(x, kernel.view(1, 1, -1, 1).repeat(C, 1, 1, 1), groups=C)
+            output[index] = x
+        return output
+
+    def adjust_sharpness(self, img, factor):
+        """Blend with a smoothed image, borders unchanged (as torchvision)"""
+        C = img.shape[1]
+        kernel = torch.ones(3, 3, device=img.device)
+        kernel[1, 1] = 5.0
+        kernel = (kernel / kernel.sum()).expand(C, 1, 3, 3)
+        degenerate = img.clone()
+        degenerate[..., 1:-1, 1:-1] = F.conv2d(img, kernel, groups=C).clamp(0, 1)
+        return blend(img, degenerate, factor)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""
+SQLite catalog of recorded bag files
+
+Each bag in a folder tree is scanned once (in parallel) and its metadata is
+stored in a local SQLite file: topics with message counts and frequencies,
+duration, GPS bounding box, rows flown (via the field map) and whether the
+AI controller topic exists. Bags can then be selected by query without
+opening them.
+
+Example to use:
+
+python -m utils.bag_catalog /media/lab/NEPTUNE2/field_raw_datasets
+
+"""
+import os
+import time
+import pickle
+import sqlite3
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+from utils import rosbag_utils
+from utils.navigation_utils import get_local_xy_from_latlon_batch, RowIndex
+
+# GPS topics in order of preference
+GPS_TOPICS = ['/piksi/navsatfix_best_fix', '/mavros/global_position/global']
+CONTROL_CMD_TOPIC = '/my_controller/yaw_cmd'
+
+# minimum number of GPS samples in a row to count it as flown
+MIN_ROW_SAMPLES = 10
+
+CATALOG_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bags (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    folder TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    start_time REAL,
+    end_time REAL,
+    duration REAL,
+    message_count INTEGER,
+    has_yaw_cmd INTEGER,
+    gps_topic TEXT,
+    lat_min REAL,
+    lat_max REAL,
+    lon_min REAL,
+    lon_max REAL,
+    version INTEGER,
+    scanned_at TEXT
+);
+CREATE TABLE IF NOT EXISTS topics (
+    bag_path TEXT,
+    topic TEXT,
+    msg_type TEXT,
+    message_count INTEGER,
+    frequency REAL,
+    PRIMARY KEY (bag_path, topic)
+);
+CREATE TABLE IF NOT EXISTS rows (
+    bag_path TEXT,
+    row_index INTEGER,
+    num_samples INTEGER,
+    PRIMARY KEY (bag_path, row_index)
+);
+CREATE INDEX IF NOT EXISTS topics_topic ON topics (topic);
+CREATE INDEX IF NOT EXISTS rows_row_index ON rows (row_index);
+"""
+
+
+def find_bag_files(root_folder_path):
+    """All .bag files under a folder (recursive), sorted by path"""
+    bag_paths = []
+    for folder, _, files in os.walk(root_folder_path):
+        bag_paths.extend([os.path.join(folder, file) for file in files if file.endswith('.bag')])
+    return sorted(bag_paths)
+
+def scan_bag(bag_path, field_data=None):
+    """Read the metadata of a bag, return a dict of bag info, topics and rows"""
+    stat = os.stat(bag_path)
+    info = {
+        'path': os.path.abspath(bag_path),
+        'name': os.path.basename(bag_path),
+        'folder': os.path.dirname(os.path.abspath(bag_path)),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'gps_topic': None,
+        'lat_min': None,
+        'lat_max': None,
+        'lon_min': None,
+        'lon_max': None,
+    }
+    topics = []
+    rows = []
+
+    with rosbag_utils.open_bag(bag_path) as bag:
+        info['start_time'] = bag.get_start_time()
+        info['end_time'] = bag.get_end_time()
+        info['duration'] = info['end_time'] - info['start_time']
+        info['message_count'] = bag.get_message_count()
+
+        for topic, topic_tuple in bag.get_type_and_topic_info()[1].items():
+            topics.append((topic, topic_tuple[0], topic_tuple[1], topic_tuple[3]))
+        available_topics = [topic[0] for topic in topics]
+        info['has_yaw_cmd'] = int(CONTROL_CMD_TOPIC in available_topics)
+
+        gps_topics = [topic for topic in GPS_TOPICS if topic in available_topics]
+        if len(gps_topics) > 0:
+            gps_msgs = rosbag_utils.get_topic_from_bag(bag, gps_topics[0], printout=False)
+            if gps_msgs is not None:
+                valid = (gps_msgs['latitude'] != 0) & (gps_msgs['longitude'] != 0)
+                lat = gps_msgs['latitude'][valid].to_numpy()
+                lon = gps_msgs['longitude'][valid].to_numpy()
+                if len(lat) > 0:
+                    info['gps_topic'] = gps_topics[0]
+                    info['lat_min'], info['lat_max'] = float(lat.min()), float(lat.max())
+                    info['lon_min'], info['lon_max'] = float(lon.min()), float(lon.max())
+
+                if len(lat) > 0 and field_data is not None:
+                    local_pos = get_local_xy_from_latlon_batch(lat, lon, field_data['utm_T_local'])
+                    row_index = RowIndex(field_data['row_data']).find_batch(local_pos[:,0], local_pos[:,1])
+                    row_index, num_samples = np.unique(row_index[row_index >= 0], return_counts=True)
+                    rows = [(int(index), int(count)) for index, count in zip(row_index, num_samples)
+                            if count >= MIN_ROW_SAMPLES]
+
+    return info, topics, rows
+
+def run_scan_job(bag_path, field_data):
+    """Scan one bag, return (bag_path, result, error)"""
+    try:
+        return bag_path, scan_bag(bag_path, field_data), None
+    except Exception:
+        return bag_path, None, traceback.format_exc()
+
+
+class BagCatalog():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_current(self, bag_path):
+        """Whether the bag is in the catalog and has not changed since"""
+        stat = os.stat(bag_path)
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, version FROM bags WHERE path = ?", (os.path.abspath(bag_path),)
+        ).fetchone()
+        return (row is not None and row['size'] == stat.st_size and
+                row['mtime_ns'] == stat.st_mtime_ns and row['version'] == CATALOG_VERSION)
+
+    def add(self, info, topics, rows):
+        """Insert or replace the entries of a bag"""
+        bag_path = info['path']
+        info = dict(info, version=CATALOG_VERSION, scanned_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        with self.connection:
+            self.remove(bag_path)
+            self.connection.execute(
+                "INSERT INTO bags (%s) VALUES (%s)" % (', '.join(info.keys()), ', '.join(['?'] * len(info))),
+                list(info.values()),
+            )
+            self.connection.executemany(
+                "INSERT INTO topics VALUES (?, ?, ?, ?, ?)",
+                [(bag_path,) + tuple(topic) for topic in topics],
+            )
+            self.connection.executemany(
+                "INSERT INTO rows VALUES (?, ?, ?)",
+                [(bag_path,) + tuple(row) for row in rows],
+            )
+
+    def remove(self, bag_path):
+        for table, column in [('bags', 'path'), ('topics', 'bag_path'), ('rows', 'bag_path')]:
+            self.connection.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (bag_path,))
+
+    def prune(self, root_folder_path=None):
+        """Remove the bags (under a folder) that no longer exist on disk, return their number"""
+        sql = "SELECT path FROM bags"
+        params = []
+        if root_folder_path is not None:
+            prefix = os.path.join(os.path.abspath(root_folder_path), '')
+            sql += " WHERE substr(path, 1, ?) = ?"
+            params = [len(prefix), prefix]
+        missing = [row['path'] for row in self.query(sql, params) if not os.path.isfile(row['path'])]
+        with self.connection:
+            for bag_path in missing:
+                self.remove(bag_path)
+        return len(missing)
+
+    def query(self, sql, params=()):
+        """Run a SQL query, return a list of sqlite3.Row"""
+        return self.connection.execute(sql, params).fetchall()
+
+    def select_bags(self,
+        folder=None,
+        recursive=False,
+        topics=None,
+        row_index=None,
+        has_yaw_cmd=None,
+        min_duration=None,
+    ):
+        """
+        Paths of the bags matching all the given conditions, sorted by path
+
+        folder matches the bags in a folder (as list_bag_files), or also in its
+        subfolders if recursive, topics the bags with all the listed topics and
+        row_index the bags that flew the given row. Bags deleted from disk since
+        they were scanned are skipped.
+        """
+        conditions = []
+        params = []
+        if folder is not None:
+            folder = os.path.abspath(folder)
+            if recursive:
+                prefix = os.path.join(folder, '')
+                conditions.append("(folder = ? OR substr(folder, 1, ?) = ?)")
+                params.extend([folder, len(prefix), prefix])
+            else:
+                conditions.append("folder = ?")
+                params.append(folder)
+        for topic in (topics or []):
+            conditions.append("path IN (SELECT bag_path FROM topics WHERE topic = ?)")
+            params.append(topic)
+        if row_index is not None:
+            conditions.append("path IN (SELECT bag_path FROM rows WHERE row_index = ?)")
+            params.append(row_index)
+        if has_yaw_cmd is not None:
+            conditions.append("has_yaw_cmd = ?")
+            params.append(int(has_yaw_cmd))
+        if min_duration is not None:
+            conditions.append("duration >= ?")
+            params.append(min_duration)
+
+        sql = "SELECT path FROM bags"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY path"
+        return [row['path'] for row in self.query(sql, params) if os.path.isfile(row['path'])]
+
+
+def build_catalog(root_folder_path, db_path, field_data=None, num_workers=4, rebuild=False):
+    """Scan all bags under a folder in parallel and add them to the catalog"""
+    with BagCatalog(db_path) as catalog:
+        num_removed = catalog.prune(root_folder_path)
+        if num_removed > 0:
+            print("Removed %d deleted bags from the catalog" % num_removed)
+
+        bag_paths = find_bag_files(root_folder_path)
+        if not rebuild:
+            bag_paths = [bag_path for bag_path in bag_paths if not catalog.is_current(bag_path)]
+
+        print("%d bags to scan with %d workers" % (len(bag_paths), num_workers))
+        if len(bag_paths) == 0:
+            return
+
+        num_failed = 0
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_scan_job, bag_path, field_data) for bag_path in bag_paths]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                bag_path, result, error = future.result()
+                if error is not None:
+                    num_failed += 1
+                    print("Failed to scan %s:\n%s" % (bag_path, error))
+                    continue
+                catalog.add(*result)
+
+        if num_failed > 0:
+            print("%d of %d bags failed" % (num_failed, len(bag_paths)))
+
+
+def main():
+    """
+    Build the catalog of every bag under a folder
+    """
+    curr_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    parser = argparse.ArgumentParser(description="Build a SQLite catalog of ROS bags.")
+    parser.add_argument("root_folder", help="Root folder of ROS bags.")
+    parser.add_argument("--db", default=None, help="Catalog file, default to <root_folder>/bag_catalog.db.")
+    parser.add_argument("--field-map", default=os.path.join(curr_dir, "ground_truth/plant_field.pkl"),
+                        help="Field map to detect the rows flown.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes.")
+    parser.add_argument("--rebuild", action="store_true", help="Rescan bags already in the catalog.")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(args.root_folder, 'bag_catalog.db')
+
+    field_data = None
+    if args.field_map and os.path.isfile(args.field_map):
+        with open(args.field_map, 'rb') as file:
+            field_data = pickle.load(file)
+
+    build_catalog(args.root_folder, db_path, field_data, args.workers, args.rebuild)
+
+if __name__ == "__main__":
+    main()
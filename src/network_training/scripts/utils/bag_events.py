@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Event index of a bag file for fast segment discovery
+
+The index is built once per bag and saved as a small json file in a cache
+folder (~/.cache/neptune_ros/events by default, or index_dir), so the raw data
+folders are never written to. If the file cannot be written, the index is only
+kept in memory. It records the rosout markers of the frequency sweeps and
+doublets, ControlCmd.is_active transitions, RC CH7 switches, flight mode
+changes and the offboard controller window.
+
+Example to use:
+
+python -m utils.bag_events /media/lab/NEPTUNE2/field_raw_datasets/2023-02-07_Dagger_eval2
+
+"""
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+
+from utils import rosbag_utils
+
+# topic of each event type
+ROSOUT_TOPICS = ['/rosout', '/rosout_agg']
+CONTROL_CMD_TOPIC = '/my_controller/yaw_cmd'
+RC_IN_TOPIC = '/mavros/rc/in'
+STATE_TOPIC = '/mavros/state'
+POS_Z_PID_TOPIC = '/my_controller/pos_z_pid'
+
+# rosout strings kept in the index, used by rosbag_utils.find_rosout_start_end_time
+ROSOUT_MARKERS = rosbag_utils.FREQ_SWEEP_MSGS + rosbag_utils.DOUBLET_MSGS
+
+# RC CH7 switches offboard mode, high if pwm > RC_SWITCH_PWM
+RC_CH7_INDEX = 6
+RC_SWITCH_PWM = 1500
+
+INDEX_VERSION = 2
+
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neptune_ros', 'events')
+
+
+def get_index_path(bag_path, index_dir=None):
+    """Index file of a bag in index_dir (DEFAULT_INDEX_DIR if None), keyed by the bag path"""
+    key = hashlib.sha1(os.path.abspath(bag_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(index_dir or DEFAULT_INDEX_DIR, "%s.%s.events.json" % (os.path.basename(bag_path), key))
+
+def get_bag_identity(bag_path):
+    """Identity of a bag file, used to invalidate the index"""
+    stat = os.stat(bag_path)
+    return {
+        'path': os.path.abspath(bag_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+def get_transitions(time, value):
+    """Return (time, value) of the first sample and every change of value"""
+    if len(value) == 0:
+        return []
+    index = np.concatenate([[0], np.flatnonzero(value[1:] != value[:-1]) + 1])
+    return [(float(time[i]), value[i].item() if hasattr(value[i], 'item') else value[i]) for i in index]
+
+
+class BagEventIndex():
+    def __init__(self, index):
+        self.index = index
+        self.events = index['events']
+        self.topics = index['topics']
+
+    @classmethod
+    def build(cls, bag):
+        """Build the event index from an opened bag"""
+        available_topics = bag.get_type_and_topic_info()[1].keys()
+        rosout_topics = [topic for topic in ROSOUT_TOPICS if topic in available_topics]
+        event_topics = [topic for topic in [CONTROL_CMD_TOPIC, RC_IN_TOPIC, STATE_TOPIC, POS_Z_PID_TOPIC]
+                        if topic in available_topics]
+
+        topic_msgs = rosbag_utils.read_topics(bag, rosout_topics[:1] + event_topics, printout=False)
+        topic_msgs = {topic: msgs for topic, msgs in topic_msgs.items() if msgs is not None}
+
+        events = []
+        topics = {}
+        def add_events(event_type, time, value):
+            topics[event_type] = [float(time[0]), float(time[-1])]
+            events.extend([(t, event_type, v) for t, v in get_transitions(time, value)])
+
+        if len(rosout_topics) > 0 and rosout_topics[0] in topic_msgs:
+            rosout = topic_msgs[rosout_topics[0]]
+            topics['rosout'] = [float(rosout['ros_time'].iloc[0]), float(rosout['ros_time'].iloc[-1])]
+            is_marker = np.isin(rosout['msg'].to_numpy(), ROSOUT_MARKERS)
+            events.extend([(float(t), 'rosout', msg) for t, msg in zip(rosout['ros_time'][is_marker], rosout['msg'][is_marker])])
+
+        if CONTROL_CMD_TOPIC in topic_msgs:
+            control_cmd = topic_msgs[CONTROL_CMD_TOPIC]
+            add_events('ai_active', control_cmd['ros_time'].to_numpy(), control_cmd['is_active'].to_numpy())
+
+        if RC_IN_TOPIC in topic_msgs:
+            rc_in = topic_msgs[RC_IN_TOPIC]
+            ch7_high = np.array([len(channels) > RC_CH7_INDEX and channels[RC_CH7_INDEX] > RC_SWITCH_PWM
+                                 for channels in rc_in['channels']], dtype=bool)
+            add_events('rc_ch7', rc_in['ros_time'].to_numpy(), ch7_high)
+
+        if STATE_TOPIC in topic_msgs:
+            state = topic_msgs[STATE_TOPIC]
+            add_events('mode', state['ros_time'].to_numpy(), state['mode'].to_numpy())
+            add_events('armed', state['ros_time'].to_numpy(), state['armed'].to_numpy())
+
+        if POS_Z_PID_TOPIC in topic_msgs:
+            pos_z_pid = topic_msgs[POS_Z_PID_TOPIC]['ros_time'].to_numpy()
+            topics['offboard'] = [float(pos_z_pid[0]), float(pos_z_pid[-1])]
+            events.append((float(pos_z_pid[0]), 'offboard', True))
+            events.append((float(pos_z_pid[-1]), 'offboard', False))
+
+        events.sort(key=lambda event: event[0])
+
+        index = {
+            'version': INDEX_VERSION,
+            'start_time': bag.get_start_time(),
+            'end_time': bag.get_end_time(),
+            'topics': topics,
+            'events': events,
+        }
+        return cls(index)
+
+    @classmethod
+    def from_bag(cls, bag, rebuild=False, index_dir=None):
+        """Load the index of a bag, or build and save it if missing or outdated"""
+        bag_path = bag.filename
+        index_path = get_index_path(bag_path, index_dir)
+        identity = get_bag_identity(bag_path)
+
+        if not rebuild and os.path.isfile(index_path):
+            event_index = cls.load(index_path)
+            if event_index.index.get('bag') == identity and event_index.index.get('version') == INDEX_VERSION:
+                return event_index
+
+        event_index = cls.build(bag)
+        event_index.index['bag'] = identity
+        try:
+            event_index.save(index_path)
+        except (IOError, OSError) as error:
+            # e.g., read-only cache folder, keep the index in memory
+            print("Failed to save event index %s: %s" % (index_path, error))
+        return event_index
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+        index['events'] = [tuple(event) for event in index['events']]
+        return cls(index)
+
+    def save(self, index_path):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with open(index_path, 'w') as file:
+            json.dump(self.index, file)
+
+    def has_event_type(self, event_type):
+        return event_type in self.topics
+
+    def find(self, event_type, value=None):
+        """Times of all events of a type (and value)"""
+        return [t for t, _type, v in self.events if _type == event_type and (value is None or v == value)]
+
+    def find_rosout_start_end_time(self, start_msg, end_msg):
+        """Find the (last) time of the start and end msgs (of ROSOUT_MARKERS) in rosout"""
+        start_time = self.find('rosout', start_msg)
+        end_time = self.find('rosout', end_msg)
+        return (start_time[-1] if start_time else None,
+                end_time[-1] if end_time else None)
+
+    def get_segments(self, event_type, value=True, start_time=None, end_time=None):
+        """
+        Time segments [(start, end), ...] where the state of event_type equals value
+
+        The last segment ends at the last msg of the topic. Segments are clipped to
+        [start_time, end_time] if given.
+        """
+        if event_type not in self.topics:
+            return []
+
+        segments = []
+        segment_start = None
+        for t, _type, v in self.events:
+            if _type != event_type:
+                continue
+            if v == value and segment_start is None:
+                segment_start = t
+            elif v != value and segment_start is not None:
+                segments.append((segment_start, t))
+                segment_start = None
+        if segment_start is not None:
+            segments.append((segment_start, self.topics[event_type][1]))
+
+        if start_time is not None:
+            segments = [(max(t0, start_time), t1) for t0, t1 in segments if t1 > start_time]
+        if end_time is not None:
+            segments = [(t0, min(t1, end_time)) for t0, t1 in segments if t0 < end_time]
+        return segments
+
+    def get_offboard_window(self):
+        """Start and end time of the offboard controller, None if not found"""
+        if 'offboard' not in self.topics:
+            return None
+        return tuple(self.topics['offboard'])
+
+    def get_pilot_ai_segments(self):
+        """Split the offboard window into pilot and AI segments"""
+        window = self.get_offboard_window()
+        if window is None:
+            return [], []
+        ai_segments = self.get_segments('ai_active', True, window[0], window[1])
+        pilot_segments = []
+        last_time = window[0]
+        for t0, t1 in ai_segments:
+            if t0 > last_time:
+                pilot_segments.append((last_time, t0))
+            last_time = t1
+        if last_time < window[1]:
+            pilot_segments.append((last_time, window[1]))
+        return pilot_segments, ai_segments
+
+
+def main():
+    """
+    Build the event index of every bag in a folder and print the pilot/AI segments
+    """
+    parser = argparse.ArgumentParser(description="Build event indexes of ROS bags.")
+    parser.add_argument("bag_folder", help="Folder of ROS bags.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild existing indexes.")
+    parser.add_argument("--index-dir", default=None, help="Folder of the index files, %s if not set." % DEFAULT_INDEX_DIR)
+    args = parser.parse_args()
+
+    for file in sorted(os.listdir(args.bag_folder)):
+        if not file.endswith('.bag'):
+            continue
+        with rosbag_utils.open_bag(os.path.join(args.bag_folder, file)) as bag:
+            event_index = BagEventIndex.from_bag(bag, args.rebuild, args.index_dir)
+        pilot_segments, ai_segments = event_index.get_pilot_ai_segments()
+        print("%s: %d pilot segments (%.1fs), %d AI segments (%.1fs)" % (
+            file,
+            len(pilot_segments), sum(t1 - t0 for t0, t1 in pilot_segments),
+            len(ai_segments), sum(t1 - t0 for t0, t1 in ai_segments),
+        ))
+
+if __name__ == "__main__":
+    main()
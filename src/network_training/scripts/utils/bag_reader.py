@@ -0,0 +1,464 @@
+"""
+Pure-Python reader of ROS bag files (format version 2.0)
+
+The bag file is memory-mapped and only the connection and chunk index at the
+end of the file is parsed when it is opened. Chunks are decompressed (bz2/lz4)
+when a message in them is read. Messages are returned raw, or deserialized with
+genpy classes generated from the message definitions stored in the bag, so no
+ROS install (besides the pure-Python genpy package for decoding) is needed.
+
+BagReader implements the reading part of the rosbag.Bag API used in this repo
+(read_messages, get_type_and_topic_info, get_start_time, ...), so it can be
+passed to the functions in rosbag_utils.
+
+Example to use:
+
+with BagReader('flight.bag') as bag:
+    for topic, msg, t in bag.read_messages(topics=['/mavros/local_position/pose']):
+        print(t.to_sec(), msg.pose.position.x)
+
+"""
+import os
+import bz2
+import mmap
+import struct
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+BAG_VERSION_LINE = b'#ROSBAG V2.0\n'
+
+# record op codes
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+# number of decompressed chunks kept in memory
+CHUNK_CACHE_SIZE = 4
+
+INDEX_ENTRY_DTYPE = np.dtype([('secs', '<u4'), ('nsecs', '<u4'), ('offset', '<u4')])
+
+Connection = namedtuple('Connection', ['id', 'topic', 'datatype', 'md5sum', 'msg_def', 'header'])
+ChunkInfo = namedtuple('ChunkInfo', ['position', 'compression', 'data_position', 'data_size',
+                                     'start_time', 'end_time', 'connection_counts'])
+BagMessage = namedtuple('BagMessage', ['topic', 'message', 'timestamp'])
+TopicTuple = namedtuple('TopicTuple', ['msg_type', 'message_count', 'connections', 'frequency'])
+TypesAndTopicsTuple = namedtuple('TypesAndTopicsTuple', ['msg_types', 'topics'])
+
+
+class Time(namedtuple('Time', ['secs', 'nsecs'])):
+    """Bag timestamp, with the same accessors as rospy.Time"""
+    __slots__ = ()
+
+    @classmethod
+    def from_nsec(cls, nsec):
+        return cls(int(nsec // 1000000000), int(nsec % 1000000000))
+
+    def to_sec(self):
+        return self.secs + self.nsecs * 1e-9
+
+    def to_nsec(self):
+        return self.secs * 1000000000 + self.nsecs
+
+
+class BagFormatError(Exception):
+    pass
+
+
+def to_nsec(t):
+    """Time in nanoseconds of a float (in seconds) or a rospy.Time like object"""
+    if t is None:
+        return None
+    if hasattr(t, 'to_nsec'):
+        return int(t.to_nsec())
+    return int(round(t * 1e9))
+
+def parse_fields(buffer, pos, end):
+    """Parse the name=value fields of a record header"""
+    fields = {}
+    while pos < end:
+        field_len, = struct.unpack_from('<I', buffer, pos)
+        pos += 4
+        field = bytes(buffer[pos:pos + field_len])
+        pos += field_len
+        name, value = field.split(b'=', 1)
+        fields[name.decode('utf-8')] = value
+    return fields
+
+def read_record(buffer, pos):
+    """Read the record at pos, return (header fields, data start, data end)"""
+    header_len, = struct.unpack_from('<I', buffer, pos)
+    header = parse_fields(buffer, pos + 4, pos + 4 + header_len)
+    data_pos = pos + 4 + header_len
+    data_len, = struct.unpack_from('<I', buffer, data_pos)
+    return header, data_pos + 4, data_pos + 4 + data_len
+
+def read_record_data(buffer, pos):
+    """Data of the record at pos, without parsing the header"""
+    header_len, = struct.unpack_from('<I', buffer, pos)
+    data_pos = pos + 4 + header_len
+    data_len, = struct.unpack_from('<I', buffer, data_pos)
+    return buffer[data_pos + 4:data_pos + 4 + data_len]
+
+def unpack_time(value):
+    secs, nsecs = struct.unpack('<II', value)
+    return secs * 1000000000 + nsecs
+
+def has_header(conn):
+    """Whether the first field of a msg type is a std_msgs/Header"""
+    for line in conn.msg_def.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            return line.split()[0] in ('Header', 'std_msgs/Header')
+    return False
+
+def unpack_header(data, pos=0):
+    """Unpack a serialized std_msgs/Header, return (seq, secs, nsecs, frame_id, end position)"""
+    seq, secs, nsecs, frame_id_len = struct.unpack_from('<IIII', data, pos)
+    pos += 16
+    frame_id = bytes(data[pos:pos + frame_id_len]).decode('utf-8')
+    return seq, secs, nsecs, frame_id, pos + frame_id_len
+
+def skip_string(data, pos):
+    length, = struct.unpack_from('<I', data, pos)
+    return pos + 4 + length
+
+def unpack_compressed_image_data(data):
+    """data field of a serialized sensor_msgs/CompressedImage"""
+    pos = unpack_header(data)[4]
+    pos = skip_string(data, pos) # format
+    length, = struct.unpack_from('<I', data, pos)
+    return bytes(data[pos + 4:pos + 4 + length])
+
+def unpack_image_data(data):
+    """data field of a serialized sensor_msgs/Image"""
+    pos = unpack_header(data)[4] + 8 # height, width
+    pos = skip_string(data, pos) + 5 # encoding, is_bigendian, step
+    length, = struct.unpack_from('<I', data, pos)
+    return bytes(data[pos + 4:pos + 4 + length])
+
+# payload (data field) parsers of serialized msgs, used by lazy topics
+PAYLOAD_PARSERS = {
+    'sensor_msgs/CompressedImage': unpack_compressed_image_data,
+    'sensor_msgs/Image': unpack_image_data,
+}
+
+def decompress_chunk(compression, data, size):
+    """Decompress the data of a chunk record"""
+    if compression == 'none':
+        return data
+    if compression == 'bz2':
+        return bz2.decompress(data)
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    raise BagFormatError("Unsupported chunk compression '%s'" % compression)
+
+
+class BagReader():
+    def __init__(self, bag_path, mode='r'):
+        if mode != 'r':
+            raise ValueError("BagReader is read-only")
+        self.filename = bag_path
+        self.file = open(bag_path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.connections = {}
+        self.chunks = []
+        self.chunk_cache = OrderedDict()
+        self.message_classes = {}
+        try:
+            self.read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.buffer is not None:
+            self.chunk_cache.clear()
+            self.buffer.close()
+            self.buffer = None
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # reopen the file in worker processes
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def read_index(self):
+        """Read the bag header, connection records, chunk infos and index data"""
+        if self.buffer[:len(BAG_VERSION_LINE)] != BAG_VERSION_LINE:
+            raise BagFormatError("%s is not a ROS bag file of version 2.0" % self.filename)
+
+        header, _, _ = read_record(self.buffer, len(BAG_VERSION_LINE))
+        if header['op'][0] != OP_BAG_HEADER:
+            raise BagFormatError("Missing bag header record in %s" % self.filename)
+        index_pos, = struct.unpack('<Q', header['index_pos'])
+        conn_count, = struct.unpack('<I', header['conn_count'])
+        chunk_count, = struct.unpack('<I', header['chunk_count'])
+        if index_pos == 0:
+            raise BagFormatError("%s is unindexed, run 'rosbag reindex' first" % self.filename)
+
+        # connection records
+        pos = index_pos
+        for _ in range(conn_count):
+            header, data_start, data_end = read_record(self.buffer, pos)
+            fields = parse_fields(self.buffer, data_start, data_end)
+            conn_id, = struct.unpack('<I', header['conn'])
+            self.connections[conn_id] = Connection(
+                id=conn_id,
+                topic=header['topic'].decode('utf-8'),
+                datatype=fields['type'].decode('utf-8'),
+                md5sum=fields['md5sum'].decode('utf-8'),
+                msg_def=fields.get('message_definition', b'').decode('utf-8'),
+                header={name: value.decode('utf-8', 'replace') for name, value in fields.items()},
+            )
+            pos = data_end
+
+        # chunk info records
+        for _ in range(chunk_count):
+            header, data_start, data_end = read_record(self.buffer, pos)
+            count, = struct.unpack('<I', header['count'])
+            connection_counts = dict(struct.iter_unpack('<II', self.buffer[data_start:data_start + 8 * count]))
+            chunk_pos, = struct.unpack('<Q', header['chunk_pos'])
+            self.chunks.append([chunk_pos, connection_counts,
+                                unpack_time(header['start_time']), unpack_time(header['end_time'])])
+            pos = data_end
+
+        # chunk records and the index data records that follow them
+        entries = {conn_id: [] for conn_id in self.connections}
+        for chunk_index, (chunk_pos, connection_counts, start_time, end_time) in enumerate(self.chunks):
+            header, data_start, data_end = read_record(self.buffer, chunk_pos)
+            size, = struct.unpack('<I', header['size'])
+            self.chunks[chunk_index] = ChunkInfo(
+                position=chunk_pos,
+                compression=header['compression'].decode('utf-8'),
+                data_position=data_start,
+                data_size=size,
+                start_time=start_time,
+                end_time=end_time,
+                connection_counts=connection_counts,
+            )
+
+            pos = data_end
+            for _ in range(len(connection_counts)):
+                header, data_start, data_end = read_record(self.buffer, pos)
+                conn_id, = struct.unpack('<I', header['conn'])
+                count, = struct.unpack('<I', header['count'])
+                entry = np.frombuffer(self.buffer, INDEX_ENTRY_DTYPE, count, data_start)
+                entries[conn_id].append((chunk_index, entry))
+                pos = data_end
+
+        # per connection index, sorted by time
+        self.index = {}
+        for conn_id, conn_entries in entries.items():
+            time = [entry['secs'].astype(np.int64) * 1000000000 + entry['nsecs'] for _, entry in conn_entries]
+            chunk = [np.full(len(entry), chunk_index, dtype=np.int32) for chunk_index, entry in conn_entries]
+            offset = [entry['offset'].astype(np.int64) for _, entry in conn_entries]
+            time = np.concatenate(time) if time else np.empty(0, dtype=np.int64)
+            chunk = np.concatenate(chunk) if chunk else np.empty(0, dtype=np.int32)
+            offset = np.concatenate(offset) if offset else np.empty(0, dtype=np.int64)
+            order = np.lexsort((offset, chunk, time))
+            self.index[conn_id] = (time[order], chunk[order], offset[order])
+
+    def get_connections(self, topics=None):
+        """Connections of the topics (all if None)"""
+        if isinstance(topics, str):
+            topics = [topics]
+        return [conn for conn in self.connections.values() if topics is None or conn.topic in topics]
+
+    def get_entries(self, topics=None, start_time=None, end_time=None):
+        """
+        Index entries of the messages, sorted by time
+
+        Return (time in nsec, chunk index, offset in chunk, connection id) arrays.
+        """
+        times, chunks, offsets, conn_ids = [], [], [], []
+        for conn in self.get_connections(topics):
+            time, chunk, offset = self.index[conn.id]
+            times.append(time)
+            chunks.append(chunk)
+            offsets.append(offset)
+            conn_ids.append(np.full(len(time), conn.id, dtype=np.int32))
+        if len(times) == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32),
+                    np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32))
+
+        time = np.concatenate(times)
+        chunk = np.concatenate(chunks)
+        offset = np.concatenate(offsets)
+        conn_id = np.concatenate(conn_ids)
+
+        mask = np.ones(len(time), dtype=bool)
+        if start_time is not None:
+            mask &= time >= to_nsec(start_time)
+        if end_time is not None:
+            mask &= time <= to_nsec(end_time)
+
+        order = np.lexsort((offset[mask], chunk[mask], time[mask]))
+        return time[mask][order], chunk[mask][order], offset[mask][order], conn_id[mask][order]
+
+    def get_chunk_groups(self, topics=None, num_groups=1):
+        """Split the chunks with msgs of the topics into contiguous groups of similar size"""
+        conn_ids = set(conn.id for conn in self.get_connections(topics))
+        chunk_indices = [i for i, chunk in enumerate(self.chunks) if conn_ids & set(chunk.connection_counts)]
+        if len(chunk_indices) == 0:
+            return []
+
+        size = np.array([self.chunks[i].data_size for i in chunk_indices], dtype=np.float64)
+        group = ((np.cumsum(size) - size) * num_groups // size.sum()).astype(np.int64)
+        return [[chunk_indices[i] for i in np.flatnonzero(group == g)] for g in np.unique(group)]
+
+    def get_chunk_data(self, chunk_index):
+        """Decompressed data of a chunk, the last CHUNK_CACHE_SIZE chunks are cached"""
+        data = self.chunk_cache.get(chunk_index)
+        if data is not None:
+            self.chunk_cache.move_to_end(chunk_index)
+            return data
+
+        chunk = self.chunks[chunk_index]
+        compressed = memoryview(self.buffer)[chunk.data_position:chunk.data_position + self.get_chunk_data_len(chunk)]
+        data = decompress_chunk(chunk.compression, compressed, chunk.data_size)
+        if len(data) != chunk.data_size:
+            raise BagFormatError("Chunk at %d decompressed to %d bytes, expected %d" % (
+                chunk.position, len(data), chunk.data_size))
+
+        self.chunk_cache[chunk_index] = data
+        if len(self.chunk_cache) > CHUNK_CACHE_SIZE:
+            self.chunk_cache.popitem(last=False)
+        return data
+
+    def get_chunk_data_len(self, chunk):
+        data_len, = struct.unpack_from('<I', self.buffer, chunk.data_position - 4)
+        return data_len
+
+    def get_message_class(self, conn):
+        """genpy message class of a connection, generated from its message definition"""
+        key = (conn.datatype, conn.md5sum)
+        msg_class = self.message_classes.get(key)
+        if msg_class is None:
+            import genpy.dynamic
+            msg_class = genpy.dynamic.generate_dynamic(conn.datatype, conn.msg_def)[conn.datatype]
+            self.message_classes[key] = msg_class
+        return msg_class
+
+    def read_message_data(self, chunk_index, offset):
+        """Serialized data of the message at offset of a chunk"""
+        return bytes(read_record_data(self.get_chunk_data(chunk_index), offset))
+
+    def read_messages(self, topics=None, start_time=None, end_time=None, raw=False):
+        """
+        Yield (topic, msg, t) of the messages in time order
+
+        With raw=True, msg is (datatype, data, md5sum, (chunk position, offset), pytype)
+        as in rosbag, where pytype is None if genpy is not available.
+        """
+        time, chunk, offset, conn_id = self.get_entries(topics, start_time, end_time)
+        for t, chunk_index, chunk_offset, conn in zip(time.tolist(), chunk.tolist(), offset.tolist(), conn_id.tolist()):
+            conn = self.connections[conn]
+            data = self.read_message_data(chunk_index, chunk_offset)
+            t = Time.from_nsec(t)
+            if raw:
+                try:
+                    pytype = self.get_message_class(conn)
+                except ImportError:
+                    pytype = None
+                position = (self.chunks[chunk_index].position, chunk_offset)
+                yield BagMessage(conn.topic, (conn.datatype, data, conn.md5sum, position, pytype), t)
+            else:
+                msg = self.get_message_class(conn)()
+                msg.deserialize(data)
+                yield BagMessage(conn.topic, msg, t)
+
+    def read_lazy_columns(self, topic):
+        """
+        Columns of a topic without its payload, None if the topic is not found
+
+        Only the header (if any) of each msg is unpacked. The msgs are referenced by
+        'bag_chunk_pos' and 'bag_offset', see read_payloads().
+        Return (fields, {field: numpy.array}, bag_time).
+        """
+        conns = self.get_connections([topic])
+        if len(conns) == 0:
+            return None
+        time, chunk, offset, _ = self.get_entries([topic])
+        chunk_pos = np.array([chunk.position for chunk in self.chunks], dtype=np.int64)[chunk]
+
+        fields = []
+        data = {}
+        if has_header(conns[0]):
+            headers = [unpack_header(self.read_message_data(chunk_index, chunk_offset))
+                       for chunk_index, chunk_offset in zip(chunk.tolist(), offset.tolist())]
+            fields = [('header.seq', 'uint32'), ('header.stamp', 'time'), ('header.frame_id', 'string')]
+            data['header.seq'] = np.array([header[0] for header in headers], dtype=np.uint32)
+            data['header.stamp'] = (np.array([header[1] for header in headers], dtype=np.float64) +
+                                    np.array([header[2] for header in headers], dtype=np.float64) * 1e-9)
+            data['header.frame_id'] = np.empty(len(headers), dtype=object)
+            data['header.frame_id'][:] = [header[3] for header in headers]
+
+        fields += [('bag_chunk_pos', 'int64'), ('bag_offset', 'int64')]
+        data['bag_chunk_pos'] = chunk_pos
+        data['bag_offset'] = offset.astype(np.int64)
+        return fields, data, (time // 1000000000) + (time % 1000000000) * 1e-9
+
+    def read_payloads(self, chunk_pos, offset):
+        """
+        Yield the payloads (data field) of the msgs at (chunk position, offset)
+
+        Msgs are read in the given order, each chunk is decompressed once as long
+        as the references are (mostly) sorted by time.
+        """
+        chunk_index = {chunk.position: i for i, chunk in enumerate(self.chunks)}
+        parsers = {}
+        for position, chunk_offset in zip(np.asarray(chunk_pos).tolist(), np.asarray(offset).tolist()):
+            chunk_data = self.get_chunk_data(chunk_index[position])
+            header, data_start, data_end = read_record(chunk_data, chunk_offset)
+            conn_id, = struct.unpack('<I', header['conn'])
+            parser = parsers.get(conn_id)
+            if parser is None:
+                parser = PAYLOAD_PARSERS[self.connections[conn_id].datatype]
+                parsers[conn_id] = parser
+            yield parser(chunk_data[data_start:data_end])
+
+    def get_message_count(self, topic_filters=None):
+        return sum(len(self.index[conn.id][0]) for conn in self.get_connections(topic_filters))
+
+    def get_start_time(self):
+        if len(self.chunks) == 0:
+            raise BagFormatError("Bag contains no message")
+        return min(chunk.start_time for chunk in self.chunks) * 1e-9
+
+    def get_end_time(self):
+        if len(self.chunks) == 0:
+            raise BagFormatError("Bag contains no message")
+        return max(chunk.end_time for chunk in self.chunks) * 1e-9
+
+    def get_type_and_topic_info(self, topic_filters=None):
+        """Same as rosbag.Bag.get_type_and_topic_info()"""
+        msg_types = {}
+        topics = {}
+        for topic in sorted(set(conn.topic for conn in self.get_connections(topic_filters))):
+            conns = self.get_connections([topic])
+            for conn in conns:
+                msg_types[conn.datatype] = conn.md5sum
+            time = np.sort(np.concatenate([self.index[conn.id][0] for conn in conns]))
+
+            frequency = None
+            if len(time) > 1:
+                period = np.median(np.diff(time)) * 1e-9
+                if period > 0:
+                    frequency = 1.0 / float(period)
+            topics[topic] = TopicTuple(conns[0].datatype, len(time), len(conns), frequency)
+        return TypesAndTopicsTuple(msg_types, topics)
@@ -3,17 +3,15 @@
 """
 Example to use:
 
-./bag_to_images.py /media/lab/NEPTUNE2/slam_data/2022-06-30/drone/trail2_xavier_data_1.bag  ~/tmp  /d435i/color/image_raw/compressed 
+python -m utils.bag_to_images /media/lab/NEPTUNE2/slam_data/2022-06-30/drone/trail2_xavier_data_1.bag  ~/tmp  /d435i/color/image_raw/compressed 
 
 """
 
 import os
 import argparse
 
-import numpy as np
-import cv2
-
-import rosbag
+from utils import rosbag_utils
+from utils.image_utils import extract_images
 # from sensor_msgs.msg import CompressedImage
 
 def main():
@@ -24,6 +22,8 @@ def main():
     parser.add_argument("bag_file", help="Input ROS bag.")
     parser.add_argument("output_dir", help="Output directory.")
     parser.add_argument("image_topic", help="Image topic.")
+    parser.add_argument("--format", default="png", choices=["png", "jpg"],
+                        help="Image format, jpg writes the original compressed bytes.")
 
     args = parser.parse_args()
 
@@ -31,17 +31,10 @@ def main():
             % (args.bag_file, args.image_topic, args.output_dir)
     )
 
-    bag = rosbag.Bag(args.bag_file, "r")
-    count = 0
-    for topic, msg, t in bag.read_messages(topics=[args.image_topic]):
-        np_arr = np.fromstring(msg.data, np.uint8)
-        image_np = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
-        cv2.imwrite(os.path.join(args.output_dir, "%07i.png" % count), image_np)
-        print("Wrote image %i" % count)
-        count += 1
-
-    bag.close()
+    with rosbag_utils.open_bag(args.bag_file) as bag:
+        payloads = (msg.data for _, msg, _ in bag.read_messages(topics=[args.image_topic]))
+        count = extract_images(payloads, args.output_dir, args.format)
+    print("Wrote %i images" % count)
 
     return
 
@@ -0,0 +1,107 @@
+"""
+Process-pool batch driver for bag extraction
+
+Bags are fanned out to a process pool and the result of each bag is written to a
+json manifest (done/failed/duration), so a restarted batch skips completed bags.
+If a worker process dies (e.g., killed by the OOM killer on an image-heavy bag),
+the unfinished bags are marked as failed and the batch stops.
+"""
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from tqdm import tqdm
+
+
+def list_bag_files(root_folder_path):
+    """All .bag files in a folder, sorted by name"""
+    return sorted([file for file in os.listdir(root_folder_path) if file.endswith('.bag')])
+
+def get_bag_identity(bag_path):
+    stat = os.stat(bag_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ExtractionManifest():
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.bags = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as file:
+                self.bags = json.load(file)
+
+    def is_done(self, bag_path):
+        """Whether the bag was extracted successfully and has not changed since"""
+        entry = self.bags.get(os.path.abspath(bag_path))
+        if entry is None or entry['status'] != 'done':
+            return False
+        return entry['bag'] == get_bag_identity(bag_path)
+
+    def update(self, bag_path, status, duration, error=None):
+        self.bags[os.path.abspath(bag_path)] = {
+            'status': status,
+            'duration': round(duration, 2),
+            'error': error,
+            'bag': get_bag_identity(bag_path),
+            'finished_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.manifest_path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.bags, file, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def run_extract_job(extract_fn, bag_path, args):
+    """Run one extraction job, return (bag_path, status, duration, error)"""
+    start_time = time.time()
+    try:
+        extract_fn(bag_path, *args)
+        return bag_path, 'done', time.time() - start_time, None
+    except Exception:
+        return bag_path, 'failed', time.time() - start_time, traceback.format_exc()
+
+def batch_extract(extract_fn, bag_jobs, manifest_path, num_workers=4, redo=False):
+    """
+    Extract bags in parallel
+
+    extract_fn(bag_path, *args) is called for each (bag_path, args) in bag_jobs, and it
+    must be picklable (i.e., a module-level function or class). Bags marked as done in
+    the manifest are skipped unless redo is True.
+    """
+    manifest = ExtractionManifest(manifest_path)
+    if not redo:
+        bag_jobs = [(bag_path, args) for bag_path, args in bag_jobs if not manifest.is_done(bag_path)]
+
+    print("%d bags to extract with %d workers" % (len(bag_jobs), num_workers))
+    if len(bag_jobs) == 0:
+        return manifest
+
+    num_failed = 0
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(run_extract_job, extract_fn, bag_path, args): bag_path for bag_path, args in bag_jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                bag_path, status, duration, error = future.result()
+            except BrokenProcessPool:
+                # a worker died, all bags not finished yet are lost
+                bag_path, status, duration = futures[future], 'failed', time.time() - start_time
+                error = "Worker process died before the bag was extracted (e.g., out of memory)"
+            manifest.update(bag_path, status, duration, error)
+            if status == 'failed':
+                num_failed += 1
+                print("Failed to extract %s:\n%s" % (bag_path, error))
+
+    if num_failed > 0:
+        print("%d of %d bags failed, see %s" % (num_failed, len(bag_jobs), manifest_path))
+
+    return manifest
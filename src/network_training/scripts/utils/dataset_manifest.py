@@ -0,0 +1,104 @@
+"""
+Cached scan of the extracted folders of a dataset
+
+Listing the color/ images and parsing pose.csv or states.csv of every flight folder
+on each start is slow over thousands of folders. The manifest keeps, per folder,
+the integer frame numbers of the images and the columns of its label files as
+contiguous arrays (float32, except time and booleans) in
+<dataset_dir>/dataset_manifest.pkl.
+An entry is rescanned when the mtime of the folder, its color/ folder or its
+label file changes.
+"""
+import os
+import pickle
+import numpy as np
+import pandas
+
+from utils.shard_utils import ImageFolder, ShardReader, is_shard_folder, LABEL_FILES, SHARD_INFO_FILE
+
+DATASET_MANIFEST_FILE = 'dataset_manifest.pkl'
+MANIFEST_VERSION = 1
+
+
+def list_data_folders(dataset_dir):
+    """Sorted subfolders of a dataset folder, i.e., one per flight"""
+    return sorted(os.path.join(dataset_dir, name) for name in os.listdir(dataset_dir)
+                  if os.path.isdir(os.path.join(dataset_dir, name)))
+
+def get_folder_stamp(folder_path):
+    """mtimes of the folder and of the files that a folder entry is read from"""
+    stamp = []
+    for name in ['', 'color', SHARD_INFO_FILE] + LABEL_FILES:
+        path = os.path.join(folder_path, name)
+        stamp.append(os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+    return tuple(stamp)
+
+def to_label_columns(data):
+    """Label pandas.DataFrame to a dict of contiguous arrays"""
+    columns = {}
+    for name in data.columns:
+        column = data[name].to_numpy()
+        if name != 'time' and column.dtype != bool and np.issubdtype(column.dtype, np.number):
+            column = column.astype(np.float32)
+        columns[name] = np.ascontiguousarray(column)
+    return columns
+
+def scan_folder(folder_path):
+    """Manifest entry of a shard or an extracted folder"""
+    entry = {'stamp': get_folder_stamp(folder_path), 'labels': {}}
+    if is_shard_folder(folder_path):
+        # a shard holds the columns of the label file it replaces
+        labels = to_label_columns(ShardReader(folder_path).read_labels())
+        entry['labels'] = {file_name: labels for file_name in LABEL_FILES}
+        return entry
+
+    entry['frame_numbers'], entry['extensions'] = ImageFolder.scan(folder_path)
+    for file_name in LABEL_FILES:
+        label_path = os.path.join(folder_path, file_name)
+        if os.path.isfile(label_path):
+            entry['labels'][file_name] = to_label_columns(pandas.read_csv(label_path))
+    return entry
+
+
+class DatasetManifest():
+    def __init__(self, dataset_dir):
+        self.manifest_path = os.path.join(dataset_dir, DATASET_MANIFEST_FILE)
+        self.folders = {}
+        self.checked = set() # folders validated since loaded
+        self.is_changed = False
+
+        if os.path.isfile(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'rb') as file:
+                    manifest = pickle.load(file)
+                if manifest['version'] == MANIFEST_VERSION:
+                    self.folders = manifest['folders']
+            except Exception as error:
+                print("Failed to read dataset manifest %s: %s" % (self.manifest_path, error))
+
+    def get_folder(self, folder_path):
+        """Entry of a folder (frame_numbers, extensions and labels by file), rescanned if changed"""
+        key = os.path.abspath(folder_path)
+        if key not in self.checked:
+            entry = self.folders.get(key)
+            if entry is None or entry['stamp'] != get_folder_stamp(folder_path):
+                self.folders[key] = scan_folder(folder_path)
+                self.is_changed = True
+            self.checked.add(key)
+        return self.folders[key]
+
+    def save(self):
+        """Write the manifest if any entry was rescanned"""
+        if not self.is_changed:
+            return
+        # drop the folders that no longer exist
+        self.folders = {key: entry for key, entry in self.folders.items()
+                        if key in self.checked or os.path.isdir(key)}
+        tmp_path = self.manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                pickle.dump({'version': MANIFEST_VERSION, 'folders': self.folders}, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.manifest_path)
+            self.is_changed = False
+        except (IOError, OSError) as error:
+            print("Failed to write dataset manifest %s: %s" % (self.manifest_path, error))
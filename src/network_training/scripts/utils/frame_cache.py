@@ -0,0 +1,158 @@
+"""
+Decoded-frame cache shared by the DataLoader workers, and a sampler that reuses it
+
+A multi-image sample reads several neighbouring frames (e.g., prev_idx_range =
+[0, 2, 4, 10]), so without a cache every frame is decoded and resized once per
+sample that uses it. SharedFrameCache keeps the decoded frames in a shared memory
+block with LRU eviction, visible to all workers. WindowSampler shuffles blocks of
+consecutive indices, so the samples sharing frames are drawn close together and
+the frames are still cached when they are needed again. get_shm_num_slots sizes
+the cache to the free shared memory (/dev/shm is 64 MB by default in Docker).
+"""
+import os
+import math
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class SharedFrameCache():
+    def __init__(self, num_slots, frame_shape, num_keys):
+        """
+        Cache of up to num_slots uint8 frames of frame_shape (e.g., (256, 256, 3)),
+        keyed by an integer in [0, num_keys), i.e., the dataset index
+        """
+        self.num_slots = num_slots
+        self.frame_shape = tuple(frame_shape)
+        self.num_keys = num_keys
+        self.lock = multiprocessing.Lock()
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.get_buffer_size())
+        self.attach()
+        self.stats[:] = 0 # tick, hits, misses
+        self.key_slot[:] = -1
+        self.slot_key[:] = -1
+        self.slot_tick[:] = 0
+        # only the creating process removes the shared memory block
+        self._finalizer = weakref.finalize(self, SharedFrameCache.release, self.shm)
+
+    def get_buffer_size(self):
+        frame_size = int(np.prod(self.frame_shape))
+        return 8 * 3 + 4 * self.num_keys + 16 * self.num_slots + frame_size * self.num_slots
+
+    def attach(self):
+        """Numpy views of the shared memory block"""
+        buffer = self.shm.buf
+        offset = 0
+        self.stats = np.ndarray((3,), dtype=np.int64, buffer=buffer, offset=offset)
+        offset += 8 * 3
+        self.key_slot = np.ndarray((self.num_keys,), dtype=np.int32, buffer=buffer, offset=offset)
+        offset += 4 * self.num_keys
+        self.slot_key = np.ndarray((self.num_slots,), dtype=np.int64, buffer=buffer, offset=offset)
+        offset += 8 * self.num_slots
+        self.slot_tick = np.ndarray((self.num_slots,), dtype=np.int64, buffer=buffer, offset=offset)
+        offset += 8 * self.num_slots
+        self.frames = np.ndarray((self.num_slots,) + self.frame_shape, dtype=np.uint8, buffer=buffer, offset=offset)
+
+    @staticmethod
+    def release(shm):
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        self._finalizer()
+
+    def __getstate__(self):
+        # workers started with spawn attach to the block by name
+        state = {name: self.__dict__[name] for name in ['num_slots', 'frame_shape', 'num_keys', 'lock']}
+        state['shm_name'] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.attach()
+
+    def get(self, key):
+        """Copy of the cached frame, None if not cached"""
+        with self.lock:
+            slot = self.key_slot[key]
+            if slot < 0:
+                self.stats[2] += 1
+                return None
+            self.stats[0] += 1
+            self.stats[1] += 1
+            self.slot_tick[slot] = self.stats[0]
+            return self.frames[slot].copy()
+
+    def put(self, key, frame):
+        """Cache a frame, evicting the least recently used one if full"""
+        with self.lock:
+            self.stats[0] += 1
+            slot = self.key_slot[key]
+            if slot < 0: # not cached by another worker in the meantime
+                slot = int(np.argmin(self.slot_tick))
+                old_key = self.slot_key[slot]
+                if old_key >= 0:
+                    self.key_slot[old_key] = -1
+                self.frames[slot] = frame
+                self.slot_key[slot] = key
+                self.key_slot[key] = slot
+            self.slot_tick[slot] = self.stats[0]
+
+    def get_stats(self):
+        """(hits, misses) since created"""
+        with self.lock:
+            return int(self.stats[1]), int(self.stats[2])
+
+
+def get_shm_num_slots(num_slots, frame_shape, num_keys, shm_fraction=0.5, shm_dir='/dev/shm'):
+    '''
+    Number of slots, at most num_slots, of a SharedFrameCache that fits in shm_fraction
+    of the free space of shm_dir, 0 if not even one frame fits
+
+    A shared memory block larger than the free space of /dev/shm is created without
+    error, but the workers are killed (SIGBUS) when they fill it, so check first.
+    '''
+    try:
+        stat = os.statvfs(shm_dir)
+    except (OSError, AttributeError): # no /dev/shm, e.g., on macOS or Windows
+        return num_slots
+    free_size = stat.f_bavail * stat.f_frsize * shm_fraction
+    slot_size = int(np.prod(frame_shape)) + 16
+    return int(max(0, min(num_slots, (free_size - 8 * 3 - 4 * num_keys) // slot_size)))
+
+
+class WindowSampler(Sampler):
+    """
+    Random order of blocks of block_size consecutive indices, shuffled within each block
+
+    Use it in place of shuffle=True when a sample reads neighbouring frames through a
+    SharedFrameCache. block_size should be a few times the batch size so batches still
+    mix samples of different parts of the flights.
+    """
+    def __init__(self, data_source, block_size=256, generator=None):
+        self.data_source = data_source
+        self.block_size = block_size
+        self.generator = generator
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __iter__(self):
+        n = len(self.data_source)
+        generator = self.generator
+        if generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        num_blocks = int(math.ceil(float(n) / self.block_size))
+        for block in torch.randperm(num_blocks, generator=generator).tolist():
+            start = block * self.block_size
+            block_len = min(self.block_size, n - start)
+            yield from (start + torch.randperm(block_len, generator=generator)).tolist()
@@ -0,0 +1,76 @@
+"""
+Streaming pipeline to decode compressed images and write them to a folder
+
+Decoding and writing run in separate thread pools (cv2 releases the GIL), with a
+bounded number of frames in flight, so the memory stays constant regardless of
+the bag length. Frame i is always written to name_format % i.
+
+With image_format='jpg', the compressed payloads (already JPEG for the d435i color
+topic) are written verbatim, skipping both decoding and re-encoding.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+
+def decode_image(payload, flags=cv2.IMREAD_COLOR, resize=None):
+    """Decode a compressed image (e.g., sensor_msgs/CompressedImage.data), resize to [width, height] if given"""
+    image = cv2.imdecode(np.frombuffer(payload, np.uint8), flags)
+    if resize is not None:
+        image = cv2.resize(image, (resize[0], resize[1]))
+    return image
+
+def write_image(file_path, image):
+    if not cv2.imwrite(file_path, image):
+        raise IOError("Failed to write image %s" % file_path)
+
+def decode_images(payloads, num_workers=4, max_in_flight=32, resize=None):
+    """Decode compressed images in a thread pool, yielding them in order"""
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for payload in payloads:
+            pending.append(executor.submit(decode_image, payload, cv2.IMREAD_COLOR, resize))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def write_images(images, output_folder, name_format="%07i.png", num_workers=4, max_in_flight=32):
+    """Write images in a thread pool, return the number of images written"""
+    count = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for image in images:
+            file_path = os.path.join(output_folder, name_format % count)
+            pending.append(executor.submit(write_image, file_path, image))
+            count += 1
+            if len(pending) >= max_in_flight:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    return count
+
+def write_payloads(payloads, output_folder, name_format="%07i.jpg"):
+    """Write compressed payloads verbatim, return the number of files written"""
+    count = 0
+    for payload in payloads:
+        with open(os.path.join(output_folder, name_format % count), 'wb') as file:
+            file.write(payload)
+        count += 1
+    return count
+
+def extract_images(payloads, output_folder, image_format='png', num_workers=4, max_in_flight=32):
+    """
+    Write compressed images to a folder as %07i.<image_format>, return the number of images
+
+    'jpg' writes the original JPEG bytes, other formats decode and re-encode the images.
+    """
+    name_format = "%07i." + image_format
+    if image_format == 'jpg':
+        return write_payloads(payloads, output_folder, name_format)
+
+    images = decode_images(payloads, num_workers, max_in_flight)
+    return write_images(images, output_folder, name_format, num_workers, max_in_flight)
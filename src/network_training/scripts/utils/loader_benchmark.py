@@ -0,0 +1,152 @@
+"""
+DataLoader throughput benchmark and autotuning of its settings
+
+benchmark_loader iterates a DataLoader for a number of batches, optionally running
+a training step on each batch, and measures the samples per second, the fraction
+of the time the device waits for the next batch (idle) and the time to the first
+batch (worker startup, paid once per epoch without persistent_workers).
+autotune_loader runs it over a grid of batch sizes, num_workers, prefetch_factor
+and pin_memory and picks the fastest settings, which write_dataloader_params saves
+in the train_params of a model YAML file for BaseTrain.
+"""
+import time
+import itertools
+from torch.utils.data import DataLoader, RandomSampler
+
+from imitation_learning.base_train import get_dataloader_kwargs
+
+
+def benchmark_loader(dataset, batch_size, dataloader_params, num_batches=50, warmup=5, step_fn=None):
+    '''
+    Throughput of a DataLoader with the dataloader_params of train_params,
+    step_fn(batch_data) is run on each batch and has to synchronize the device
+    '''
+    loader = DataLoader(dataset,
+                        batch_size=batch_size,
+                        sampler=RandomSampler(dataset),
+                        drop_last=True,
+                        **get_dataloader_kwargs(dataloader_params))
+
+    t_start = time.perf_counter()
+    data_iter = iter(loader)
+    first_batch = None
+    wait_time = 0.0
+    num_samples = 0
+    for i in range(warmup + num_batches):
+        t0 = time.perf_counter()
+        try:
+            batch_data = next(data_iter)
+        except StopIteration:
+            break
+        t1 = time.perf_counter()
+        if first_batch is None:
+            first_batch = t1 - t_start
+
+        if i == warmup:
+            t_measure = t0
+        if i >= warmup:
+            wait_time += t1 - t0
+            num_samples += batch_size
+        if step_fn is not None:
+            step_fn(batch_data)
+    t_end = time.perf_counter()
+    del data_iter, loader # shut the workers down
+
+    if num_samples == 0:
+        raise ValueError("Not enough data for {:d} warmup batches of {:d}".format(warmup, batch_size))
+
+    total_time = t_end - t_measure
+    return {
+        'samples_per_sec': num_samples / total_time,
+        'idle': wait_time / total_time,
+        'first_batch': first_batch,
+    }
+
+def autotune_loader(dataset,
+                    batch_sizes,
+                    num_workers=(0, 2, 4, 8),
+                    prefetch_factors=(2, 4),
+                    pin_memory=(False, True),
+                    num_batches=50,
+                    warmup=5,
+                    step_fn=None,
+                    tolerance=0.05):
+    '''
+    Benchmark the grid of settings, return (best, results) with best = {batch_size: params}
+    and results a list of (batch_size, params, benchmark) in run order
+
+    Among the settings within tolerance of the highest samples/s of a batch size, the
+    one with the fewest workers, then the smallest prefetch_factor, is the best, i.e.,
+    extra workers and memory have to pay off. persistent_workers is set when there
+    are workers, which saves the worker startup at every epoch.
+    '''
+    results = []
+    for batch_size in batch_sizes:
+        for workers, pin in itertools.product(num_workers, pin_memory):
+            for prefetch in (prefetch_factors if workers > 0 else [None]):
+                params = {
+                    'num_workers': workers,
+                    'pin_memory': pin,
+                    'persistent_workers': workers > 0,
+                    'prefetch_factor': prefetch,
+                }
+                result = benchmark_loader(dataset, batch_size, params, num_batches, warmup, step_fn)
+                print('batch_size {:4d}, workers {:2d}, prefetch {:>4s}, pin {:5s}: {:8.1f} samples/s, idle {:5.1%}, first batch {:.2f} s'.format(
+                    batch_size, workers, str(prefetch), str(pin),
+                    result['samples_per_sec'], result['idle'], result['first_batch']))
+                results.append((batch_size, params, result))
+
+    best = {}
+    for batch_size in batch_sizes:
+        candidates = [(params, result) for size, params, result in results if size == batch_size]
+        max_speed = max(result['samples_per_sec'] for _, result in candidates)
+        candidates = [(params, result) for params, result in candidates
+                      if result['samples_per_sec'] >= (1 - tolerance) * max_speed]
+        candidates.sort(key=lambda x: (x[0]['num_workers'], x[0]['prefetch_factor'] or 0, -x[1]['samples_per_sec']))
+        best[batch_size] = candidates[0][0]
+    return best, results
+
+def format_yaml_line(indent, key, value):
+    """'key: value' line with the values aligned as in the config files"""
+    value = 'null' if value is None else str(value)
+    return indent + (key + ':').ljust(26 - len(indent)) + value
+
+def write_dataloader_params(file_path, params, batch_size=None):
+    '''
+    Write the dataloader settings (and the batch_size if given) into the train_params
+    of a model YAML file, editing only those lines so comments and layout are kept
+    '''
+    with open(file_path, 'r') as file:
+        lines = file.read().split('\n')
+
+    # train_params section: indented lines after 'train_params:'
+    start = [line.rstrip() for line in lines].index('train_params:') + 1
+    end = start
+    while end < len(lines) and (lines[end].startswith(' ') or lines[end].strip() == ''):
+        end += 1
+    while end > start and lines[end-1].strip() == '':
+        end -= 1
+
+    if batch_size is not None:
+        for i in range(start, end):
+            if lines[i].startswith('  batch_size:'):
+                lines[i] = format_yaml_line('  ', 'batch_size', batch_size)
+
+    params = dict(params)
+    block = [i for i in range(start, end) if lines[i].startswith('  dataloader:')]
+    if block:
+        i = block[0] + 1
+        while i < end and lines[i].startswith('    '):
+            key = lines[i].strip().split(':')[0]
+            if key in params:
+                lines[i] = format_yaml_line('    ', key, params.pop(key))
+            i += 1
+        new_lines = [] # settings not in the file yet
+    else:
+        i = end
+        new_lines = ['  dataloader:']
+    new_lines.extend(format_yaml_line('    ', key, value) for key, value in params.items())
+    lines[i:i] = new_lines
+
+    with open(file_path, 'w') as file:
+        file.write('\n'.join(lines))
@@ -109,6 +109,29 @@ def euler_from_quaternion(quaternion, axes='sxyz'):
     """
     return euler_from_matrix(quaternion_matrix(quaternion), axes)
 
+def euler_from_quaternion_array(x, y, z, w):
+    """Return 'sxyz' Euler angles from arrays of quaternion components.
+
+    Vectorized version of euler_from_quaternion(quaternion, axes='sxyz').
+
+    """
+    x, y, z, w = [np.asarray(q, dtype=np.float64) for q in (x, y, z, w)]
+    s = 2.0 / (x*x + y*y + z*z + w*w)
+    M00 = 1.0 - s * (y*y + z*z)
+    M10 = s * (x*y + z*w)
+    M11 = 1.0 - s * (x*x + z*z)
+    M12 = s * (y*z - x*w)
+    M20 = s * (x*z - y*w)
+    M21 = s * (y*z + x*w)
+    M22 = 1.0 - s * (x*x + y*y)
+
+    cy = np.sqrt(M00*M00 + M10*M10)
+    valid = cy > _EPS
+    ax = np.where(valid, np.arctan2(M21, M22), np.arctan2(-M12, M11))
+    ay = np.arctan2(-M20, cy)
+    az = np.where(valid, np.arctan2(M10, M00), 0.0)
+    return ax, ay, az
+
 def wrap_2PI(angle):
     while angle < 0.0:
         angle += 2.0 * math.pi
@@ -1,8 +1,13 @@
+import math
 import numpy as np
 import utm
+from utm.conversion import K0 as UTM_K0, E as UTM_E, E_P2 as UTM_E_P2, R as UTM_R, M1 as UTM_M1, M2 as UTM_M2, M3 as UTM_M3, M4 as UTM_M4
 
+import shapely
 from shapely.geometry import Point
 from shapely.geometry.polygon import Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 
 def wrap_2pi(angle):
     while angle < 0.0:
@@ -22,6 +27,14 @@ def wrap_pi(angle):
 
     return angle
 
+def wrap_2pi_array(angle):
+    """Vectorized wrap_2pi"""
+    return np.mod(angle, 2.0 * np.pi)
+
+def wrap_pi_array(angle):
+    """Vectorized wrap_pi"""
+    return np.mod(np.asarray(angle) + np.pi, 2.0 * np.pi) - np.pi
+
 def get_local_xy_from_latlon(lat, lon, utm_T_local):
     e, n, _, _ = utm.from_latlon(lat, lon)
     utm_pose = np.array([e, n, 0, 1]).T
@@ -30,6 +43,88 @@ def get_local_xy_from_latlon(lat, lon, utm_T_local):
 
     return local_pos
 
+def get_local_xy_from_latlon_batch(lat, lon, utm_T_local, zone_number=None):
+    """
+    Convert arrays of lat, lon into local positions of shape (N, 2)
+
+    utm_T_local is applied as one matrix multiply. zone_number forces a fixed UTM zone.
+    """
+    e, n, _, _ = utm.from_latlon(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), zone_number)
+    utm_pos = np.column_stack([np.atleast_1d(e), np.atleast_1d(n)])
+    return utm_pos.dot(utm_T_local[:2, :2].T) + utm_T_local[:2, 3]
+
+class LatLonToLocal():
+    """
+    Lat, lon to local xy conversion in a fixed UTM zone
+
+    The constants of the zone (central meridian, false northing) are computed once
+    and the UTM scale factor and false easting/northing are folded into utm_T_local,
+    so a call only evaluates the transverse Mercator series of utm.from_latlon,
+    without the zone lookup and range checks. Scalars are converted with math and
+    arrays with numpy. The zone is taken from the first call if not given.
+    """
+    def __init__(self, utm_T_local, zone_number=None, northern=True):
+        self.utm_T_local = np.copy(utm_T_local)
+        self.zone_number = None
+        if zone_number is not None:
+            self.set_zone(zone_number, northern)
+
+    def set_zone(self, zone_number, northern=True):
+        """Precompute the projection into a UTM zone"""
+        self.zone_number = zone_number
+        self.central_lon_rad = math.radians(utm.zone_number_to_central_longitude(zone_number))
+        # local = utm_T_local * (K0 * (x, y) + (false easting, false northing))
+        rotation = self.utm_T_local[:2, :2]
+        self.scaled_rotation = rotation * UTM_K0
+        self.offset = rotation.dot([500000.0, 0.0 if northern else 10000000.0]) + self.utm_T_local[:2, 3]
+        self.coeffs = self.scaled_rotation.ravel().tolist() + self.offset.tolist()
+
+    def project(self, lat, lon, lib):
+        """Transverse Mercator (x, y) in the zone before the scale factor, lib is math or numpy"""
+        lat_rad = lib.radians(lat)
+        lat_sin = lib.sin(lat_rad)
+        lat_cos = lib.cos(lat_rad)
+        lat_tan = lat_sin / lat_cos
+        lat_tan2 = lat_tan * lat_tan
+        lat_tan4 = lat_tan2 * lat_tan2
+
+        n = UTM_R / lib.sqrt(1 - UTM_E * lat_sin * lat_sin)
+        c = UTM_E_P2 * lat_cos * lat_cos
+        a = lat_cos * ((lib.radians(lon) - self.central_lon_rad + math.pi) % (2 * math.pi) - math.pi)
+        a2 = a * a
+        a3 = a2 * a
+        a4 = a3 * a
+        a5 = a4 * a
+        a6 = a5 * a
+
+        # sin(2, 4, 6 * lat) from sin(lat) and cos(lat)
+        sin2 = 2 * lat_sin * lat_cos
+        cos2 = 1 - 2 * lat_sin * lat_sin
+        sin4 = 2 * sin2 * cos2
+        sin6 = sin4 * cos2 + (1 - 2 * sin2 * sin2) * sin2
+        m = UTM_R * (UTM_M1 * lat_rad - UTM_M2 * sin2 + UTM_M3 * sin4 - UTM_M4 * sin6)
+
+        x = n * (a +
+                 a3 / 6 * (1 - lat_tan2 + c) +
+                 a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * UTM_E_P2))
+        y = m + n * lat_tan * (a2 / 2 +
+                               a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c * c) +
+                               a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * UTM_E_P2))
+        return x, y
+
+    def __call__(self, lat, lon):
+        if self.zone_number is None:
+            lat0 = float(np.ravel(lat)[0])
+            self.set_zone(utm.latlon_to_zone_number(lat0, float(np.ravel(lon)[0])), lat0 >= 0)
+
+        if np.ndim(lat) == 0:
+            x, y = self.project(float(lat), float(lon), math)
+            r00, r01, r10, r11, b0, b1 = self.coeffs
+            return np.array([r00 * x + r01 * y + b0, r10 * x + r11 * y + b1])
+
+        x, y = self.project(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64), np)
+        return np.column_stack([x, y]).dot(self.scaled_rotation.T) + self.offset
+
 def get_projection_point2line(point, line):
     p1_p2 = line[1] - line[0]
     p1_q = point[:2] - line[0]
@@ -38,6 +133,59 @@ def get_projection_point2line(point, line):
 
     return lateral_proj, longitude_proj
 
+def get_projection_points2line(points, line):
+    """Vectorized get_projection_point2line of points with shape (N, 2)"""
+    line = np.asarray(line, dtype=np.float64)
+    p1_p2 = (line[1] - line[0]) / np.linalg.norm(line[1] - line[0])
+    p1_q = np.asarray(points, dtype=np.float64)[:, :2] - line[0]
+    lateral_proj = p1_q[:, 0] * p1_p2[1] - p1_q[:, 1] * p1_p2[0] # positive means on the right hand side
+    longitude_proj = p1_q.dot(p1_p2)
+
+    return lateral_proj, longitude_proj
+
+def get_row_direction(start_pos_x, row_data):
+    """Flying direction in a row, 1 from west to east and -1 from east to west"""
+    if start_pos_x > row_data['treelines_actual'][0][1][0]:
+        return -1
+    return 1
+
+def get_compass_heading_range(direction):
+    """Valid compass heading range [rad] of a flying direction"""
+    if direction < 0:
+        return [np.pi, 2*np.pi]
+    return [0, np.pi]
+
+def get_direction_from_heading(heading):
+    """Flying direction from a heading (compass heading - pi/2) in the valid range"""
+    compass_heading = wrap_2pi_array(heading + np.pi/2)
+    return 1 if compass_heading <= np.pi else -1
+
+def get_reference_line(row_data, direction):
+    """Reference centerline and heading of a row in the flying direction"""
+    centerline = np.asarray(row_data['centerline_actual'])
+    reference_heading = np.arctan2(
+        centerline[1][1] - centerline[0][1],
+        centerline[1][0] - centerline[0][0],
+    )
+    if direction < 0:
+        centerline = np.flip(centerline, axis=0)
+        reference_heading += np.pi
+
+    return centerline, wrap_2pi(reference_heading)
+
+def label_affordance(pos_x, pos_y, heading, row_data, direction):
+    """
+    Affordance labels of a trajectory in a row
+
+    Return (dist_center, rel_angle) arrays, where dist_center is the lateral distance
+    to the centerline and rel_angle is the heading relative to the centerline.
+    """
+    reference_line, reference_heading = get_reference_line(row_data, direction)
+    dist_center, _ = get_projection_points2line(np.column_stack([pos_x, pos_y]), reference_line)
+    rel_angle = wrap_pi_array(np.asarray(heading, dtype=np.float64) - reference_heading)
+
+    return dist_center, rel_angle
+
 def find_area_index(current_pose, all_data, start_index=0):
     search_index = np.arange(0, len(all_data))
     search_index_order = (search_index + start_index) % len(all_data)
@@ -57,4 +205,70 @@ def whether_in_polygon(current_pose, polygon):
     if polygon.contains(point):
         return True
     else:
-        return False
\ No newline at end of file
+        return False
+
+def contains_xy(polygon, x, y):
+    """Vectorized point-in-polygon test of arrays x, y"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if hasattr(shapely, 'contains_xy'): # shapely>=2.0
+        return shapely.contains_xy(polygon, x, y)
+    from shapely import vectorized
+    return vectorized.contains(polygon, x, y)
+
+class RowIndex():
+    """
+    Spatial index of the row polygons in plant_field.pkl (row_data or column_data)
+
+    Polygons are built and prepared once. A single point is checked against the
+    last row first, then against the STRtree candidates. Whole trajectories are
+    tested with find_batch and contains_batch.
+    """
+    def __init__(self, row_data, vertice_key='vertice'):
+        self.polygons = [Polygon([vertex for vertex in data[vertice_key]]) for data in row_data]
+        self.prepared = [prep(polygon) for polygon in self.polygons]
+        self.bounds = np.array([polygon.bounds for polygon in self.polygons]).reshape(-1, 4)
+        self.tree = STRtree(self.polygons)
+        self.tree_index = {id(polygon): i for i, polygon in enumerate(self.polygons)}
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def query(self, x, y):
+        """Rows whose bounding box contains the point"""
+        result = self.tree.query(Point(x, y))
+        if len(result) > 0 and not isinstance(result[0], (int, np.integer)): # shapely<2.0 returns geometries
+            return sorted(self.tree_index[id(polygon)] for polygon in result)
+        return sorted(int(index) for index in result)
+
+    def contains(self, x, y, index):
+        """Whether the point is inside row index"""
+        return self.prepared[index].contains(Point(x, y))
+
+    def find(self, x, y, last_index=None):
+        """Row index of the point, None if outside all rows"""
+        if last_index is not None and self.contains(x, y, last_index):
+            return last_index
+
+        point = Point(x, y)
+        for index in self.query(x, y):
+            if self.prepared[index].contains(point):
+                return index
+
+        return None
+
+    def contains_batch(self, x, y, index):
+        """Whether each point is inside row index"""
+        return contains_xy(self.polygons[index], x, y)
+
+    def find_batch(self, x, y):
+        """Row index of each point, -1 if outside all rows"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.full(len(x), -1, dtype=np.int64)
+        for index, (x_min, y_min, x_max, y_max) in enumerate(self.bounds):
+            candidate = np.flatnonzero((result < 0) & (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max))
+            if len(candidate) == 0:
+                continue
+            result[candidate[self.contains_batch(x[candidate], y[candidate], index)]] = index
+        return result
@@ -4,7 +4,7 @@ from collections import deque
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
-from utils.navigation_utils import find_area_index
+from utils.navigation_utils import RowIndex
 
 
 def plot_vehicle(handle, pos, heading, show_FOV=True, is_first=False):
@@ -112,6 +112,7 @@ class FieldMapPlot():
         field_bound,
     ):
         self.data = data
+        self.row_index = RowIndex(data)
         self.field_bound_latlon = field_bound['latlon']
         self.field_bound_local = field_bound['local']
 
@@ -232,11 +233,7 @@ class FieldMapPlot():
         )
 
         # find index
-        index = find_area_index(
-            [pos[0], pos[1]],
-            self.data,
-            start_index = self.last_index if self.last_index is not None else 0,
-        )
+        index = self.row_index.find(pos[0], pos[1], self.last_index)
 
         if index != self.last_index: 
             if index is None:
@@ -1,8 +1,66 @@
+import os
+import operator
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas
 
 # from geometry_msgs.msg import Twist, Pose
-from scipy.spatial import KDTree
+
+from utils.topic_cache import TopicCache
+from utils.bag_reader import BagReader, Time
+
+# ROS primitive types that map onto typed numpy columns
+ROS_NUMPY_TYPES = {
+    'bool': np.bool_,
+    'byte': np.int8,
+    'char': np.uint8,
+    'int8': np.int8,
+    'uint8': np.uint8,
+    'int16': np.int16,
+    'uint16': np.uint16,
+    'int32': np.int32,
+    'uint32': np.uint32,
+    'int64': np.int64,
+    'uint64': np.uint64,
+    'float32': np.float32,
+    'float64': np.float64,
+}
+
+# ROS time types, flattened into float seconds
+ROS_TIME_TYPES = ('time', 'duration')
+
+# compiled accessors, one per message type
+_msg_accessors = {}
+
+# on-disk cache of decoded topics, off unless NEPTUNE_TOPIC_CACHE is set (or set_topic_cache() is called)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'neptune_ros', 'topics')
+_topic_cache = TopicCache(os.environ['NEPTUNE_TOPIC_CACHE']) if os.environ.get('NEPTUNE_TOPIC_CACHE') else None
+
+def set_topic_cache(cache_dir=DEFAULT_CACHE_DIR, max_size=10 * 1024**3):
+    """Enable the on-disk topic cache in cache_dir, use cache_dir=None to disable it"""
+    global _topic_cache
+    _topic_cache = TopicCache(cache_dir, max_size) if cache_dir is not None else None
+
+# bag reader used by open_bag(): 'auto', 'rosbag' or 'python' (utils.bag_reader)
+BAG_READER = os.environ.get('NEPTUNE_BAG_READER', 'auto')
+
+def open_bag(bag_path, reader=None):
+    """
+    Open a bag file for reading
+
+    Use rosbag if installed (or reader='rosbag'), otherwise the pure-Python
+    BagReader (or reader='python'), which only needs genpy to decode the messages.
+    reader defaults to BAG_READER.
+    """
+    reader = reader or BAG_READER
+    if reader != 'python':
+        try:
+            import rosbag
+            return rosbag.Bag(bag_path, 'r')
+        except ImportError:
+            if reader == 'rosbag':
+                raise
+    return BagReader(bag_path)
 
 def print_bag_topics(bag):
     """Print all topic names in the bag file"""
@@ -28,66 +86,273 @@ def print_topic_info(topic_info):
         print("%s: %s" % (key, value))
     print('-'*30)
 
-def get_topic_duration(start_msg, end_msg):
+def get_topic_duration(topic_msgs):
     """Get the duration of a topic"""
-    if not hasattr(start_msg, 'header') or not hasattr(end_msg, 'header'):
+    if 'header.stamp' not in topic_msgs:
         return None
-    start_time = start_msg.header.stamp.secs + float(start_msg.header.stamp.nsecs) * 1e-9
-    end_time = end_msg.header.stamp.secs + float(end_msg.header.stamp.nsecs) * 1e-9
-    return round(end_time - start_time, 2)
+    stamp = topic_msgs['header.stamp'].to_numpy()
+    return round(stamp[-1] - stamp[0], 2)
+
+def get_flat_fields(msg, prefix=''):
+    """
+    Get all leaf fields from a msg as (name, type) pairs
 
-def get_all_fields(msg):
-    """Get all fields from a msg"""
+    Nested msgs are flattened with dotted names, e.g. 'pose.position.x'.
+    Arrays (e.g. 'data', 'covariance', 'channels') are kept as a single field.
+    """
     fields = []
-    exclude_list = ['deserialize', 'deserialize_numpy', 'serialize', 'serialize_numpy']
-    for field in dir(msg):
-        if not field.startswith('__') and not field.startswith('_') and field[0].islower() and field not in exclude_list:
-            fields.append(field)
+    for slot, slot_type in zip(msg.__slots__, msg._slot_types):
+        name = prefix + slot
+        if '[' not in slot_type and '/' in slot_type:
+            fields.extend(get_flat_fields(getattr(msg, slot), name + '.'))
+        else:
+            fields.append((name, slot_type))
     return fields
 
-def get_topic_from_bag(bag, topic, printout=True):
-    """Read topic data into pandas.Dataframe format"""
-    has_found = False
-    # read msg and time
-    for _, msg, bag_time in bag.read_messages(topics=topic):
-        if not has_found:
-            fields = get_all_fields(msg)
-            data = {key: [] for key in fields}
-            data['bag_time'] = []
-            data['ros_time'] = []
-            has_found = True
-
-        data['bag_time'].append(bag_time.to_sec())
-        use_bag_time = True
-        if hasattr(msg, "header") :
-            use_bag_time = False
-            ros_time = msg.header.stamp.secs + float(msg.header.stamp.nsecs) * 1e-9
-            if ros_time == 0: # if timestamp not updated properly
-                use_bag_time = True
-        if use_bag_time:
-            data['ros_time'].append(data['bag_time'][-1]) # use bag_time if msg.header.stamp not found
+class MsgAccessor():
+    """
+    Compiled accessor that reads all leaf fields of one msg type at once
+    """
+    def __init__(self, msg):
+        self.fields = get_flat_fields(msg)
+
+        paths = []
+        for name, field_type in self.fields:
+            if field_type in ROS_TIME_TYPES:
+                paths.append(name + '.secs')
+                paths.append(name + '.nsecs')
+            else:
+                paths.append(name)
+        self.num_paths = len(paths)
+
+        if self.num_paths > 1:
+            self.getter = operator.attrgetter(*paths)
+        elif self.num_paths == 1:
+            getter = operator.attrgetter(paths[0])
+            self.getter = lambda msg: (getter(msg),)
         else:
-            data['ros_time'].append(ros_time) # use msg.header.stamp
+            self.getter = lambda msg: ()
 
-        for field in fields:
-            data[field].append(getattr(msg, field))
-        
-    if not has_found:
-        print("Topic '%s' does not exist in the bag file!" % topic)
-        return None
+    def to_columns(self, rows):
+        """Convert a list of getter outputs into typed numpy columns"""
+        if len(rows) > 0 and self.num_paths > 0:
+            values = list(zip(*rows))
+        else:
+            values = [()] * self.num_paths
+
+        columns = {}
+        k = 0
+        for name, field_type in self.fields:
+            if field_type in ROS_TIME_TYPES:
+                secs = np.asarray(values[k], dtype=np.float64)
+                nsecs = np.asarray(values[k+1], dtype=np.float64)
+                columns[name] = secs + nsecs * 1e-9
+                k += 2
+                continue
+
+            if field_type in ROS_NUMPY_TYPES:
+                columns[name] = np.asarray(values[k], dtype=ROS_NUMPY_TYPES[field_type])
+            else:
+                # strings and arrays stay as python objects
+                column = np.empty(len(values[k]), dtype=object)
+                column[:] = values[k]
+                columns[name] = column
+            k += 1
+
+        return columns
+
+def get_msg_accessor(msg):
+    """Get (or compile) the accessor for this msg type"""
+    key = (msg._type, msg._md5sum)
+    if key not in _msg_accessors:
+        _msg_accessors[key] = MsgAccessor(msg)
+    return _msg_accessors[key]
+
+def get_topic_from_bag(bag, topic, printout=True, use_cache=True):
+    """
+    Read topic data into pandas.Dataframe format
+
+    Nested fields are flattened into typed numpy columns, e.g. 'pose.position.x',
+    'twist.linear.z' and 'header.stamp' (in seconds).
+    """
+    return read_topics(bag, [topic], printout, use_cache)[topic]
+
+def read_topics(bag, topics, printout=True, use_cache=True, num_workers=1, lazy_topics=()):
+    """
+    Read multiple topics in a single pass over the bag file
+
+    Return {topic: pandas.Dataframe}, the same format as get_topic_from_bag().
+    Missing topics are set to None. If the on-disk topic cache is enabled (see
+    set_topic_cache), decoded topics without payload are stored in it, so only
+    uncached topics are read from the bag. With a BagReader
+    and num_workers > 1, the chunks of the bag are decoded in a process pool.
+
+    With a BagReader, lazy_topics (e.g., images) are read without their payload,
+    which is loaded later by iter_payloads() for the rows that are kept. Other
+    bags (rosbag) read them with their payload, with a warning.
+    """
+    bag_path = getattr(bag, 'filename', None)
+    cache = _topic_cache if (use_cache and bag_path is not None) else None
+    lazy_topics = set(lazy_topics)
+    if len(lazy_topics) > 0 and not isinstance(bag, BagReader):
+        print("Warning: lazy topics need a BagReader, reading %s with their payload" % ', '.join(sorted(lazy_topics)))
+        lazy_topics = set()
+
+    def get_cache_key(topic):
+        return topic + ' (lazy)' if topic in lazy_topics else topic
+
+    topic_msgs = {}
+    if cache is not None:
+        for topic in topics:
+            cached = cache.load(bag_path, get_cache_key(topic))
+            if cached is not None:
+                topic_msgs[topic] = cached
+                if printout:
+                    print_topic_info({
+                        "topic": topic + ' (cached)',
+                        "messages": len(cached),
+                        'frequency': str(cached['frequency'].iloc[0]) + 'Hz',
+                    })
+
+    topics_to_read = [topic for topic in topics if topic not in topic_msgs]
+    if len(topics_to_read) == 0:
+        return topic_msgs
+
+    columns = {}
+    for topic in topics_to_read:
+        if topic in lazy_topics:
+            lazy_columns = bag.read_lazy_columns(topic)
+            if lazy_columns is not None:
+                columns[topic] = lazy_columns
+    topics_to_decode = [topic for topic in topics_to_read if topic not in lazy_topics]
+
+    if len(topics_to_decode) > 0 and num_workers > 1 and isinstance(bag, BagReader):
+        columns.update(read_topics_by_chunk(bag, topics_to_decode, num_workers))
+    elif len(topics_to_decode) > 0:
+        columns.update(read_topic_columns(bag.read_messages(topics=topics_to_decode)))
+
+    for topic in topics_to_read:
+        if topic not in columns:
+            print("Topic '%s' does not exist in the bag file!" % topic)
+            topic_msgs[topic] = None
+            continue
+        fields, data, bag_time = columns[topic]
+        topic_msgs[topic] = build_topic_dataframe(topic, fields, data, bag_time, printout)
+        if cache is not None:
+            cache.save(bag_path, get_cache_key(topic), topic_msgs[topic])
+
+    return {topic: topic_msgs[topic] for topic in topics}
+
+def iter_payloads(bag, topic_msgs, field='data'):
+    """
+    Iterate the payloads (e.g., compressed image bytes) of the rows of a topic
+
+    For a lazy topic (see read_topics), the payloads are loaded from the bag.
+    topic_msgs can be a pandas.Dataframe or TopicData.
+    """
+    if field in topic_msgs:
+        return iter(topic_msgs[field])
+    return bag.read_payloads(topic_msgs['bag_chunk_pos'], topic_msgs['bag_offset'])
+
+def read_topic_columns(messages):
+    """
+    Decode (topic, msg, t) into columns
+
+    Return {topic: (fields, {field: numpy.array}, bag_time)} of the topics found.
+    """
+    accessors = {}
+    rows = {}
+    bag_time = {}
+    for topic, msg, t in messages:
+        accessor = accessors.get(topic)
+        if accessor is None:
+            accessor = get_msg_accessor(msg)
+            accessors[topic] = accessor
+            rows[topic] = []
+            bag_time[topic] = []
+        rows[topic].append(accessor.getter(msg))
+        bag_time[topic].append(t.to_sec())
+
+    return {topic: (accessor.fields, accessor.to_columns(rows[topic]), np.asarray(bag_time[topic], dtype=np.float64))
+            for topic, accessor in accessors.items()}
+
+def read_chunk_block(bag_path, topics, chunk_indices):
+    """
+    Decode the msgs of the topics in a group of chunks (worker of read_topics_by_chunk)
+
+    Return {topic: (fields, columns, bag_time, order)}, where order is the position
+    of each msg in the time-sorted msgs of the whole bag.
+    """
+    with BagReader(bag_path) as bag:
+        time, chunk, offset, conn_id = bag.get_entries(topics)
+        order = np.flatnonzero(np.isin(chunk, chunk_indices))
+        order = order[np.lexsort((offset[order], chunk[order]))] # read each chunk once
+
+        def read_messages():
+            for i in order.tolist():
+                conn = bag.connections[int(conn_id[i])]
+                msg = bag.get_message_class(conn)()
+                msg.deserialize(bag.read_message_data(int(chunk[i]), int(offset[i])))
+                yield conn.topic, msg, Time.from_nsec(int(time[i]))
+
+        columns = read_topic_columns(read_messages())
+
+    topic_order = {}
+    for i in order.tolist():
+        topic_order.setdefault(bag.connections[int(conn_id[i])].topic, []).append(i)
+    return {topic: columns[topic] + (np.asarray(topic_order[topic]),) for topic in columns}
+
+def read_topics_by_chunk(bag, topics, num_workers=4):
+    """
+    Decode the topics of a single BagReader with its chunks split across a process pool
+
+    Each worker decodes a contiguous group of chunks into column blocks, which are
+    concatenated in time order. Return the same format as read_topic_columns().
+    """
+    chunk_groups = bag.get_chunk_groups(topics, num_workers)
+    if len(chunk_groups) <= 1:
+        return read_topic_columns(bag.read_messages(topics=topics))
+
+    with ProcessPoolExecutor(max_workers=len(chunk_groups)) as executor:
+        blocks = list(executor.map(
+            read_chunk_block,
+            [bag.filename] * len(chunk_groups),
+            [topics] * len(chunk_groups),
+            chunk_groups,
+        ))
+
+    columns = {}
+    for topic in topics:
+        topic_blocks = [block[topic] for block in blocks if topic in block]
+        if len(topic_blocks) == 0:
+            continue
+        order = np.argsort(np.concatenate([block[3] for block in topic_blocks]), kind='stable')
+        data = {name: np.concatenate([block[1][name] for block in topic_blocks])[order]
+                for name in topic_blocks[0][1]}
+        bag_time = np.concatenate([block[2] for block in topic_blocks])[order]
+        columns[topic] = (topic_blocks[0][0], data, bag_time)
+    return columns
+
+def build_topic_dataframe(topic, fields, data, bag_time, printout=True):
+    """Build the topic pandas.Dataframe from decoded columns"""
+    data['bag_time'] = np.asarray(bag_time, dtype=np.float64)
+
+    # use msg.header.stamp if found, otherwise use bag_time
+    if 'header.stamp' in data:
+        stamp = data['header.stamp']
+        data['ros_time'] = np.where(stamp != 0, stamp, data['bag_time']) # if timestamp not updated properly
+    else:
+        data['ros_time'] = data['bag_time'].copy()
 
     # calculate frequency
-    dt_total = 0
-    time_type = 'bag_time'
-    for i in range(1, len(data[time_type])):
-        dt_total += data[time_type][i] - data[time_type][i-1]
-    freq = (len(data[time_type]) - 1) / dt_total
+    dt_total = data['bag_time'][-1] - data['bag_time'][0]
+    freq = (len(data['bag_time']) - 1) / dt_total if dt_total > 0 else 0.0
     data['frequency'] = round(freq, 2)
 
     if printout:
         topic_info = {
             "topic": topic,
-            "fields": fields,
+            "fields": [name for name, _ in fields],
             "messages": len(data['bag_time']),
             'frequency': str(data['frequency']) + 'Hz',
         }
@@ -95,70 +360,203 @@ def get_topic_from_bag(bag, topic, printout=True):
 
     return pandas.DataFrame(data)
 
-def parse_pose_msg(data):
+class TopicData():
+    """
+    Time-indexed topic container
+
+    Holds one numpy array per column, sorted by 'ros_time'. window() finds the
+    time range by binary search and returns views sharing memory with the parent.
+    """
+    def __init__(self, data, frequency=0.0):
+        self.data = data
+        self.frequency = frequency
+
+    @classmethod
+    def from_dataframe(cls, topic_msgs):
+        """Build from a topic pandas.Dataframe"""
+        time = topic_msgs['ros_time'].to_numpy()
+        order = np.argsort(time, kind='stable') if np.any(np.diff(time) < 0) else None
+
+        data = {}
+        for name in topic_msgs.columns:
+            if name == 'frequency':
+                continue
+            column = topic_msgs[name].to_numpy()
+            data[name] = column[order] if order is not None else column
+
+        frequency = topic_msgs['frequency'].iloc[0] if len(topic_msgs) > 0 else 0.0
+        return cls(data, frequency)
+
+    @property
+    def columns(self):
+        return list(self.data.keys())
+
+    @property
+    def time(self):
+        return self.data['ros_time']
+
+    def __len__(self):
+        return len(self.data['ros_time'])
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def index_range(self, start_time, end_time):
+        """Index range of samples with start_time <= ros_time < end_time"""
+        start_index, end_index = np.searchsorted(self.time, [start_time, end_time], side='left')
+        return int(start_index), int(end_index)
+
+    def window(self, start_time, end_time):
+        """
+        View of samples with start_time <= ros_time < end_time, which can be empty
+        (crop_data_with_start_end_time returns None instead)
+        """
+        start_index, end_index = self.index_range(start_time, end_time)
+        data = {name: column[start_index:end_index] for name, column in self.data.items()}
+        return TopicData(data, self.frequency)
+
+    def shift(self, time_offset):
+        """Add timestamp offset, the other columns are shared"""
+        data = dict(self.data)
+        data['ros_time'] = self.data['ros_time'] + time_offset
+        return TopicData(data, self.frequency)
+
+    def to_dataframe(self):
+        """Convert to the pandas.Dataframe format of get_topic_from_bag()"""
+        data = dict(self.data)
+        data['frequency'] = self.frequency
+        return pandas.DataFrame(data)
+
+def as_topic_data(topic_msgs):
+    """Convert a topic pandas.Dataframe into TopicData if needed"""
+    if isinstance(topic_msgs, TopicData):
+        return topic_msgs
+    return TopicData.from_dataframe(topic_msgs)
+
+def parse_pose_msg(topic_msgs, prefix='pose.'):
     """Parse pose msg"""
     pose = {
-        'position_x': [],
-        'position_y': [],
-        'position_z': [],
-        'orientation_w': [],
-        'orientation_x': [],
-        'orientation_y': [],
-        'orientation_z': [],
+        'position_x': topic_msgs[prefix + 'position.x'].to_numpy(),
+        'position_y': topic_msgs[prefix + 'position.y'].to_numpy(),
+        'position_z': topic_msgs[prefix + 'position.z'].to_numpy(),
+        'orientation_w': topic_msgs[prefix + 'orientation.w'].to_numpy(),
+        'orientation_x': topic_msgs[prefix + 'orientation.x'].to_numpy(),
+        'orientation_y': topic_msgs[prefix + 'orientation.y'].to_numpy(),
+        'orientation_z': topic_msgs[prefix + 'orientation.z'].to_numpy(),
     }
-    for msg in data:
-        pose['position_x'].append(msg.pose.position.x)
-        pose['position_y'].append(msg.pose.position.y)
-        pose['position_z'].append(msg.pose.position.z)
-
-        pose['orientation_w'].append(msg.pose.orientation.w)
-        pose['orientation_x'].append(msg.pose.orientation.x)
-        pose['orientation_y'].append(msg.pose.orientation.y)
-        pose['orientation_z'].append(msg.pose.orientation.z)
 
     return pandas.DataFrame(pose)
 
-def parse_twist_msg(data):
+def parse_twist_msg(topic_msgs, prefix='twist.'):
     """Parse twist msg"""
     twists = {
-        'angular_x': [],
-        'angular_y': [],
-        'angular_z': [],
-        'linear_x': [],
-        'linear_y': [],
-        'linear_z': [],
+        'angular_x': topic_msgs[prefix + 'angular.x'].to_numpy(),
+        'angular_y': topic_msgs[prefix + 'angular.y'].to_numpy(),
+        'angular_z': topic_msgs[prefix + 'angular.z'].to_numpy(),
+        'linear_x': topic_msgs[prefix + 'linear.x'].to_numpy(),
+        'linear_y': topic_msgs[prefix + 'linear.y'].to_numpy(),
+        'linear_z': topic_msgs[prefix + 'linear.z'].to_numpy(),
     }
-    for msg in data:
-        twists['angular_x'].append(msg.twist.angular.x)
-        twists['angular_y'].append(msg.twist.angular.y)
-        twists['angular_z'].append(msg.twist.angular.z)
-
-        twists['linear_x'].append(msg.twist.linear.x)
-        twists['linear_y'].append(msg.twist.linear.y)
-        twists['linear_z'].append(msg.twist.linear.z)
 
     return pandas.DataFrame(twists)
 
-def timesync_topics(topic_list, force_use_first=True, printout=True):
+SYNC_MODES = ('nearest', 'previous', 'linear')
+
+def get_sync_index(time, time_query, mode='nearest'):
+    """
+    Match query timestamps against sorted topic timestamps
+
+    Return (left_index, right_index, weight, skew), where the synced value is
+    value[left_index] + weight * (value[right_index] - value[left_index]).
+    'nearest' and 'previous' always have weight = 0. skew is the time distance to
+    the matched sample(s), or inf if there is no valid match.
+    """
+    num = len(time)
+    if mode == 'nearest':
+        right = np.clip(np.searchsorted(time, time_query), 1, max(num - 1, 1))
+        left = right - 1
+        if num == 1:
+            right = left = np.zeros(len(time_query), dtype=np.int64)
+        use_left = (time_query - time[left]) <= (time[right] - time_query)
+        index = np.where(use_left, left, right)
+        skew = np.abs(time[index] - time_query)
+        return index, index, np.zeros(len(time_query)), skew
+
+    if mode == 'previous':
+        index = np.searchsorted(time, time_query, side='right') - 1
+        valid = index >= 0
+        index = np.clip(index, 0, num - 1)
+        skew = np.where(valid, time_query - time[index], np.inf)
+        return index, index, np.zeros(len(time_query)), skew
+
+    if mode == 'linear':
+        left = np.searchsorted(time, time_query, side='right') - 1
+        right = np.searchsorted(time, time_query, side='left') # equals left on exact match
+        valid = (left >= 0) & (right < num)
+        left = np.clip(left, 0, num - 1)
+        right = np.clip(right, 0, num - 1)
+        dt = time[right] - time[left]
+        weight = np.where(dt > 0, (time_query - time[left]) / np.where(dt > 0, dt, 1.0), 0.0)
+        skew = np.where(valid, np.maximum(time_query - time[left], time[right] - time_query), np.inf)
+        return left, right, weight, skew
+
+    raise ValueError("Unknown sync mode '%s', should be one of %s" % (mode, SYNC_MODES))
+
+def sync_topic(topic, time_query, mode='nearest'):
+    """
+    Resample one topic (TopicData) at the query timestamps
+
+    In 'linear' mode, float columns are interpolated and the others use the previous sample.
+    Return (topic_sync, skew)
+    """
+    left, right, weight, skew = get_sync_index(topic.time, time_query, mode)
+
+    data = {}
+    for name, column in topic.data.items():
+        if mode == 'linear' and column.dtype.kind == 'f':
+            data[name] = column[left] + weight * (column[right] - column[left])
+        else:
+            data[name] = column[left]
+    data['ros_time'] = time_query.copy()
+    data['frequency'] = topic.frequency
+
+    return pandas.DataFrame(data), skew
+
+def timesync_topics(topic_list, force_use_first=True, printout=True, mode='nearest', max_skew=None):
     """
     Time Synchronize different topics
     
-    topic_list = [topic1, topic2, ...] and each topic is in pandas.Dataframe format
+    topic_list = [topic1, topic2, ...] and each topic is in pandas.Dataframe or TopicData format.
+    The synchronized topics are returned in pandas.Dataframe format.
+
+    mode: 'nearest', 'previous' (causal, only use samples received before the base
+          timestamp) or 'linear' (interpolate continuous signals). Can also be a
+          list with one mode per topic. Note that angles are interpolated without wrapping.
+    max_skew: if not None, drop base timestamps whose match in any topic is further
+          than max_skew seconds away
     """
     assert len(topic_list) > 1, "The number of synchronized topics should be larger than one!"
 
+    if isinstance(mode, str):
+        mode = [mode] * len(topic_list)
+    assert len(mode) == len(topic_list), "The number of sync modes should match the number of topics!"
+    topic_list = [as_topic_data(topic) for topic in topic_list]
+
     base_index = 0
-    min_freq = topic_list[0]['frequency'][0]
+    min_freq = topic_list[0].frequency
     max_freq = min_freq
 
     # find the lowest and highest frequencies from all topics
     for i in range(1, len(topic_list)):
-        if topic_list[i]['frequency'][0] <  min_freq:
+        if topic_list[i].frequency <  min_freq:
             base_index = i
-            min_freq = topic_list[i]['frequency'][0]
+            min_freq = topic_list[i].frequency
         
-        if topic_list[i]['frequency'][0] >  max_freq:
-            max_freq = topic_list[i]['frequency'][0]
+        if topic_list[i].frequency >  max_freq:
+            max_freq = topic_list[i].frequency
         
     freq_diff = max_freq - min_freq
     if freq_diff > 5 and printout:
@@ -167,113 +565,109 @@ def timesync_topics(topic_list, force_use_first=True, printout=True):
     # if force to use the first topic as the base
     if force_use_first:
         base_index = 0
-        min_freq = topic_list[0]['frequency'][0]
+        min_freq = topic_list[0].frequency
 
     if printout:
         print("Use the %d column as the base. The synchronized frequency is %.0fHz." % (base_index, min_freq))
 
     # query timestamp
-    time_query = topic_list[base_index]['ros_time'].to_numpy().reshape(-1, 1)
+    time_query = topic_list[base_index].time
 
-    # KD Tree to find the closest timstamp
+    # sorted merge to find the matched timestamps
     topic_list_sync = []
+    valid = np.ones(len(time_query), dtype=bool)
     for i, topic in enumerate(topic_list):
         if i == base_index:
-            topic_list_sync.append(topic)
+            topic_list_sync.append(topic.to_dataframe())
             continue
-        time_kd = KDTree(topic['ros_time'].to_numpy().reshape(-1, 1))
-        _, query_idx = time_kd.query(time_query)
-        topic_sync = topic.iloc[query_idx].copy() # copy() is needed to avoid warning msg
-        topic_sync['new_index'] = np.arange(len(topic_sync)) # reset index in pandas dataframe
-        topic_sync.set_index('new_index', inplace=True, drop=True)
-        topic_sync['ros_time'] = time_query.copy()
+        topic_sync, skew = sync_topic(topic, time_query, mode[i])
         topic_list_sync.append(topic_sync)
-        
+        if max_skew is not None:
+            valid &= (skew <= max_skew)
+
+    # drop samples without a close enough match
+    if not np.all(valid):
+        if printout:
+            print("Drop %d of %d samples exceeding the max skew of %.3fs." % (np.sum(~valid), len(valid), max_skew))
+        time_query = time_query[valid]
+        topic_list_sync = [topic_sync[valid].reset_index(drop=True) for topic_sync in topic_list_sync]
+
     return time_query, topic_list_sync
 
-def find_freq_sweep_start_end_time(rosout_msgs):
-    """Find frequency sweep start and end time"""
+# rosout msgs at the start and end of the test maneuvers
+FREQ_SWEEP_MSGS = ("Start frequency sweep", "End of frequency sweep")
+DOUBLET_MSGS = ("Start doublet", "End of doublet")
+
+def find_rosout_start_end_time(rosout_msgs, start_msg, end_msg):
+    """
+    Find the (last) time of the start and end msgs in rosout
+
+    rosout_msgs is the rosout topic, or a utils.bag_events.BagEventIndex of the bag,
+    which avoids reading rosout again.
+    """
+    if hasattr(rosout_msgs, 'find_rosout_start_end_time'): # BagEventIndex
+        return rosout_msgs.find_rosout_start_end_time(start_msg, end_msg)
+    rosout_msgs = as_topic_data(rosout_msgs)
     start_time = None
     end_time = None
-    for i in range(len(rosout_msgs)):
-        if rosout_msgs['msg'].iloc[i] == "Start frequency sweep":
-            start_time = rosout_msgs['header'].iloc[i].stamp.secs + float(rosout_msgs['header'].iloc[i].stamp.nsecs) * 1e-9
-        if rosout_msgs['msg'].iloc[i] == "End of frequency sweep":
-            end_time = rosout_msgs['header'].iloc[i].stamp.secs + float(rosout_msgs['header'].iloc[i].stamp.nsecs) * 1e-9
+    start_index = np.flatnonzero(rosout_msgs['msg'] == start_msg)
+    if len(start_index) > 0:
+        start_time = rosout_msgs['header.stamp'][start_index[-1]]
+    end_index = np.flatnonzero(rosout_msgs['msg'] == end_msg)
+    if len(end_index) > 0:
+        end_time = rosout_msgs['header.stamp'][end_index[-1]]
     return start_time, end_time
 
-def find_freq_sweep_start_end_time_from_command(command_msgs):
-    """Find frequency sweep start and end time from command"""
-    start_time = None
-    end_time = None
+def find_command_change_time(command_msgs):
+    """Find the times of the first two changes in the speed command"""
+    command_msgs = as_topic_data(command_msgs)
     speed_cmd = command_msgs['linear_speed']
-    last_cmd = speed_cmd.iloc[0]
+    index = np.flatnonzero(speed_cmd[1:] != speed_cmd[:-1]) + 1
 
-    index = []
-    for i in range(len(speed_cmd)):
-        if speed_cmd.iloc[i] != last_cmd:
-            index.append(i)
-            last_cmd = speed_cmd.iloc[i]
-    
-    start_time = command_msgs['ros_time'].iloc[index[0]]
-    end_time = command_msgs['ros_time'].iloc[index[1]]
-    
+    start_time = command_msgs['ros_time'][index[0]]
+    end_time = command_msgs['ros_time'][index[1]]
     return start_time, end_time
 
+def find_freq_sweep_start_end_time(rosout_msgs):
+    """Find frequency sweep start and end time, from rosout or a BagEventIndex"""
+    return find_rosout_start_end_time(rosout_msgs, *FREQ_SWEEP_MSGS)
+
+def find_freq_sweep_start_end_time_from_command(command_msgs):
+    """Find frequency sweep start and end time from command"""
+    return find_command_change_time(command_msgs)
+
 def find_doublet_start_end_time(rosout_msgs):
-    """Find doublet start and end time"""
-    start_time = None
-    end_time = None
-    for i in range(len(rosout_msgs)):
-        if rosout_msgs['msg'].iloc[i] == "Start doublet":
-            start_time = rosout_msgs['header'].iloc[i].stamp.secs + float(rosout_msgs['header'].iloc[i].stamp.nsecs) * 1e-9
-        if rosout_msgs['msg'].iloc[i] == "End of doublet":
-            end_time = rosout_msgs['header'].iloc[i].stamp.secs + float(rosout_msgs['header'].iloc[i].stamp.nsecs) * 1e-9
-    return start_time, end_time
+    """Find doublet start and end time, from rosout or a BagEventIndex"""
+    return find_rosout_start_end_time(rosout_msgs, *DOUBLET_MSGS)
 
 def find_doublet_start_end_time_from_command(command_msgs):
     """Find doublet start and end time"""
-    start_time = None
-    end_time = None
-    speed_cmd = command_msgs['linear_speed']
-    last_cmd = speed_cmd.iloc[0]
-
-    index = []
-    for i in range(len(speed_cmd)):
-        if speed_cmd.iloc[i] != last_cmd:
-            index.append(i)
-            last_cmd = speed_cmd.iloc[i]
-    
-    start_time = command_msgs['ros_time'].iloc[index[0]]
-    end_time = command_msgs['ros_time'].iloc[index[1]]
-    
-    return start_time, end_time
+    return find_command_change_time(command_msgs)
 
 def crop_data_with_start_end_time(topic_msgs, start_time, end_time):
-    """Crop data using start and end time"""
-    start_index = None
-    end_index = None
+    """
+    Crop data using start and end time
 
-    if start_time > topic_msgs['ros_time'].iloc[-1] or end_time < topic_msgs['ros_time'].iloc[0]:
+    Return the same type as topic_msgs (pandas.Dataframe or TopicData), or None
+    if no data was found in the time range.
+    """
+    if isinstance(topic_msgs, TopicData):
+        start_index, end_index = topic_msgs.index_range(start_time, end_time)
+    else:
+        start_index, end_index = np.searchsorted(topic_msgs['ros_time'].to_numpy(), [start_time, end_time], side='left')
+    if end_index <= start_index:
         print('No data was found in the time range. Return None.')
         return None
 
-    for i in range(len(topic_msgs)):
-        if start_index is None and topic_msgs['ros_time'].iloc[i] >= start_time:
-            start_index = i
-        
-        if end_index is None and topic_msgs['ros_time'].iloc[i] >= end_time:
-            end_index = i - 1
-
-    topic_msg_crop = topic_msgs.loc[start_index:end_index].copy()
-    topic_msg_crop.reset_index(drop=True)
-    topic_msg_crop[''] = np.arange(len(topic_msg_crop)) # reset index in pandas dataframe
-    topic_msg_crop.set_index('', inplace=True, drop=True)
-
-    return topic_msg_crop
+    if isinstance(topic_msgs, TopicData):
+        return topic_msgs.window(start_time, end_time)
+    return topic_msgs.iloc[start_index:end_index].reset_index(drop=True)
 
 def add_timestamp_offset(topic_msgs, time_offset=0.0):
     """Add timestamp offset"""
+    if isinstance(topic_msgs, TopicData):
+        return topic_msgs.shift(time_offset)
+
     new_topic_msgs = topic_msgs.copy()
     new_topic_msgs['ros_time'] += time_offset
 
@@ -281,42 +675,22 @@ def add_timestamp_offset(topic_msgs, time_offset=0.0):
 
 def get_linear_acceleration_from_imu(imu_msgs):
     """Get linear acceleration from IMU msgs"""
-    acc_x = []
-    acc_y = []
-    acc_z = []
-    for accel in imu_msgs['linear_acceleration']:
-        acc_x.append(accel.x)
-        acc_y.append(accel.y)
-        acc_z.append(accel.z)
-
-    acc_x = np.array(acc_x)
-    acc_y = np.array(acc_y)
-    acc_z = np.array(acc_z)
+    acc_x = imu_msgs['linear_acceleration.x'].to_numpy()
+    acc_y = imu_msgs['linear_acceleration.y'].to_numpy()
+    acc_z = imu_msgs['linear_acceleration.z'].to_numpy()
 
     return acc_x, acc_y, acc_z
 
 def get_angular_velocity_from_imu(imu_msgs):
     """Get angular velocity from IMU msgs"""
-    gyro_x = []
-    gyro_y = []
-    gyro_z = []
-    for gyro in imu_msgs['angular_velocity']:
-        gyro_x.append(gyro.x)
-        gyro_y.append(gyro.y)
-        gyro_z.append(gyro.z)
-
-    gyro_x = np.array(gyro_x)
-    gyro_y = np.array(gyro_y)
-    gyro_z = np.array(gyro_z)
+    gyro_x = imu_msgs['angular_velocity.x'].to_numpy()
+    gyro_y = imu_msgs['angular_velocity.y'].to_numpy()
+    gyro_z = imu_msgs['angular_velocity.z'].to_numpy()
 
     return gyro_x, gyro_y, gyro_z
 
 def get_linear_x_from_odom(odom_msgs):
     """Get linear x from Odometry msg"""
-    linear_x = []
-    for msg in odom_msgs['twist']:
-        linear_x.append(msg.twist.linear.x)
-
-    linear_x = np.array(linear_x)
+    linear_x = odom_msgs['twist.twist.linear.x'].to_numpy()
     
     return linear_x
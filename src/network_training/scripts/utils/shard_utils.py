@@ -0,0 +1,338 @@
+"""
+Packed training shards written straight from bags
+
+A shard holds the synced samples of one bag, in place of the color/ image folder
+and the csv file of an extracted folder:
+
+    <shard_folder>/images.npy   uint8 (N, height, width, 3) RGB frames, pre-resized
+    <shard_folder>/labels.npz   one array of length N per label/state column
+    <shard_folder>/shard.json   source bag, time range, image size and columns
+
+Frames are decoded and resized in a thread pool and streamed into a memory-mapped
+images.npy, so neither full-resolution frames nor small image files hit the disk.
+
+For training, ShardReader memory-maps images.npy and FrameList indexes the frames
+of shards and of extracted folders as one list, so a Dataset reads a sample as a
+zero-copy slice when the shard is at the model resolution.
+
+Example to pack extracted folders:
+
+python -m utils.shard_utils /media/lab/NEPTUNE2/field_datasets/row_18 /media/lab/NEPTUNE2/field_shards/row_18 --resize 256 256
+
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import numpy as np
+import pandas
+import cv2
+
+from utils.image_utils import decode_images
+from utils.train_utils import get_color_file_list
+
+SHARD_VERSION = 1
+SHARD_INFO_FILE = 'shard.json'
+SHARD_IMAGE_FILE = 'images.npy'
+SHARD_LABEL_FILE = 'labels.npz'
+SHARD_MANIFEST_FILE = 'shard_manifest.json'
+LABEL_FILES = ['pose.csv', 'states.csv']
+
+
+def is_shard_folder(folder_path):
+    return os.path.isfile(os.path.join(folder_path, SHARD_INFO_FILE))
+
+def read_shard_info(shard_folder):
+    with open(os.path.join(shard_folder, SHARD_INFO_FILE), 'r') as file:
+        return json.load(file)
+
+def write_shard(shard_folder, payloads, labels, resize, info=None, num_workers=4, max_in_flight=32):
+    """
+    Pack compressed images and their label columns into a shard, return the number of frames
+
+    payloads yields one compressed image per row of labels (a pandas.DataFrame with a
+    'time' column). Frames are resized to [width, height] and stored as RGB. Extra
+    info (e.g., the source bag) is saved to shard.json.
+    """
+    num_frames = len(labels)
+    tmp_folder = shard_folder + '.tmp'
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    # write to a temporary folder first so a crash never leaves a partial shard
+    images = np.lib.format.open_memmap(
+        os.path.join(tmp_folder, SHARD_IMAGE_FILE),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(num_frames, resize[1], resize[0], 3),
+    )
+    count = 0
+    for image in decode_images(payloads, num_workers, max_in_flight, resize):
+        if count >= num_frames:
+            raise ValueError("More images than label rows in %s" % shard_folder)
+        images[count] = image[:, :, ::-1] # BGR to RGB
+        count += 1
+    if count != num_frames:
+        raise ValueError("Expected %d images in %s, got %d" % (num_frames, shard_folder, count))
+    images.flush()
+    del images
+
+    columns = list(labels.columns)
+    np.savez(os.path.join(tmp_folder, SHARD_LABEL_FILE), **{name: labels[name].to_numpy() for name in columns})
+
+    shard_info = dict(info or {})
+    shard_info.update({
+        'version': SHARD_VERSION,
+        'num_frames': num_frames,
+        'image_size': [int(resize[0]), int(resize[1])],
+        'columns': columns,
+        'start_time': float(labels['time'].iloc[0]) if num_frames > 0 else None,
+        'end_time': float(labels['time'].iloc[-1]) if num_frames > 0 else None,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+    })
+    with open(os.path.join(tmp_folder, SHARD_INFO_FILE), 'w') as file:
+        json.dump(shard_info, file, indent=2)
+
+    if os.path.isdir(shard_folder):
+        shutil.rmtree(shard_folder)
+    os.replace(tmp_folder, shard_folder)
+    return num_frames
+
+def find_shard_folders(root_folder_path):
+    """All shard folders under a folder (recursive), sorted by path"""
+    shard_folders = []
+    for folder, subfolders, _ in os.walk(root_folder_path):
+        if is_shard_folder(folder):
+            shard_folders.append(folder)
+            subfolders[:] = []
+    return sorted(shard_folders)
+
+def write_shard_manifest(root_folder_path):
+    """
+    Collect the shard.json of every shard under a folder into shard_manifest.json,
+    which maps each shard (relative path) to its source bag and time range
+    """
+    shards = {}
+    for shard_folder in find_shard_folders(root_folder_path):
+        shard_info = read_shard_info(shard_folder)
+        shards[os.path.relpath(shard_folder, root_folder_path)] = {
+            'bag': shard_info.get('bag'),
+            'start_time': shard_info['start_time'],
+            'end_time': shard_info['end_time'],
+            'num_frames': shard_info['num_frames'],
+            'image_size': shard_info['image_size'],
+        }
+
+    manifest_path = os.path.join(root_folder_path, SHARD_MANIFEST_FILE)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(shards, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+    print("%d shards in %s" % (len(shards), manifest_path))
+    return shards
+
+def pack_extracted_folder(folder_path, shard_folder, resize, num_workers=4):
+    """Pack an extracted folder (color/ images and pose.csv or states.csv) into a shard"""
+    label_files = [file for file in LABEL_FILES if os.path.isfile(os.path.join(folder_path, file))]
+    color_file_list = get_color_file_list(folder_path)
+    if len(label_files) > 0:
+        labels = pandas.read_csv(os.path.join(folder_path, label_files[0]))
+        if len(labels) != len(color_file_list):
+            raise ValueError("%d images but %d rows in %s" % (len(color_file_list), len(labels), label_files[0]))
+    else:
+        labels = pandas.DataFrame({'time': np.arange(len(color_file_list), dtype=np.float64)})
+
+    def iter_file_payloads():
+        for file_path in color_file_list:
+            with open(file_path, 'rb') as file:
+                yield file.read()
+
+    return write_shard(
+        shard_folder,
+        iter_file_payloads(),
+        labels,
+        resize,
+        info={'source_folder': os.path.abspath(folder_path)},
+        num_workers=num_workers,
+    )
+
+
+class ShardReader():
+    def __init__(self, shard_folder):
+        self.shard_folder = shard_folder
+        self.info = read_shard_info(shard_folder)
+        self.image_size = self.info['image_size'] # [width, height]
+        self._images = None
+
+    def __len__(self):
+        return self.info['num_frames']
+
+    @property
+    def images(self):
+        """(N, height, width, 3) RGB frames, memory-mapped on first access"""
+        if self._images is None:
+            # copy-on-write so the slices are writable without touching the file
+            self._images = np.load(os.path.join(self.shard_folder, SHARD_IMAGE_FILE), mmap_mode='c')
+        return self._images
+
+    def read_labels(self):
+        """Label and state columns as a pandas.DataFrame"""
+        with np.load(os.path.join(self.shard_folder, SHARD_LABEL_FILE)) as file:
+            return pandas.DataFrame({name: file[name] for name in self.info['columns']})
+
+    def __getstate__(self):
+        # never pickle the memory map, each DataLoader worker maps the file itself
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+
+def read_label_table(folder_path, file_name, manifest=None):
+    """
+    Label columns of an extracted folder (i.e., file_name) or of a shard, from the
+    cached utils.dataset_manifest.DatasetManifest if given
+    """
+    if manifest is not None:
+        return pandas.DataFrame(manifest.get_folder(folder_path)['labels'][file_name])
+    if is_shard_folder(folder_path):
+        return ShardReader(folder_path).read_labels()
+    return pandas.read_csv(os.path.join(folder_path, file_name))
+
+
+class ImageFolder():
+    """
+    Sorted %07i.png/jpg images of an extracted folder, kept as integer frame numbers
+    instead of full path strings
+    """
+    EXTENSIONS = ('png', 'jpg')
+
+    def __init__(self, folder_path, frame_numbers=None, extensions=None):
+        self.color_folder = os.path.join(folder_path, 'color')
+        if frame_numbers is None:
+            frame_numbers, extensions = ImageFolder.scan(folder_path)
+        self.frame_numbers = frame_numbers # int32
+        self.extensions = extensions # uint8 index in EXTENSIONS
+
+    @staticmethod
+    def scan(folder_path):
+        """(frame_numbers, extensions) of the images, sorted by file name as get_color_file_list"""
+        color_folder = os.path.join(folder_path, 'color')
+        file_names = []
+        if os.path.isdir(color_folder):
+            file_names = sorted(file for file in os.listdir(color_folder) if file[-3:] in ImageFolder.EXTENSIONS)
+        frame_numbers = np.array([int(file[:-4]) for file in file_names], dtype=np.int32)
+        extensions = np.array([ImageFolder.EXTENSIONS.index(file[-3:]) for file in file_names], dtype=np.uint8)
+        return frame_numbers, extensions
+
+    def __len__(self):
+        return len(self.frame_numbers)
+
+    def get_path(self, index):
+        file_name = "%07i.%s" % (self.frame_numbers[index], ImageFolder.EXTENSIONS[self.extensions[index]])
+        return os.path.join(self.color_folder, file_name)
+
+
+class FrameList():
+    def __init__(self, resize=None):
+        self.resize = resize # [width, height]
+        self.folders = []
+        self.sources = [] # ShardReader or ImageFolder
+        self.frame_indices = [] # selected frames of each source
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def add_folder(self, folder_path, selection=None, manifest=None):
+        """
+        Add the frames of a shard or an extracted folder, return the number added
+
+        selection is a boolean mask or index array of the frames to keep. The image
+        files are listed from the cached manifest if given.
+        """
+        if is_shard_folder(folder_path):
+            source = ShardReader(folder_path)
+        elif manifest is not None:
+            entry = manifest.get_folder(folder_path)
+            source = ImageFolder(folder_path, entry['frame_numbers'], entry['extensions'])
+        else:
+            source = ImageFolder(folder_path)
+
+        frame_index = np.arange(len(source), dtype=np.int64)
+        if selection is not None:
+            frame_index = frame_index[np.asarray(selection)]
+
+        self.folders.append(folder_path)
+        self.sources.append(source)
+        self.frame_indices.append(frame_index)
+        self.offsets = np.append(self.offsets, self.offsets[-1] + len(frame_index))
+        return len(frame_index)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def get_groups(self, level=0):
+        """
+        Group index of each sample, i.e., the index of its folder (level=0, one flight)
+        or of the parent folder level steps up (e.g., level=1 for the iterN folders)
+        """
+        keys = [os.path.normpath(folder) for folder in self.folders]
+        for _ in range(level):
+            keys = [os.path.dirname(key) for key in keys]
+        _, source_groups = np.unique(keys, return_inverse=True)
+        return np.repeat(source_groups.reshape(-1), np.diff(self.offsets))
+
+    def locate(self, idx):
+        """(source index, frame index in the source) of a sample"""
+        source_index = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return source_index, int(self.frame_indices[source_index][idx - self.offsets[source_index]])
+
+    def get_frame_number(self, idx):
+        """Frame number of a sample in its folder, i.e., %07i of the image file"""
+        source_index, frame_index = self.locate(idx)
+        source = self.sources[source_index]
+        if isinstance(source, ImageFolder):
+            return int(source.frame_numbers[frame_index])
+        return frame_index
+
+    def __getitem__(self, idx):
+        """RGB uint8 image of a sample, resized to self.resize"""
+        source_index, frame_index = self.locate(idx)
+        source = self.sources[source_index]
+        if isinstance(source, ShardReader):
+            rgb_img = source.images[frame_index]
+            if self.resize is not None and list(self.resize) != source.image_size:
+                rgb_img = cv2.resize(rgb_img, (self.resize[0], self.resize[1]))
+            return rgb_img
+
+        bgr_img = cv2.imread(source.get_path(frame_index), cv2.IMREAD_UNCHANGED)
+        rgb_img = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
+        if self.resize is not None:
+            rgb_img = cv2.resize(rgb_img, (self.resize[0], self.resize[1]))
+        return rgb_img
+
+
+def main():
+    """
+    Pack every extracted folder (i.e., with a color/ folder) under a folder into shards,
+    mirroring the folder tree
+    """
+    parser = argparse.ArgumentParser(description="Pack extracted image folders into training shards.")
+    parser.add_argument("dataset_folder", help="Root folder of the extracted data.")
+    parser.add_argument("output_folder", help="Root folder of the shards.")
+    parser.add_argument("--resize", type=int, nargs=2, required=True, metavar=('WIDTH', 'HEIGHT'),
+                        help="Image size of the shards, i.e., the model resolution.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of decoding threads.")
+    args = parser.parse_args()
+
+    for folder, subfolders, _ in os.walk(args.dataset_folder):
+        if 'color' not in subfolders:
+            continue
+        subfolders[:] = []
+        shard_folder = os.path.join(args.output_folder, os.path.relpath(folder, args.dataset_folder))
+        num_frames = pack_extracted_folder(folder, shard_folder, args.resize, args.workers)
+        print("%s: %d frames" % (shard_folder, num_frames))
+
+    write_shard_manifest(args.output_folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Train/test split of a Dataset by index, keeping each flight on one side
+
+Only the sample indices are split, the Dataset is never iterated, and the samples
+of a group (e.g., a flight folder or a DAgger iteration) are either all in the
+training set or all in the test set.
+"""
+import numpy as np
+from sklearn.model_selection import GroupShuffleSplit
+from torch.utils.data import Subset
+
+
+def split_indices_by_group(groups, test_size, random_state=None):
+    """
+    (train_index, test_index) sorted arrays, test_size is the fraction (float) or
+    number (int) of groups in the test set
+    """
+    groups = np.asarray(groups)
+    splitter = GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=random_state)
+    train_index, test_index = next(splitter.split(np.zeros(len(groups)), groups=groups))
+    return np.sort(train_index), np.sort(test_index)
+
+def split_dataset_by_group(dataset, groups, test_size, random_state=None):
+    """(train, test) torch.utils.data.Subset of a dataset, groups has one entry per sample"""
+    if len(groups) != len(dataset):
+        raise ValueError("Expected %d groups, got %d" % (len(dataset), len(groups)))
+    train_index, test_index = split_indices_by_group(groups, test_size, random_state)
+    return Subset(dataset, train_index.tolist()), Subset(dataset, test_index.tolist())
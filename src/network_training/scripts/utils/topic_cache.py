@@ -0,0 +1,133 @@
+"""
+On-disk cache of decoded bag topics
+
+Each topic is stored as a columnar .npz file keyed by the bag path, size, mtime
+and topic name, so re-running an extraction script skips decoding the bag.
+Topics with a payload column (e.g., the data bytes of an image topic) are not
+cached, they would fill the cache with copies of the bags. String and array
+columns are stored as fixed-width string and 2D arrays, so the files are loaded
+without pickle.
+
+The cache is off by default, set NEPTUNE_TOPIC_CACHE to the cache folder or call
+rosbag_utils.set_topic_cache() to enable it.
+"""
+import os
+import hashlib
+import numpy as np
+import pandas
+
+# bump when the column layout of the cached topics changes, older files are not loaded
+CACHE_VERSION = 2
+
+
+def encode_column(column):
+    """
+    Column as a (numpy array without objects, kind) pair, None if it cannot be stored
+
+    kind is 'value' for typed columns, 'string' for strings and 'array' for
+    arrays of numbers of the same length (e.g., covariance).
+    """
+    if column.dtype != object:
+        return column, 'value'
+    values = column.tolist()
+    if all(isinstance(value, str) for value in values):
+        return np.array(values, dtype=str) if len(values) > 0 else np.empty(0, dtype='U1'), 'string'
+    if len(values) > 0 and all(isinstance(value, (tuple, list)) for value in values):
+        if len(set(len(value) for value in values)) == 1:
+            array = np.array(values)
+            if array.dtype.kind in 'biuf':
+                return array, 'array'
+    return None
+
+def decode_column(array, kind):
+    if kind == 'value':
+        return array
+    column = np.empty(len(array), dtype=object)
+    column[:] = array.tolist() if kind == 'string' else [tuple(row) for row in array.tolist()]
+    return column
+
+
+class TopicCache():
+    def __init__(self,
+        cache_dir,
+        max_size=10 * 1024**3,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size # in bytes
+
+    def get_cache_path(self, bag_path, topic):
+        """Cache file of a topic, keyed by bag identity"""
+        stat = os.stat(bag_path)
+        key = "%d|%s|%d|%d|%s" % (CACHE_VERSION, os.path.abspath(bag_path), stat.st_size, stat.st_mtime_ns, topic)
+        file_name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz'
+        return os.path.join(self.cache_dir, file_name)
+
+    def load(self, bag_path, topic):
+        """Load topic pandas.Dataframe from cache, return None if not cached"""
+        cache_path = self.get_cache_path(bag_path, topic)
+        if not os.path.isfile(cache_path):
+            return None
+
+        try:
+            with np.load(cache_path, allow_pickle=False) as file:
+                columns = file['columns'].tolist()
+                kinds = file['kinds'].tolist()
+                data = {name: decode_column(file['arr_%d' % i], kind) for i, (name, kind) in enumerate(zip(columns, kinds))}
+        except Exception as error:
+            print("Failed to read cache file %s: %s" % (cache_path, error))
+            return None
+
+        os.utime(cache_path) # mark as recently used
+        return pandas.DataFrame(data)
+
+    @staticmethod
+    def is_cacheable(topic_msgs):
+        """Whether all columns can be stored, i.e., no payload (bytes) column"""
+        return all(encode_column(topic_msgs[name].to_numpy()) is not None for name in topic_msgs.columns)
+
+    def save(self, bag_path, topic, topic_msgs):
+        """Save topic pandas.Dataframe to cache, return False if not cacheable"""
+        columns = list(topic_msgs.columns)
+        encoded = [encode_column(topic_msgs[name].to_numpy()) for name in columns]
+        if any(column is None for column in encoded):
+            return False
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        cache_path = self.get_cache_path(bag_path, topic)
+        arrays = [array for array, _ in encoded]
+        kinds = [kind for _, kind in encoded]
+
+        # write to a temporary file first so a crash never leaves a partial cache file
+        tmp_path = cache_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, *arrays, columns=np.array(columns, dtype=str), kinds=np.array(kinds, dtype=str))
+        os.replace(tmp_path, cache_path)
+
+        self.evict()
+        return True
+
+    def evict(self):
+        """Remove least recently used cache files until under max_size"""
+        cache_files = []
+        total_size = 0
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.npz') or file_name.endswith('.tmp.npz'):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            cache_files.append((stat.st_mtime, stat.st_size, file_name))
+            total_size += stat.st_size
+
+        cache_files.sort()
+        for _, size, file_name in cache_files:
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total_size -= size
+
+    def clear(self):
+        """Remove all cache files"""
+        if not os.path.isdir(self.cache_dir):
+            return
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, file_name))
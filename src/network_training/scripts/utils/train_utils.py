@@ -1,3 +1,5 @@
+import os
+import glob
 import yaml
 import pandas
 import numpy as np
@@ -20,6 +22,16 @@ def read_yaml(file_path):
         exit('Exit the program.')
 
 
+def get_color_file_list(folder_path):
+    '''
+    Sorted color image files (%07i.png or %07i.jpg) of an extracted folder
+    '''
+    color_file_list = glob.glob(os.path.join(folder_path, 'color', '*.png'))
+    color_file_list.extend(glob.glob(os.path.join(folder_path, 'color', '*.jpg')))
+    color_file_list.sort()
+    return color_file_list
+
+
 def read_map_data(filepath):
     '''
     Read map spline data
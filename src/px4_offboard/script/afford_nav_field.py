@@ -4,7 +4,6 @@ import pickle
 import math
 import rospy
 import numpy as np
-from shapely.geometry.polygon import Polygon
 
 from std_msgs.msg import Float64
 from sensor_msgs.msg import NavSatFix, Image
@@ -13,9 +12,9 @@ from px4_offboard.msg import Affordance, ControlCmd
 from mavros_msgs.srv import SetMode
 
 from utils.navigation_utils import (
-    get_local_xy_from_latlon,
+    LatLonToLocal,
     get_projection_point2line,
-    whether_in_polygon,
+    RowIndex,
 )
 from utils.math_utils import wrap_2PI, wrap_PI, constrain_value
 
@@ -86,6 +85,7 @@ class AffordanceNav():
 
         # local position (calculated from lat, lon)
         self.utm_T_local = None
+        self.latlon_to_local = None
         self.local_x = 0.0
         self.local_y = 0.0
 
@@ -162,16 +162,15 @@ class AffordanceNav():
             field_data = pickle.load(file)
 
         self.field_data = field_data['row_data']
+        self.row_index = RowIndex(self.field_data)
         self.set_utm_T_local(field_data['utm_T_local'])
 
     def set_utm_T_local(self, utm_T_local):
         self.utm_T_local = np.copy(utm_T_local)
+        self.latlon_to_local = LatLonToLocal(self.utm_T_local)
 
     def set_target_index(self, target_index):
         self.target_index = target_index
-        self.target_polygon = Polygon(
-            [vertex for vertex in self.field_data[target_index]['vertice']]
-        )
         rospy.loginfo("Row Index: %i" % target_index)
 
     def global_position_callback(self, msg):
@@ -179,12 +178,8 @@ class AffordanceNav():
         self.current_lon = msg.longitude
         self.current_alt = msg.altitude
 
-        if self.utm_T_local is not None:
-            local_pos = get_local_xy_from_latlon(
-                self.current_lat,
-                self.current_lon,
-                self.utm_T_local
-            )
+        if self.latlon_to_local is not None:
+            local_pos = self.latlon_to_local(self.current_lat, self.current_lon)
             self.local_x = local_pos[0]
             self.local_y = local_pos[1]
 
@@ -261,10 +256,7 @@ class AffordanceNav():
                 self.reference_line,
             )
             rel_angle = wrap_PI(current_heading - self.reference_heading)
-            in_bound = whether_in_polygon(
-                [self.local_x, self.local_y, current_heading],
-                self.target_polygon,
-            )
+            in_bound = self.row_index.contains(self.local_x, self.local_y, self.target_index)
             self.affordance['dist_center'] = lat_proj
             self.affordance['rel_angle'] = rel_angle
             self.affordance['in_bound'] = in_bound